@@ -247,8 +247,9 @@ def is_domogik_advanced(advanced_mode, sect, key):
         'domogik': ['libraries_path', 'src_prefix', \
                 'log_dir_path', 'pid_dir_path', 'broadcast', 'log_level', \
                 'log_when', 'log_interval', 'log_backup_count'],
-        'database': ['prefix', 'pool_recycle', 'portcache'],
+        'database': ['prefix', 'pool_recycle', 'portcache', 'history_partitioning'],
         'admin': ['port', 'ws_port', 'use_ssl', 'ssl_certificate', 'ssl_key', 'clean_json', 'rest_auth', 'secret_key', 'http_workers_number'],
+        'xplgw': ['store_workers', 'queue_size', 'overload_policy', 'overload_policies'],
     }
     if advanced_mode:
         return True
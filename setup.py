@@ -83,6 +83,7 @@ setup(
             dmg_package = domogik.bin.package:main
             dmg_testrunner = domogik.tests.bin.testrunner:main
             dmg_cron = domogik.bin.cron:main
+            dmg_rollup = domogik.bin.rollup:main
             dmg_review = domogik.tools.packages.review:main
         """
         ]
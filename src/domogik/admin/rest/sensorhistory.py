@@ -2,12 +2,56 @@ from domogik.admin.application import app, json_response, timeit
 from domogik.common.configloader import Loader
 import sys
 import os
+import json
+import itertools
 import domogik
 from subprocess import Popen, PIPE
-from flask import Response
+from flask import Response, request
 from flask_login import login_required
 import traceback
 
+# number of history values sent in each chunk of a streamed response
+STREAM_CHUNK_SIZE = 1000
+
+def _history_chunks(values, ndjson):
+    """ Generate a history document by chunks of STREAM_CHUNK_SIZE values
+        @param values : iterator on (timestamp, value_num, value_str) tuples
+        @param ndjson : if True, one json value per line, else a json list
+    """
+    if ndjson:
+        start, sep, end = u"", u"\n", u"\n"
+    else:
+        start, sep, end = u"[", u", ", u"]"
+    chunk = [start]
+    count = 0
+    for timestamp, value_num, value_str in values:
+        if count > 0:
+            chunk.append(sep)
+        chunk.append(json.dumps({"timestamp" : timestamp, "value_num" : value_num, "value_str" : value_str}))
+        count += 1
+        if count % STREAM_CHUNK_SIZE == 0:
+            yield u"".join(chunk)
+            chunk = []
+    if count > 0 or not ndjson:
+        chunk.append(end)
+    yield u"".join(chunk)
+
+def _history_stream(sid, ftime, ttime=None):
+    """ Return a streamed (chunked) response with the history of a sensor between 2 timestamps
+        The values are sent as a json list, or as ndjson (one value per line) with the
+        ?format=ndjson parameter or the 'Accept: application/x-ndjson' header
+        With the ?points=N parameter, the values are downsampled to N values
+    """
+    ndjson = request.args.get('format') == 'ndjson' or \
+             request.accept_mimetypes.best == 'application/x-ndjson'
+    points = request.args.get('points', type=int)
+    chunks = _history_chunks(app.db.iter_sensor_history_between(sid, ftime, ttime, points=points), ndjson)
+    # the query is done for the first chunk : its errors are still returned as a 500 error
+    first = next(chunks)
+    return Response(response=itertools.chain([first], chunks),
+                    status=200,
+                    content_type='application/x-ndjson' if ndjson else 'application/json')
+
 @app.route('/rest/sensorhistory/id/<int:sid>/latest')
 @app.route('/rest/sensorhistory/id/<int:sid>/latest/')
 @json_response
@@ -178,6 +222,8 @@ def sensorHistory_from(sid, ftime):
 
     @apiParam {Number} id The id of the sensor we want to retrieve the history from
     @apiParam {Number} tstamp The unixtimestamp from what time you want the history to start
+    @apiParam {String} [format] ndjson to get one value per line instead of a json list (or use the 'Accept: application/x-ndjson' header). The response is streamed
+    @apiParam {Number} [points] Max number of values to return : the values are downsampled with the Largest-Triangle-Three-Buckets algorithm, which keeps the peaks (min 3)
 
     @apiSuccess {json} result The json representing the latest value
 
@@ -222,10 +268,7 @@ def sensorHistory_from(sid, ftime):
         }
     """
     try:
-        app.db.open_session()
-        res = app.db.list_sensor_history_between(sid, ftime)
-        app.db.close_session()
-        return 200, res
+        return _history_stream(sid, ftime)
     except:
         msg = u"Error while getting the sensor history. Error is : {0}".format(traceback.format_exc())
         app.logger.error(msg)
@@ -245,6 +288,8 @@ def sensorHistory_from_to(sid, ftime, ttime):
     @apiParam {Number} id The id of the sensor we want to retrieve the history from
     @apiParam {Number} tstampFrom The unixtimestamp from what time you want the history to start
     @apiParam {Number} tstampTo The unixtimestamp to what time you want the history to show up
+    @apiParam {String} [format] ndjson to get one value per line instead of a json list (or use the 'Accept: application/x-ndjson' header). The response is streamed
+    @apiParam {Number} [points] Max number of values to return : the values are downsampled with the Largest-Triangle-Three-Buckets algorithm, which keeps the peaks (min 3)
 
     @apiSuccess {json} result The json representing the latest value
 
@@ -289,10 +334,7 @@ def sensorHistory_from_to(sid, ftime, ttime):
         }
     """
     try:
-        app.db.open_session()
-        b = app.db.list_sensor_history_between(sid, ftime, ttime)
-        app.db.close_session()
-        return 200, b
+        return _history_stream(sid, ftime, ttime)
     except:
         msg = u"Error while getting the sensor history. Error is : {0}".format(traceback.format_exc())
         app.logger.error(msg)
@@ -468,3 +510,225 @@ def sensorHistory_from_to_filter(sid, ftime, interval, selector):
         msg = u"Error while getting the sensor history. Error is : {0}".format(traceback.format_exc())
         app.logger.error(msg)
         return 500, {'error': msg}
+
+def _parse_sensor_ids(ids):
+    """ Return the list of sensor ids of a 'id1,id2,...' url part, None if it is not valid
+    """
+    try:
+        return [int(sid) for sid in ids.split(',') if sid.strip() != '']
+    except ValueError:
+        return None
+
+@app.route('/rest/sensorhistory/ids/<ids>/from/<int:ftime>')
+@app.route('/rest/sensorhistory/ids/<ids>/from/<int:ftime>/to/<int:ttime>')
+@json_response
+@login_required
+@timeit
+def sensorsHistory_from_to(ids, ftime, ttime=None):
+    """
+    @api {get} /rest/sensorhistory/ids/<ids>/from/<tstampFrom>/to/<tstampTo> Retrieve the history of several sensors between 2 timestamps
+    @apiName getSensorsHistoryFromTo
+    @apiGroup SensorHistory
+    @apiVersion 0.5.0
+
+    @apiParam {String} ids The ids of the sensors, separated by commas
+    @apiParam {Number} tstampFrom The unixtimestamp from what time you want the history to start
+    @apiParam {Number} [tstampTo] The unixtimestamp to what time you want the history to show up. If not set, the current time
+
+    @apiSuccess {json} result The values of each sensor, by sensor id
+
+    @apiSampleRequest /rest/sensorhistory/ids/2,3/from/1412750000/to/1412760000
+
+    @apiSuccessExample Success-Response:
+        HTTTP/1.1 200 OK
+        {
+            "2": [{"timestamp": 1412750219.0, "value_str": "139.0", "value_num": 139.0}, {"timestamp": 1412750473.0, "value_str": "195.0", "value_num": 195.0}],
+            "3": [{"timestamp": 1412751078.0, "value_str": "0688459268", "value_num": 688459000.0}]
+        }
+
+    @apiErrorExample Invalid sensor ids
+        HTTTP/1.1 400
+        {
+            'error': '...'
+        }
+
+    @apiErrorExample Error
+        HTTTP/1.1 500
+        {
+            'error': '...'
+        }
+    """
+    sids = _parse_sensor_ids(ids)
+    if not sids:
+        return 400, {'error': u"Invalid sensor ids : {0}".format(ids)}
+    try:
+        app.db.open_session()
+        b = app.db.list_sensors_history_between(sids, ftime, ttime)
+        app.db.close_session()
+        return 200, b
+    except:
+        msg = u"Error while getting the sensors history. Error is : {0}".format(traceback.format_exc())
+        app.logger.error(msg)
+        return 500, {'error': msg}
+
+@app.route('/rest/sensorhistory/ids/<ids>/from/<int:ftime>/interval/<interval>/selector/<selector>')
+@app.route('/rest/sensorhistory/ids/<ids>/from/<int:ftime>/to/<int:ttime>/interval/<interval>/selector/<selector>')
+@json_response
+@login_required
+@timeit
+def sensorsHistory_from_to_filter(ids, ftime, interval, selector, ttime=None):
+    """
+    @api {get} /rest/sensorhistory/ids/<ids>/from/<tstampFrom>/to/<tstampTo>/interval/<interval>/selector/<selector> Retrieve the filtered and calculated history of several sensors between 2 timestamps
+    @apiName getSensorsHistoryFilter
+    @apiGroup SensorHistory
+    @apiVersion 0.5.0
+
+    @apiParam {String} ids The ids of the sensors, separated by commas
+    @apiParam {Number} tstampFrom The unixtimestamp from what time you want the history to start
+    @apiParam {Number} [tstampTo] The unixtimestamp to what time you want the history to show up. If not set, the current time
+    @apiParam {String} interval The interval that we want to filter, can be minute, hour, day, week, month, year
+    @apiParam {String} selector The selector to calculate the values, can be min, max, avg or sum
+
+    @apiSuccess {json} result The filtered history of each sensor (same as the single sensor url), by sensor id
+
+    @apiSampleRequest /rest/sensorhistory/ids/2,3/from/1/to/1412750000/interval/month/selector/avg
+
+    @apiSuccessExample Success-Response:
+        HTTTP/1.1 200 OK
+        {
+            "2": {
+                "values": [[2014, 9, 127.87381404174573], [2014, 10, 121.58620689655173]],
+                "global_values": {"max": 652.0, "avg": 121.74901423084457, "min": 54.0, "sum": 3507.848652}
+            },
+            "3": {
+                "values": [[2014, 10, 19.5]],
+                "global_values": {"max": 21.0, "avg": 19.5, "min": 18.0, "sum": 39.0}
+            }
+        }
+
+    @apiErrorExample Invalid sensor ids
+        HTTTP/1.1 400
+        {
+            'error': '...'
+        }
+
+    @apiErrorExample Error
+        HTTTP/1.1 500
+        {
+            'error': '...'
+        }
+    """
+    sids = _parse_sensor_ids(ids)
+    if not sids:
+        return 400, {'error': u"Invalid sensor ids : {0}".format(ids)}
+    try:
+        app.db.open_session()
+        b = app.db.list_sensors_history_filter(
+            sids=sids, frm=ftime, to=ttime,
+            step_used=interval, function_used=selector)
+        app.db.close_session()
+        return 200, b
+    except:
+        msg = u"Error while getting the sensors history. Error is : {0}".format(traceback.format_exc())
+        app.logger.error(msg)
+        return 500, {'error': msg}
+
+@app.route('/rest/sensorhistory/id/<int:sid>/from/<int:ftime>/bucket/<int:width>/selector/<selector>')
+@app.route('/rest/sensorhistory/id/<int:sid>/from/<int:ftime>/to/<int:ttime>/bucket/<int:width>/selector/<selector>')
+@json_response
+@login_required
+@timeit
+def sensorHistory_from_to_bucket(sid, ftime, width, selector, ttime=None):
+    """
+    @api {get} /rest/sensorhistory/id/<id>/from/<tstampFrom>/to/<tstampTo>/bucket/<width>/selector/<selector> Retrieve the calculated history between 2 timestamps by buckets of any duration
+    @apiName getSensorHistoryBucket
+    @apiGroup SensorHistory
+    @apiVersion 0.5.0
+
+    @apiParam {Number} id The id of the sensor we want to retrieve the history from
+    @apiParam {Number} tstampFrom The unixtimestamp from what time you want the history to start
+    @apiParam {Number} [tstampTo] The unixtimestamp to what time you want the history to show up. If not set, the current time
+    @apiParam {Number} width The duration of the buckets, in seconds (300, 900, 1800, ...). The buckets start at the beginning of the day of tstampFrom
+    @apiParam {String} selector The selector to calculate the values, can be min, max, avg or sum
+
+    @apiSuccess {json} result The start timestamp and the value of each bucket which has values
+
+    @apiSampleRequest /rest/sensorhistory/id/2/from/1412719200/to/1412762400/bucket/900/selector/avg
+
+    @apiSuccessExample Success-Response:
+        HTTTP/1.1 200 OK
+        {
+            "values": [
+                [1412750700.0, 139.0],
+                [1412751600.0, 155.0]
+            ],
+            "global_values": {
+                "max": 195.0,
+                "avg": 149.66666666666666,
+                "min": 115.0,
+                "sum": 449.0
+            }
+        }
+
+    @apiErrorExample Error
+        HTTTP/1.1 500
+        {
+            'error': '...'
+        }
+    """
+    try:
+        app.db.open_session()
+        b = app.db.list_sensor_history_buckets(sid, ftime, ttime, width, selector)
+        app.db.close_session()
+        return 200, b
+    except:
+        msg = u"Error while getting the sensor history. Error is : {0}".format(traceback.format_exc())
+        app.logger.error(msg)
+        return 500, {'error': msg}
+
+@app.route('/rest/sensorhistory/ids/<ids>/from/<int:ftime>/bucket/<int:width>/selector/<selector>')
+@app.route('/rest/sensorhistory/ids/<ids>/from/<int:ftime>/to/<int:ttime>/bucket/<int:width>/selector/<selector>')
+@json_response
+@login_required
+@timeit
+def sensorsHistory_from_to_bucket(ids, ftime, width, selector, ttime=None):
+    """
+    @api {get} /rest/sensorhistory/ids/<ids>/from/<tstampFrom>/to/<tstampTo>/bucket/<width>/selector/<selector> Retrieve the calculated history of several sensors between 2 timestamps by buckets of any duration
+    @apiName getSensorsHistoryBucket
+    @apiGroup SensorHistory
+    @apiVersion 0.5.0
+
+    @apiParam {String} ids The ids of the sensors, separated by commas
+    @apiParam {Number} tstampFrom The unixtimestamp from what time you want the history to start
+    @apiParam {Number} [tstampTo] The unixtimestamp to what time you want the history to show up. If not set, the current time
+    @apiParam {Number} width The duration of the buckets, in seconds (300, 900, 1800, ...). The buckets start at the beginning of the day of tstampFrom
+    @apiParam {String} selector The selector to calculate the values, can be min, max, avg or sum
+
+    @apiSuccess {json} result The calculated history of each sensor (same as the single sensor url), by sensor id
+
+    @apiSampleRequest /rest/sensorhistory/ids/2,3/from/1412719200/to/1412762400/bucket/900/selector/avg
+
+    @apiErrorExample Invalid sensor ids
+        HTTTP/1.1 400
+        {
+            'error': '...'
+        }
+
+    @apiErrorExample Error
+        HTTTP/1.1 500
+        {
+            'error': '...'
+        }
+    """
+    sids = _parse_sensor_ids(ids)
+    if not sids:
+        return 400, {'error': u"Invalid sensor ids : {0}".format(ids)}
+    try:
+        app.db.open_session()
+        b = app.db.list_sensors_history_buckets(sids, ftime, ttime, width, selector)
+        app.db.close_session()
+        return 200, b
+    except:
+        msg = u"Error while getting the sensors history. Error is : {0}".format(traceback.format_exc())
+        app.logger.error(msg)
+        return 500, {'error': msg}
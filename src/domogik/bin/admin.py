@@ -495,7 +495,10 @@ class Admin(Plugin):
                         self._mdp_reply_sensor_update_result(msg, db)
                     # sensor history
                     elif msg.get_action() == "sensor_history.get":
-                        self._mdp_reply_sensor_history(msg, db)
+                        if 'sensor_ids' in msg.get_data():
+                            self._mdp_reply_sensors_history(msg, db)
+                        else:
+                            self._mdp_reply_sensor_history(msg, db)
                     # person
                     elif msg.get_action() == "person.get":
                         self._mdp_reply_person_get(msg, db)
@@ -1221,6 +1224,52 @@ class Admin(Plugin):
 
         self.reply(msg.get())
 
+    def _mdp_reply_sensors_history(self, data, db):
+        """ Reply to sensor_history.get MQ req for several sensors (sensor_ids list)
+            @param data : MQ req message
+
+            Only the 'period' and 'filter' modes are available. The history of all
+            the sensors is read at once and the values are returned by sensor id
+        """
+        msg = MQMessage()
+        msg.set_action('sensor_history.result')
+        status = True
+        reason = ""
+        values = None
+
+        msg_data = data.get_data()
+        sensor_ids = msg_data['sensor_ids']
+        mode = msg_data.get('mode')
+        if not isinstance(sensor_ids, list) or len(sensor_ids) == 0:
+            reason = "ERROR when getting sensors history. The key 'sensor_ids' should be a list of sensor ids"
+            status = False
+        elif mode not in ("period", "filter"):
+            reason = "ERROR when getting sensors history. No valid mode (period, filter) declared in the message"
+            status = False
+        elif 'from' not in msg_data:
+            reason = "ERROR when getting sensors history. No key 'from' defined for mode = '{0}'!".format(mode)
+            status = False
+        else:
+            try:
+                if mode == "period":
+                    values = db.list_sensors_history_between(sensor_ids, msg_data['from'], msg_data.get('to'))
+                else:
+                    values = db.list_sensors_history_filter(sensor_ids, msg_data['from'], msg_data.get('to'),
+                                                            msg_data.get('interval'), msg_data.get('selector'))
+            except:
+                reason = "ERROR when getting sensors history for ids = {0} : {1}".format(sensor_ids, traceback.format_exc())
+                status = False
+        if not status:
+            self.log.error(reason)
+
+        msg.add_data('status', status)
+        msg.add_data('reason', reason)
+        msg.add_data('sensor_ids', sensor_ids)
+        msg.add_data('mode', mode)
+        msg.add_data('values', values)
+
+        self.reply(msg.get())
+
     def _mdp_reply_person_get(self, data, db):
         status = True
         reason = False
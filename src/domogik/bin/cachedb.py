@@ -37,78 +37,397 @@ Implements
 from domogik.common.defaultloader import DefaultLoader
 from domogik.common.configloader import Loader
 from domogik.common import logger
+from domogik.common.cachestate import CacheStateWriter, get_state_path, STATE_HEARTBEAT_PERIOD
 from multiprocessing import Lock
 from multiprocessing.managers import SyncManager, active_children, current_process
 from threading import Thread
+from collections import OrderedDict
 
 import signal
 import sys
 import os
 import pwd
 import time
+import traceback
+import uuid
 
 CACHE_NAME = 'cachedb_api'
+# keys of the sensors state updated by patchSensors
+SENSOR_STATE = ('last_value', 'last_received', 'value_min', 'value_max')
+# time (in seconds) after which a devices rebuild claimed by a client may be claimed by another one
+REFRESH_TIMEOUT = 10
 
 class CacheData(object):
-    _devices_cache = []
+    """ Devices and plugins config cache
+
+        The devices are indexed by device id, client id and sensor id, and the config
+        by client and parameter key : the lookups and the marking of the devices to
+        update don't depend on the number of devices.
+
+        Each change of a device gets a new version of the cache. The clients keep a copy
+        of the devices and only get the devices changed since the version of their copy
+        (see getDevicesChanges). The cache id changes when all the devices are set : the
+        clients copies are then fully reloaded.
+
+        A device marked to update is rebuilt alone, the devices of a client marked to
+        update are reloaded (devices may have been created or deleted). The rebuilds are
+        claimed by the client which gets the changes : the other clients wait for its
+        result (see refreshDevices) instead of rebuilding the same devices.
+
+        The new values of the sensors don't mark their device to update : the last value,
+        last received date, min and max of the sensors are patched in the cached devices
+        (see patchSensors). The patched sensors have their own versions : the clients copies
+        only get the changed sensors state (see getSensorsChanges), the devices version
+        does not change.
+
+        After each change, the cache id, the versions and the up to date clients are published
+        in the state file (see common/cachestate.py) : the clients whose copy has this version
+        don't call the cache. The heartbeat of the state is refreshed by a thread of the process
+        which serves the cache (see startHeartbeat) : the clients don't use the state of a stopped cache.
+    """
+    # device id => device
+    _devices_cache = OrderedDict()
+    # client id => OrderedDict of the device ids of the client
+    _client_devices = {}
+    # sensor id => device id
+    _sensor_devices = {}
+    # device ids to update, by client id
     _to_update_devices = {}
+    # client ids whose devices must be reloaded
+    _to_update_clients = set()
+    # True when all the devices were set
+    _loaded = False
+    # device id or client id => (token, time) of the running rebuilds
+    _refreshing = {}
+    _last_token = 0
+    # id of the devices versions, changed when all the devices are set
+    _cache_id = None
+    # last version of the devices
+    _version = 0
+    # device id => version of its last change (update or removal), the oldest change first
+    _device_versions = OrderedDict()
+    # last version of the sensors state
+    _sensors_version = 0
+    # sensor id => version of its last patched state, the oldest patch first
+    _sensor_versions = OrderedDict()
     _lockList = Lock()
 
+    # client => OrderedDict key => PluginConfigData
     _config_cache = {}
     _to_update_config = {}
     _lockConfig = Lock()
 
-    def __init__(self):
+    def __init__(self, state_path=None):
+        """ Init
+            @param state_path : file in which the state of the devices cache is published, None to not publish it
+        """
         # Here you have to specify twice the logger name as two instances of DbHelper are created
         self.log = logger.Logger(CACHE_NAME).get_logger(CACHE_NAME)
+        self._cache_id = uuid.uuid4().hex
+        self._state_path = state_path
+        self._state_writer = None
+        # replace the state of a previous cache
+        with self._lockList:
+            self._publishState()
         self.log.debug(u"Cache Data initialized")
 
+    def _publishState(self):
+        """ Publish the state of the devices cache, the caller holds the devices lock
+        """
+        if self._state_path is None:
+            return
+        try:
+            if self._state_writer is None:
+                self._state_writer = CacheStateWriter(self._state_path)
+            clients = dict([(client_id, True) for client_id in self._client_devices])
+            for client_id in self._to_update_devices:
+                clients[client_id] = False
+            for client_id in self._to_update_clients:
+                clients[client_id] = False
+            self._state_writer.publish({'cache_id' : self._cache_id,
+                                        'version' : self._version,
+                                        'sensors_version' : self._sensors_version,
+                                        'loaded' : self._loaded,
+                                        'up_to_date' : self._loaded and all(clients.values()),
+                                        'clients' : clients})
+        except:
+            self.log.error(u"Error while publishing the devices cache state in {0}, it is not published any more : {1}".format(self._state_path, traceback.format_exc()))
+            self._state_path = None
+
+    def startHeartbeat(self):
+        """ Start the thread which refreshes the heartbeat of the published state
+            It must be called in the process which serves the cache
+        """
+        if self._state_path is None:
+            return
+        thread = Thread(None,
+                        self._heartbeat,
+                        "cache_state_heartbeat",
+                        (),
+                        {})
+        thread.daemon = True
+        thread.start()
+
+    def _heartbeat(self):
+        """ Refresh the heartbeat of the published state each STATE_HEARTBEAT_PERIOD seconds
+        """
+        while True:
+            time.sleep(STATE_HEARTBEAT_PERIOD)
+            with self._lockList:
+                if self._state_path is None:
+                    return
+                if self._state_writer is not None:
+                    self._state_writer.heartbeat()
+
 # Devices list cache data
+    def _newVersion(self, device_id):
+        """ Record a change of a device
+        """
+        self._version += 1
+        self._device_versions.pop(device_id, None)
+        self._device_versions[device_id] = self._version
+
+    def _sensorsChanges(self, sensors_version):
+        """ Return the sensors state patched since a version
+            @return a list of (device id, sensor id, state)
+        """
+        changes = []
+        for sensor_id in reversed(self._sensor_versions):
+            if self._sensor_versions[sensor_id] <= sensors_version:
+                break
+            device_id = self._sensor_devices.get(sensor_id)
+            if device_id is None:
+                continue
+            for sensor in self._devices_cache[device_id]['sensors'].values():
+                if sensor['id'] == sensor_id:
+                    changes.append((device_id, sensor_id, dict([(key, sensor[key]) for key in SENSOR_STATE])))
+                    break
+        return changes
+
+    def _addDevice(self, dev):
+        """ Add or replace a device in the cache and its indexes, the device is up to date
+            The sensors state of the database may be older than the patched one (see patchSensors) :
+            the most recent one is kept
+        """
+        old = self._devices_cache.get(dev['id'])
+        if old is not None:
+            self._keepSensorsState(old, dev)
+        self._unindexDevice(dev['id'])
+        self._devices_cache[dev['id']] = dev
+        self._client_devices.setdefault(dev['client_id'], OrderedDict())[dev['id']] = True
+        for sensor in dev['sensors'].values():
+            self._sensor_devices[sensor['id']] = dev['id']
+        self._newVersion(dev['id'])
+
+    def _keepSensorsState(self, old, dev):
+        """ Copy in a new version of a device the sensors state of the cached device which are more recent
+        """
+        states = dict([(sensor['id'], sensor) for sensor in old['sensors'].values()])
+        for sensor in dev['sensors'].values():
+            state = states.get(sensor['id'])
+            if state is not None and state['last_received'] is not None and \
+               (sensor['last_received'] is None or state['last_received'] > sensor['last_received']):
+                for key in SENSOR_STATE:
+                    sensor[key] = state[key]
+
+    def _removeDevice(self, device_id):
+        """ Remove a device from the cache and its indexes
+        """
+        if self._unindexDevice(device_id):
+            self._newVersion(device_id)
+
+    def _unindexDevice(self, device_id):
+        """ Remove a device from the cache and its indexes, without new version
+            The client stays known, even without devices
+            @return True if the device was in the cache
+        """
+        dev = self._devices_cache.pop(device_id, None)
+        if dev is None:
+            return False
+        del self._client_devices[dev['client_id']][device_id]
+        for sensor in dev['sensors'].values():
+            if self._sensor_devices.get(sensor['id']) == device_id:
+                del self._sensor_devices[sensor['id']]
+        self._setUpToDate(dev['client_id'], device_id)
+        return True
+
+    def _setUpToDate(self, client_id, device_id):
+        to_update = self._to_update_devices.get(client_id)
+        if to_update is not None:
+            to_update.discard(device_id)
+            if len(to_update) == 0:
+                del self._to_update_devices[client_id]
+
+    def _setToUpdate(self, device_id):
+        dev = self._devices_cache.get(device_id)
+        if dev is not None:
+            self._to_update_devices.setdefault(dev['client_id'], set()).add(device_id)
+            # a running rebuild may have read the device before the change
+            self._refreshing.pop(device_id, None)
+
+    def _setClientToUpdate(self, client_id):
+        self._to_update_clients.add(client_id)
+        self._refreshing.pop(client_id, None)
+
+    def _reloadClient(self, client_id, device_list):
+        """ Replace the devices of a client, the devices marked to update stay marked
+        """
+        to_update = set(self._to_update_devices.get(client_id, ()))
+        # 1st remove all devices for client (assume deleted device)
+        for dev_id in list(self._client_devices.get(client_id, ())):
+            self._removeDevice(dev_id)
+        self._client_devices.setdefault(client_id, OrderedDict())
+        for dev in device_list :
+            self._addDevice(dev)
+        for dev_id in to_update :
+            self._setToUpdate(dev_id)
+        self._to_update_clients.discard(client_id)
+        self._refreshing.pop(client_id, None)
+
+    def _claim(self, key, token, now):
+        """ Claim the rebuild of a device (device id) or of the devices of a client (client id)
+            @return False if it is already claimed by another client
+        """
+        claim = self._refreshing.get(key)
+        if claim is not None and claim[0] != token and now - claim[1] < REFRESH_TIMEOUT:
+            return False
+        self._refreshing[key] = (token, now)
+        return True
+
+    def _isClaimed(self, key, token):
+        claim = self._refreshing.get(key)
+        return claim is not None and claim[0] == token
+
     def getDevices(self, client_id = None):
         with self._lockList :
             if client_id is not None :
-                devices = []
-                for dev in self._devices_cache:
-                    if dev['client_id'] == client_id :
-                      devices.append(dict(dev))
+                devices = [dict(self._devices_cache[device_id]) for device_id in self._client_devices.get(client_id, ())]
                 self.log.debug(u"Get cache with {0} device(s) for client {1}".format(len(devices), client_id))
                 return devices
             else :
                 self.log.debug(u"Get cache with {0} device(s) for all clients".format(len(self._devices_cache)))
-                return list(self._devices_cache)
+                return list(self._devices_cache.values())
+
+    def getDevicesChanges(self, cache_id = None, version = 0, client_id = None, sensors_version = 0):
+        """ Return the devices changed since a version of the cache, and the devices to rebuild
+            @param cache_id, version : cache id and version of the client copy, from the previous call
+            @param client_id : only check the devices of this client
+            @param sensors_version : sensors version of the client copy
+            @return None if all the devices are requested and they were never set,
+                    else (cache id, version, full, devices, removed device ids, refresh, sensors). If full
+                    is True, the client copy is too old and devices are all the devices.
+                    refresh is (token, client ids, device ids, pending) : the client must rebuild
+                    the devices of these clients and these devices, and give them to refreshDevices
+                    with the token. pending is the number of rebuilds claimed by other clients.
+                    The devices (of the client) are up to date when there is nothing to rebuild.
+                    sensors is the result of getSensorsChanges
+        """
+        with self._lockList :
+            if client_id is None and not self._loaded :
+                return None
+            if client_id is not None and client_id not in self._client_devices and not self._loaded and \
+               client_id not in self._to_update_clients :
+                self._to_update_clients.add(client_id)
+                self._publishState()
+            if client_id is None :
+                clients = list(self._to_update_clients)
+                devices = [dev_id for ids in self._to_update_devices.values() for dev_id in ids]
+            else :
+                clients = [client_id] if client_id in self._to_update_clients else []
+                devices = list(self._to_update_devices.get(client_id, ()))
+            refresh = (None, [], [], 0)
+            if len(clients) > 0 or len(devices) > 0 :
+                self._last_token += 1
+                token = self._last_token
+                now = time.time()
+                claimed_clients = [cid for cid in clients if self._claim(cid, token, now)]
+                claimed_devices = [did for did in devices if self._claim(did, token, now)]
+                pending = len(clients) + len(devices) - len(claimed_clients) - len(claimed_devices)
+                refresh = (token, claimed_clients, claimed_devices, pending)
+            if cache_id != self._cache_id or version > self._version :
+                self.log.debug(u"Get cache changes with {0} device(s), full".format(len(self._devices_cache)))
+                return (self._cache_id, self._version, True, list(self._devices_cache.values()), [], refresh,
+                        (self._sensors_version, []))
+            devices = []
+            removed = []
+            for device_id in reversed(self._device_versions) :
+                if self._device_versions[device_id] <= version :
+                    break
+                if device_id in self._devices_cache :
+                    devices.append(self._devices_cache[device_id])
+                else :
+                    removed.append(device_id)
+            return (self._cache_id, self._version, False, devices, removed, refresh,
+                    (self._sensors_version, self._sensorsChanges(sensors_version)))
+
+    def getSensorsChanges(self, cache_id, sensors_version):
+        """ Return the sensors state patched since a version of the cache
+            @param cache_id, sensors_version : cache id and sensors version of the client copy
+            @return None if the cache id changed, else (sensors version, list of (device id, sensor id, state))
+        """
+        with self._lockList :
+            if cache_id != self._cache_id :
+                return None
+            return (self._sensors_version, self._sensorsChanges(sensors_version))
+
+    def refreshDevices(self, token, client_ids, device_ids, device_list, source="undefined"):
+        """ Store the devices rebuilt after a call to getDevicesChanges
+            The devices changed again since the call stay to update
+            @param token, client_ids, device_ids : refresh returned by getDevicesChanges
+            @param device_list : the active devices of these clients and these devices. The devices
+                                 which are not in the list were deleted
+        """
+        with self._lockList :
+            by_id = dict([(dev['id'], dev) for dev in device_list])
+            for client_id in client_ids :
+                if self._isClaimed(client_id, token) :
+                    self._reloadClient(client_id, [dev for dev in device_list if dev['client_id'] == client_id])
+            refreshed = 0
+            for device_id in device_ids :
+                if self._isClaimed(device_id, token) :
+                    del self._refreshing[device_id]
+                    if device_id in by_id :
+                        self._addDevice(by_id[device_id])
+                    else :
+                        self._removeDevice(device_id)
+                    refreshed += 1
+            self._publishState()
+            self.log.debug(u"Refresh cache for {0} client(s) and {1}/{2} device(s). Source : {3}".format(len(client_ids), refreshed, len(device_ids), source))
 
     def upToDateDevices(self, client_id = None, device_id = None):
         with self._lockList :
             if device_id is not None :
                 device_id = int(device_id)
-                if device_id in self._to_update_devices :
-                    return not self._to_update_devices[device_id]
-                else :
-                    return False
-            elif client_id is not None :
-                exist = False
-                for dev in self._devices_cache:
-                    if dev['client_id'] == client_id :
-                        exist = True
-                        uptodate = not self._to_update_devices[dev['id']]
-                        if not uptodate: return False
-                return exist
-            else :
-                if self._devices_cache is None or self._devices_cache == []:
-                    self.log.debug(u"Cache is empty.")
+                dev = self._devices_cache.get(device_id)
+                if dev is None :
                     return False
-                for dev in self._devices_cache:
-                    uptodate = not self._to_update_devices[dev['id']]
-                    if not uptodate: return False
-                return True
-            return False
+                return device_id not in self._to_update_devices.get(dev['client_id'], ()) and \
+                       dev['client_id'] not in self._to_update_clients
+            if client_id is not None :
+                return client_id in self._client_devices and client_id not in self._to_update_clients and \
+                       client_id not in self._to_update_devices
+            if not self._loaded:
+                self.log.debug(u"Cache is empty.")
+                return False
+            return len(self._to_update_devices) == 0 and len(self._to_update_clients) == 0
 
     def setDevices(self, device_list, source="undefined"):
         with self._lockList :
-            self._devices_cache = device_list
+            self._devices_cache = OrderedDict()
+            self._client_devices = {}
+            self._sensor_devices = {}
             self._to_update_devices = {}
-            for dev in self._devices_cache:
-                self._to_update_devices[dev['id']] = False
+            self._to_update_clients = set()
+            self._refreshing = {}
+            self._cache_id = uuid.uuid4().hex
+            self._version = 0
+            self._device_versions = OrderedDict()
+            self._sensors_version = 0
+            self._sensor_versions = OrderedDict()
+            for dev in device_list:
+                self._addDevice(dev)
+            self._loaded = True
+            self._publishState()
             self.log.debug(u"Set cache with {0} device(s). Source : {1}".format(len(self._devices_cache), source))
             return True
 
@@ -116,55 +435,66 @@ class CacheData(object):
         with self._lockList :
             if device_id is not None : # Update one device of device_list
                 device_id = int(device_id)
-                for i in range(0, len(self._devices_cache)) :
-                    if self._devices_cache[i]['id'] == device_id :
-                        self._devices_cache[i] = device_list
-                        self._to_update_devices[device_id] = False
-                        self.log.debug(u"Update cache, mode device : {0}".format(device_id))
-                        break
+                if device_id in self._devices_cache :
+                    self._addDevice(device_list)
+                    self._refreshing.pop(device_id, None)
+                    self.log.debug(u"Update cache, mode device : {0}".format(device_id))
             elif client_id is not None : # Update by client
-                for dev in list(self._devices_cache):
-                    # 1st remove all devices for client (assume deleted device)
-                    if dev['client_id'] == client_id :
-                        self._devices_cache.remove(dev)
-                        del(self._to_update_devices[dev['id']])
-                self._devices_cache.extend(device_list)
-                for dev in device_list :
-                    self._to_update_devices[dev['id']] = False
+                self._reloadClient(client_id, device_list)
                 self.log.debug(u"Update cache for {0} device(s), mode client : {1}".format(len(device_list), client_id))
             else : #  Update all devices of device_list
-                for dev_n in device_list :
-                    for dev in self._devices_cache :
-                        if dev['id'] == dev_n['id'] :
-                            dev = dev_n
-                            self._to_update_devices[dev['id']] = False
+                for dev in device_list :
+                    if dev['id'] in self._devices_cache :
+                        self._addDevice(dev)
+                        self._refreshing.pop(dev['id'], None)
                 self.log.debug(u"Update cache for {0}/{1} device(s), mode all of list.".format(len(device_list),len(self._devices_cache)))
+            self._publishState()
+
+    def patchSensors(self, states):
+        """ Update the state of some sensors in the cached devices, which stay up to date
+            The devices rebuilt later from the database keep this state until the database has a newer one.
+            The patched sensors get a new sensors version, the devices version does not change
+            @param states : sensor id => dict with the new 'last_value', 'last_received', 'value_min' and 'value_max'
+        """
+        with self._lockList :
+            patched = False
+            for sensor_id, state in states.items() :
+                device_id = self._sensor_devices.get(sensor_id)
+                if device_id is None :
+                    continue
+                dev = self._devices_cache[device_id]
+                for sensor in dev['sensors'].values() :
+                    if sensor['id'] == sensor_id :
+                        # a state older than the cached one comes from an older write
+                        if sensor['last_received'] is None or state['last_received'] >= sensor['last_received'] :
+                            sensor.update(state)
+                            self._sensors_version += 1
+                            self._sensor_versions.pop(sensor_id, None)
+                            self._sensor_versions[sensor_id] = self._sensors_version
+                            patched = True
+                        break
+            # one publication for all the sensors of a stored batch
+            if patched :
+                self._publishState()
 
     def markAsUpdatingDevices(self, client_id = None, device_id = None, sensor_id = None):
         with self._lockList :
             if sensor_id is not None :
-                for dev in self._devices_cache :
-                    for key in dev['sensors'] :
-                        if dev['sensors'][key]['id'] == sensor_id :
-                            self._to_update_devices[dev['id']] = True
-#                            self.log.debug(u"Mark cache to update sensor {0} of device {1} of {2}".format(sensor_id, dev['id'], dev['client_id']))
-                            break
+                device_id = self._sensor_devices.get(int(sensor_id))
+                if device_id is not None :
+                    self._setToUpdate(device_id)
+#                    self.log.debug(u"Mark cache to update sensor {0} of device {1}".format(sensor_id, device_id))
             elif device_id is not None : # Mark one device
-                device_id = int(device_id)
-                for dev in self._devices_cache :
-                    if dev['id'] == device_id :
-                        self._to_update_devices[dev['id']] = True
-#                        self.log.debug(u"Mark cache to update device {0} of {1}".format(dev['id'], dev['client_id']))
-                        break
+                self._setToUpdate(int(device_id))
+#                self.log.debug(u"Mark cache to update device {0}".format(device_id))
             elif client_id is not None : # Mark devices by client
-                for dev in self._devices_cache:
-                    if dev['client_id'] == client_id :
-                        self._to_update_devices[dev['id']] = True
+                self._setClientToUpdate(client_id)
 #                self.log.debug(u"Mark cache to update all devices of {0}".format(client_id))
             else : #  Mark all devices
-                for dev_n in self._devices_cache :
-                    self._to_update_devices[dev['id']] = True
+                for client_id in self._client_devices :
+                    self._setClientToUpdate(client_id)
 #                self.log.debug(u"Mark cache to update mode all clients")
+            self._publishState()
 
 # Plugin Config Cache Data
 
@@ -185,10 +515,8 @@ class CacheData(object):
             pId = self._getConfigId(pl_id, pl_hostname)
             if pId in self._config_cache :
                 if key is not None :
-                    for p in self._config_cache[pId] :
-                        if p.key == key :
-                            return p
-                config = list(self._config_cache[pId])
+                    return self._config_cache[pId].get(key)
+                config = list(self._config_cache[pId].values())
                 self.log.debug(u"Get cache config with {0} parameters(s) for client {1}".format(len(config), pId))
                 return config
             else :
@@ -198,7 +526,7 @@ class CacheData(object):
     def setConfigData(self, config_list, pl_id, pl_hostname, source="undefined"):
         with self._lockConfig :
             pId = self._getConfigId(pl_id, pl_hostname)
-            self._config_cache[pId] = config_list
+            self._config_cache[pId] = OrderedDict([(p.key, p) for p in config_list])
             self._to_update_config[pId] = False
             self.log.debug(u"Set cache config with {0} parameters for client {1}. Source : {2}".format(len(self._config_cache[pId]), pId, source))
             return True
@@ -241,12 +569,14 @@ class WorkerCache(object):
         db_config = dict(config[1])
 
         port_c = 40409 if not 'portcache' in db_config else int(db_config['portcache'])
+        state_path = get_state_path(config)
 
-        self._cache = CacheData()
+        self._cache = CacheData(state_path)
         MyManager.register('get_cache', callable=lambda:self._cache)
         MyManager.register('force_leave', callable=lambda:self.force_leave())
         self.cacheManager = MyManager(address=('localhost', port_c), authkey=b'{0}'.format(db_config['password']))
-        self.cacheManager.start()
+        # the heartbeat thread runs in the manager process, with the cache
+        self.cacheManager.start(self._cache.startHeartbeat)
         self.log.info(u"Listening on port '{0}' [BIND]...".format(port_c))
         self._pPIDs = []
         for p in active_children():
@@ -266,26 +596,31 @@ class WorkerCache(object):
         os.kill(int(selfPID), signal.SIGKILL)
 
     def start(self):
-        Thread(None,
+        self._thread = Thread(None,
                   self.__start,
                   "run_cache_forever",
                   (),
-                  {}).start()
+                  {})
+        self._thread.start()
+
+    def join(self):
+        """ Wait until the cache is stopped
+        """
+        self._thread.join()
 
     def __start(self):
         self.log.info(u"Start loop forever")
         self._running = True
-        while self._running :
-            time.sleep(0.05)
+        # the cache is served by the manager process
+        self.cacheManager.join()
+        self._running = False
         self.log.info(u"Loop forever stopped")
 
 
 if __name__ == '__main__':
     print(u"Main Cache")
-    running = True
     cacheData = WorkerCache()
     cacheData.start()
-    while running :
-        time.sleep(0.05)
+    cacheData.join()
     print(u"**************** Finished cache *******************")
 
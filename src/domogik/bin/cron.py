@@ -37,6 +37,7 @@ Implements
 
 from domogik.common import logger
 from domogik.common.database import DbHelper
+from domogik.common.retention import SensorHistoryRetention
 from domogik.common.utils import is_already_launched
 import traceback
 
@@ -56,6 +57,7 @@ class CronSystem():
         self.log.info(u"START Cron system run")
         self._migrate_sensor()
         self._delete_devices()
+        self._clean_sensor_history()
         self.log.info(u"END   Cron system run")
 
     def _delete_devices(self):
@@ -69,6 +71,12 @@ class CronSystem():
                     self.log.error(u"     Unable to delete the device. Please check the error message for the reason. Error is : {0}".format(traceback.format_exc()))
         self.log.info(u"=> END device deleting")
 
+    def _clean_sensor_history(self):
+        self.log.info(u"=> START sensor history retention")
+        with self.db.session_scope():
+            SensorHistoryRetention(self.log, self.db).run()
+        self.log.info(u"=> END sensor history retention")
+
     def _migrate_sensor(self):
         self.log.info(u"=> START sensor migration")
         with self.db.session_scope():
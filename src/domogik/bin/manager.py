@@ -104,6 +104,7 @@ PYTHON = sys.executable
 WAIT_AFTER_STOP_REQUEST = 15           # seconds
 CHECK_FOR_NEW_PACKAGES_INTERVAL = 30   # seconds
 SEND_METRICS_INTERVAL = 600            # seconds
+HISTORY_CHECKPOINT_INTERVAL = 300      # seconds, max time between 2 writes of an unchanged client status in the history
 
 class CacheDB(SyncManager):
     pass
@@ -1792,6 +1793,8 @@ class Clients():
         self._conversions = {}
         self._db = DbHelper(owner="Manager core clients")
         self._lock_db = Lock()
+        # client_id => (status, comment, time) last written in the clients history
+        self._history_written = {}
 
         ### init logger
         log = logger.Logger('manager')
@@ -1930,9 +1933,7 @@ class Clients():
             self._clients[client_id]['last_seen'] = status_time
         if old_status == new_status:
 #            self.log.debug(u"The status was already {0} : store current time and nothing to do".format(old_status))
-            with self._lock_db :
-                with self._db.session_scope():
-                    self._db.add_plugin_history(self._clients[client_id]['type'], self._clients[client_id]['name'], self._clients[client_id]['host'], new_status, comment, status_time)
+            self._write_history(client_id, new_status, comment, status_time)
             return
         self._clients[client_id]['status'] = new_status
         self._clients_with_details[client_id]['status'] = new_status
@@ -1951,10 +1952,22 @@ class Clients():
                                       "comment": "Manager advert client is dead"})
 
         self.publish_update()
-        if self._clients[client_id]['name'] is not None :
-            with self._lock_db :
-                with self._db.session_scope():
-                    self._db.add_plugin_history(self._clients[client_id]['type'], self._clients[client_id]['name'], self._clients[client_id]['host'], new_status, comment, status_time)
+        self._write_history(client_id, new_status, comment, status_time)
+
+    def _write_history(self, client_id, status, comment, status_time):
+        """ Write a client status in the clients history
+            The heartbeats don't change the status : an unchanged status (and comment) is only written
+            again each HISTORY_CHECKPOINT_INTERVAL seconds, to record that the client is still alive
+        """
+        if self._clients[client_id]['name'] is None:
+            return
+        last = self._history_written.get(client_id)
+        if last is not None and last[0] == status and last[1] == comment and status_time - last[2] < HISTORY_CHECKPOINT_INTERVAL:
+            return
+        with self._lock_db :
+            with self._db.session_scope():
+                self._db.add_plugin_history(self._clients[client_id]['type'], self._clients[client_id]['name'], self._clients[client_id]['host'], status, comment, status_time)
+        self._history_written[client_id] = (status, comment, status_time)
 
     def set_pid(self, client_id, pid):
         """ Set a pid to a client
@@ -0,0 +1,79 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+""" This file is part of B{Domogik} project (U{http://www.domogik.org}).
+
+License
+=======
+
+B{Domogik} is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+B{Domogik} is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Domogik. If not, see U{http://www.gnu.org/licenses}.
+
+Plugin purpose
+==============
+
+Compute the sensors history rollups (minute, hour, day, month aggregates)
+of the history stored before the rollups were maintained by the store path
+
+Implements
+==========
+
+- RollupBackfill
+
+@author: Domogik project
+@copyright: (C) 2007-2019 Domogik project
+@license: GPL(v3)
+@organization: Domogik
+"""
+
+from argparse import ArgumentParser
+from domogik.common import logger
+from domogik.common.database import DbHelper
+import traceback
+
+class RollupBackfill():
+    """ Sensors history rollups backfill
+    """
+    def __init__(self):
+        """ Init
+        """
+        parser = ArgumentParser(description="Compute the sensors history rollups of the existing history")
+        parser.add_argument("-s", "--sensor", action="append", type=int, dest="sensors", default=None,
+                            help="Sensor id (may be used several times). Default : all the sensors not yet done.")
+        self.options = parser.parse_args()
+        l = logger.Logger("core_rollup", log_on_stdout=True)
+        self.log = l.get_logger()
+        self.db = DbHelper(owner="Rollup backfill")
+        self.run()
+
+    def run(self):
+        self.log.info(u"START sensor history rollups backfill")
+        if self.options.sensors:
+            sensors = self.options.sensors
+        else:
+            with self.db.session_scope():
+                sensors = self.db.list_sensors_rollup_to_backfill()
+        self.log.info(u"{0} sensor(s) to backfill".format(len(sensors)))
+        for sid in sensors:
+            try:
+                with self.db.session_scope():
+                    self.db.backfill_sensor_history_rollups(sid)
+            except:
+                self.log.error(u"Unable to compute the rollups of the sensor {0}. Error is : {1}".format(sid, traceback.format_exc()))
+        self.log.info(u"END   sensor history rollups backfill")
+
+def main():
+    backfill = RollupBackfill()
+
+if __name__ == "__main__":
+    main()
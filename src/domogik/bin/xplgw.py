@@ -35,7 +35,13 @@ class XplManager(XplPlugin):
 from domogik.xpl.common.xplconnector import Listener
 from domogik.xpl.common.plugin import XplPlugin
 from domogik.common.database import DbHelper
+from domogik.common.configloader import Loader
+from domogik.common.conversionregistry import ConversionRegistry
+from domogik.common.devicemodel import DeviceModel
+from domogik.common.boundedqueue import BoundedQueue, POLICIES, POLICY_BLOCK, POLICY_DROP_OLDEST
 from domogik.xpl.common.xplmessage import XplMessage, XplMessageError
+from domogik.xpl.common.xplstatmatcher import XplStatMatcher
+from domogik.xpl.common.xplcommandack import XplCommandAckMatcher
 from domogikmq.pubsub.publisher import MQPub
 from domogikmq.reqrep.client import MQSyncReq
 from domogikmq.message import MQMessage
@@ -51,8 +57,22 @@ except:
 import threading
 from uuid import uuid4
 
-# how long we keep a message in the cmd queue
+# how long we wait for the answer to an xPL command
 CMDTIMEOUT = 5
+# max number of values stored in the history in a single transaction
+STORE_BATCH_SIZE = 100
+# max time (in seconds) to wait for more values before storing a batch
+STORE_BATCH_DELAY = 0.5
+# default number of threads storing the values in the database ([xplgw] > store_workers)
+STORE_WORKERS = 2
+# interval (in seconds) between 2 logs of the store workers statistics
+STORE_STATS_INTERVAL = 60
+# max time (in seconds) before the last value, min and max of the sensors are written in the sensors table
+STORE_STATE_DELAY = 5
+# default size of the queues ([xplgw] > queue_size)
+QUEUE_SIZE = 10000
+# default overload policy of the store queues ([xplgw] > overload_policy)
+OVERLOAD_POLICY = POLICY_BLOCK
 
 ################################################################################
 class XplManager(XplPlugin):
@@ -69,34 +89,29 @@ class XplManager(XplPlugin):
         self.add_mq_sub('device.update')
 
         self.log.info(u"XPL manager initialisation...")
+        self._load_xplgw_config()
         self._db = DbHelper(owner="xplgw core")
         self.pub = MQPub(zmq.Context(), 'xplgw')
         # some initial data sets
         self.client_xpl_map = {}
-        self.client_conversion_map = {}
+        self.client_by_xpl_source = {}
+        self._conversions = ConversionRegistry(self.log)
         self._db_sensors = {}
         self._db_xplstats = {}
 
-        # load devices informations
-        self._dev_lock = threading.Lock()
-        self._reload_devices()
-        self._cmd_lock = threading.Lock()
-        self._reload_commands()
-        self._stats_lock = threading.Lock()
-        self._reload_xpl_stats()
+        # load devices informations, shared by all the threads
+        self._model = DeviceModel(self.log, owner="xplgw device model")
 
         # queue to store the message that needs to be ahndled for sensor checking
-        self._sensor_queue = queue.Queue()
-        # queue to handle the sensor storage
-        self._sensor_store_queue = queue.Queue()
-        # all command handling params
-        # _lock => to be sure to be thread safe
-        # _dict => uuid to xplstat translationg
-        # _pkt => received messages to check
-        self._cmd_lock_d = threading.Lock()
-        self._cmd_dict = {}
-        self._cmd_lock_p = threading.Lock()
-        self._cmd_pkt = {}
+        # when it is full, the oldest messages are dropped : xPL is not reliable anyway and fresh data are better
+        self._sensor_queue = BoundedQueue(self._queue_size, POLICY_DROP_OLDEST)
+        # queues to handle the sensor storage : one for each store worker
+        # when a queue is full, the overload policy of the sensor is applied
+        self._sensor_store_queues = [BoundedQueue(self._queue_size, self._overload_policy, self._overload_policies) \
+                                     for idx in range(self._store_workers_nb)]
+        self.register_helper('queues_stats', 'Show the length, drop and coalesce counters of the xplgw queues', '_get_queues_stats')
+        # xPL commands waiting for their answer
+        self._cmd_acks = XplCommandAckMatcher(CMDTIMEOUT)
         # load some initial data from manager and db
         self._load_client_to_xpl_target()
         self._load_conversions()
@@ -105,24 +120,99 @@ class XplManager(XplPlugin):
         # start handling the xplmessages
         self._x_thread = self._XplSensorThread(\
             self.log, self.get_stop(), self._sensor_queue, \
-            self._sensor_store_queue)
+            self._put_in_store_queue, self._model)
         self.register_thread(self._x_thread)
         self._x_thread.start()
         # start handling the command reponses in a thread
         self._c_thread = self._XplCommandThread(\
-            self.log, self.get_stop(), self._db, self._cmd_lock_d, \
-            self._cmd_lock_p, self._cmd_dict, self._cmd_pkt, self.pub)
+            self.log, self.get_stop(), self._cmd_acks)
         self.register_thread(self._c_thread)
         self._c_thread.start()
-        # start the sensor storage thread
-        self._s_thread = self._SensorStoreThread(\
-                self._sensor_store_queue, self.log, \
-                self._get_conversion_map, self.pub, self.get_stop())
-        self.register_thread(self._s_thread)
-        self._s_thread.start()
+        # start the sensor storage threads
+        self._s_threads = []
+        for idx, store_queue in enumerate(self._sensor_store_queues):
+            s_thread = self._SensorStoreThread(\
+                    idx, store_queue, self.log, self._model, \
+                    self._conversions, self._on_devices_changed, self.get_stop())
+            self.register_thread(s_thread)
+            s_thread.start()
+            self._s_threads.append(s_thread)
+        self.log.info(u"{0} sensor store worker(s) started".format(len(self._s_threads)))
         # start the sensorthread
         self.ready()
 
+    def _load_xplgw_config(self):
+        """ Read the optional [xplgw] section of the configuration file
+        """
+        self._store_workers_nb = STORE_WORKERS
+        self._queue_size = QUEUE_SIZE
+        self._overload_policy = OVERLOAD_POLICY
+        # sensor id (str) => overload policy
+        self._overload_policies = {}
+        try:
+            cfg = Loader('xplgw')
+            config = cfg.load()
+            conf = dict(config[1])
+        except:
+            self.log.info(u"No [xplgw] section in the configuration file, using the default values")
+            return
+        if 'store_workers' in conf:
+            try:
+                self._store_workers_nb = max(1, int(conf['store_workers']))
+            except ValueError:
+                self.log.warning(u"Invalid value for [xplgw] > store_workers : '{0}'. Using the default value : {1}".format(conf['store_workers'], STORE_WORKERS))
+        if 'queue_size' in conf:
+            try:
+                self._queue_size = max(1, int(conf['queue_size']))
+            except ValueError:
+                self.log.warning(u"Invalid value for [xplgw] > queue_size : '{0}'. Using the default value : {1}".format(conf['queue_size'], QUEUE_SIZE))
+        if conf.get('overload_policy', '').strip() != '':
+            if conf['overload_policy'].strip() in POLICIES:
+                self._overload_policy = conf['overload_policy'].strip()
+            else:
+                self.log.warning(u"Invalid value for [xplgw] > overload_policy : '{0}'. Using the default value : {1}".format(conf['overload_policy'], OVERLOAD_POLICY))
+        # overload_policies = <sensor id>:<policy>, <sensor id>:<policy>, ...
+        for item in conf.get('overload_policies', '').split(','):
+            if item.strip() == '':
+                continue
+            try:
+                sensor_id, policy = [part.strip() for part in item.split(':')]
+                if policy not in POLICIES:
+                    raise ValueError(policy)
+                self._overload_policies[str(int(sensor_id))] = policy
+            except ValueError:
+                self.log.warning(u"Invalid item in [xplgw] > overload_policies : '{0}'. It is ignored".format(item))
+
+    def _get_store_queue(self, sensor_id):
+        """ Return the store queue of a sensor
+            The values of a sensor always go to the same store worker, so they are stored in order
+            @param sensor_id : sensor id (int)
+        """
+        return self._sensor_store_queues[sensor_id % len(self._sensor_store_queues)]
+
+    def _put_in_store_queue(self, data):
+        """ Add a value to the store queue of its sensor
+            The sensor id is converted to an int : the MQ messages give it as a string, the xPL
+            messages as an int, and the store workers use it as a key (history windows, states)
+            The sensor id is the key of the overload policy
+            @raise ValueError if the sensor id is not a number
+        """
+        data['sensor_id'] = int(data['sensor_id'])
+        store_queue = self._get_store_queue(data['sensor_id'])
+        store_queue.put(data, str(data['sensor_id']))
+        return store_queue
+
+    def _get_queues_stats(self):
+        """ Helper : return the statistics of the queues
+        """
+        stats = {'sensor_queue' : self._sensor_queue.get_stats(),
+                 'store_queues' : []}
+        for s_thread in self._s_threads:
+            worker_stats = s_thread.get_stats()
+            worker_stats.update(self._sensor_store_queues[worker_stats['worker']].get_stats())
+            stats['store_queues'].append(worker_stats)
+        return stats
+
     def on_mdp_request(self, msg):
         """ Method called when an mq request comes in
         XplPlugin also needs this info, so we need to do a passthrough
@@ -141,7 +231,7 @@ class XplManager(XplPlugin):
         """
         try:
             # No need to reload device_list of xplgw
-            # => xplgw does not use self.devices from the Plugin class but its own self.all_devices.
+            # => xplgw does not use self.devices from the Plugin class but its own devices model (self._model).
             #    As self.devices is not used/needed, we don't call the XplPlugon.on_message for device.update
             if msgid != 'device.update':
                 XplPlugin.on_message(self, msgid, content)
@@ -159,126 +249,25 @@ class XplManager(XplPlugin):
 
     def _handle_mq_device_update(self, content):
         """ On a device change, a Mq message is received
-            So we update all the devices parameters used by xplgw
+            So we update the devices parameters used by xplgw : only the changed devices are read again
+            - the device given in the message
+            - the devices created, deleted or with a new info_changed date (in case some messages were missed)
         """
         self.log.debug(u"New message (from MQ) about some device changes > reload the devices parameters...")
-        self._x_thread.on_device_changed()
-        self._s_thread.on_device_changed()
-        self._reload_devices()
-        self._reload_commands()
-
-
-    def _reload_devices(self):
-        """ Reload the commands
+        changed_sensors = set()
+        if content and content.get('device_id') is not None:
+            changed_sensors.update(self._model.reload_device(content['device_id']))
+        changed_sensors.update(self._model.sync())
+        self._on_devices_changed(changed_sensors)
+
+    def _on_devices_changed(self, changed_sensors):
+        """ Tell the xpl sensor thread and all the store threads that some devices changed
+            The devices model is already up to date
+            @param changed_sensors : ids (str) of the sensors of the changed devices
         """
-        with self._dev_lock:
-            self.log.info("Event : one device changed. Reloading data for devices (light data)")
-            self.all_devices = {}
-            with self._db.session_scope():
-                for dev in self._db.list_devices():
-                    #print(dev)
-                    #{'xpl_stats': {u'get_total_space': {'json_id': u'get_total_space', 'schema': u'sensor.basic', 'id': 3, 'parameters': {'dynamic': [{'ignore_values': u'', 'sensor_name': u'get_total_space', 'key': u'current'}], 'static': [{'type': u'string', 'value': u'/', 'key': u'device'}, {'type': None, 'value': u'total_space', 'key': u'type'}]}, 'name': u'Total space'}, u'get_free_space': {'json_id': u'get_free_space', 'schema': u'sensor.basic', 'id': 4, 'parameters': {'dynamic': [{'ignore_values': u'', 'sensor_name': u'get_free_space', 'key': u'current'}], 'static': [{'type': u'string', 'value': u'/', 'key': u'device'}, {'type': None, 'value': u'free_space', 'key': u'type'}]}, 'name': u'Free space'}, u'get_used_space': {'json_id': u'get_used_space', 'schema': u'sensor.basic', 'id': 5, 'parameters': {'dynamic': [{'ignore_values': u'', 'sensor_name': u'get_used_space', 'key': u'current'}], 'static': [{'type': u'string', 'value': u'/', 'key': u'device'}, {'type': None, 'value': u'used_space', 'key': u'type'}]}, 'name': u'Used space'}, u'get_percent_used': {'json_id': u'get_percent_used', 'schema': u'sensor.basic', 'id': 6, 'parameters': {'dynamic': [{'ignore_values': u'', 'sensor_name': u'get_percent_used', 'key': u'current'}], 'static': [{'type': u'string', 'value': u'/', 'key': u'device'}, {'type': None, 'value': u'percent_used', 'key': u'type'}]}, 'name': u'Percent used'}}, 'commands': {}, 'description': u'', 'reference': u'', 'sensors': {u'get_total_space': {'value_min': None, 'data_type': u'DT_Byte', 'incremental': False, 'id': 57, 'reference': u'get_total_space', 'conversion': u'', 'name': u'Total Space', 'last_received': 1459192737, 'timeout': 0, 'formula': None, 'last_value': u'14763409408', 'value_max': 14763409408.0}, u'get_free_space': {'value_min': None, 'data_type': u'DT_Byte', 'incremental': False, 'id': 59, 'reference': u'get_free_space', 'conversion': u'', 'name':u'Free Space', 'last_received': 1459192737, 'timeout': 0, 'formula': None, 'last_value': u'1319346176', 'value_max': 8220349952.0}, u'get_used_space': {'value_min': None, 'data_type': u'DT_Byte', 'incremental': False, 'id': 60, 'reference': u'get_used_space', 'conversion': u'', 'name': u'Used Space', 'last_received': 1459192737, 'timeout': 0, 'formula': None, 'last_value': u'13444063232', 'value_max': 14763409408.0}, u'get_percent_used': {'value_min': None, 'data_type':u'DT_Scaling', 'incremental': False, 'id': 58, 'reference': u'get_percent_used', 'conversion': u'', 'name': u'Percent used', 'last_received': 1459192737, 'timeout': 0, 'formula': None, 'last_value': u'91', 'value_max': 100.0}}, 'xpl_commands': {}, 'client_id': u'plugin-diskfree.ambre', 'device_type_id': u'diskfree.disk_usage', 'client_version': u'1.0', 'parameters': {u'interval': {'value': u'5', 'type': u'integer', 'id': 5, 'key': u'interval'}}, 'id': 3, 'name': u'Ambre /'}
-                    self.all_devices[str(dev['id'])] = {
-                                                    'client_id': dev['client_id'],
-                                                    'id': dev['id'],
-                                                    'name': dev['name'],
-                                                  }
-                #print(self.all_devices)
-            self.log.info("Event : one device changed. Reloading data for devices (light data) -- finished")
-
-    def _reload_commands(self):
-        """ Reload the commands
-        """
-        with self._cmd_lock:
-            self.log.info("Event : one device changed. Reloading data for commands")
-            self.all_commands = {}
-            with self._db.session_scope():
-                for cmd in self._db.get_all_command():
-                    #print(cmd)
-                    #<Command: return_confirmation='True', name='Swith', reference='switch_lighting2', id='6', device_id='21'>
-                    #print(cmd.params)
-                    #[<CommandParam: data_type='DT_Trigger', conversion='', cmd_id='16', key='state'>]
-
-                    self.all_commands[str(cmd.id)] = {
-                                                  'return_confirmation' : cmd.return_confirmation,
-                                                  'name' : cmd.name,
-                                                  'reference' : cmd.reference,
-                                                  'id' : cmd.id,
-                                                  'device_id' : cmd.device_id,
-                                                  'xpl_command' : None,
-                                                  'params' : []
-                                                }
-
-                    for param in cmd.params:
-                        self.all_commands[str(cmd.id)]['params'].append({
-                                                                       'data_type' : param.data_type,
-                                                                       'conversion' : param.conversion,
-                                                                       'cmd_id' : param.cmd_id,
-                                                                       'key' : param.key
-                                                                   })
-
-                    #print(cmd.xpl_command)
-                    #<XplCommand: name='Switch', stat_id='82', cmd_id='6', json_id='switch_lighting2', device_id='21', id='6', schema='ac.basic'>
-                    if cmd.xpl_command != None:
-                        xpl_command = {
-                                        'name' : cmd.xpl_command.name,
-                                        'stat_id' : cmd.xpl_command.stat_id,
-                                        'cmd_id' : cmd.xpl_command.cmd_id,
-                                        'json_id' : cmd.xpl_command.json_id,
-                                        'device_id' : cmd.xpl_command.device_id,
-                                        'id' : cmd.xpl_command.id,
-                                        'schema' : cmd.xpl_command.schema,
-                                        'params' : []
-                                      }
-
-                        for param in cmd.xpl_command.params:
-                            #print(param)
-                            #<XplCommandParam: value='0x0038abfc', key='address', xplcmd_id='6'>
-                            xpl_command['params'].append({'value' : param.value,
-                                                          'key' : param.key,
-                                                          'xplcmd_id' : param.xplcmd_id})
-
-                        self.all_commands[str(cmd.id)]['xpl_command'] = xpl_command
-
-            #print(self.all_commands)
-            self.log.info("Event : one device changed. Reloading data for commands -- finished")
-
-    def _reload_xpl_stats(self):
-        """ Reload the commands
-        """
-        with self._stats_lock:
-            self.log.info("Event : one device changed. Reloading data for xpl stats")
-            self.all_xpl_stats = {}
-            with self._db.session_scope():
-                for xplstat in self._db.get_all_xpl_stat():
-                    #print(xplstat)
-                    #print(xplstat.params)
-                    # <XplStat: name='Open/Close sensor', json_id='open_close', device_id='95', id='185', schema='ac.basic'>
-                    # <XplStatParam: xplstat_id='188', multiple='None', value='None', ignore_values='', sensor_id='411', static='False', key='current', type='None'>
-                    a_xplstat = {'name' : xplstat.name,
-                                 'json_id' : xplstat.json_id,
-                                 'device_id' : xplstat.device_id,
-                                 'id' : xplstat.id,
-                                 'schema' : xplstat.schema,
-                                 'params' : []
-                                }
-                    for a_xplstat_param in xplstat.params:
-                        a_xplstat['params'].append({
-                                                     'xplstat_id' : a_xplstat_param.xplstat_id,
-                                                     'multiple' : a_xplstat_param.multiple,
-                                                     'value' : a_xplstat_param.value,
-                                                     'ignore_values' : a_xplstat_param.ignore_values,
-                                                     'sensor_id' : a_xplstat_param.sensor_id,
-                                                     'static' : a_xplstat_param.static,
-                                                     'key' : a_xplstat_param.key,
-                                                     'type' : a_xplstat_param.type
-                                                   })
-
-                    self.all_xpl_stats[str(xplstat.id)] = a_xplstat
-                #print(self.all_xpl_stats)
-
-            self.log.info("Event : one device changed. Reloading data for xpl stats -- finished")
-
+        self._x_thread.on_device_changed()
+        for s_thread in self._s_threads:
+            s_thread.on_device_changed(changed_sensors)
 
     def _handle_mq_sensor(self, content):
         """ Handles an mq sensor message and push it into the queue
@@ -299,8 +288,12 @@ class XplManager(XplPlugin):
             data['sensor_id'] = sensorid
             data['time'] = tim
             data['value'] = content[sensorid]
-            self._sensor_store_queue.put(data)
-            self.log.debug(u"New message (from MQ) > message for sensor_id='{0}' added to the store queue, current length = {1}".format(sensorid, self._sensor_store_queue.qsize()))
+            try:
+                store_queue = self._put_in_store_queue(data)
+            except ValueError:
+                self.log.error(u"New message (from MQ) > invalid sensor_id '{0}', the value is not stored".format(sensorid))
+                continue
+            self.log.debug(u"New message (from MQ) > message for sensor_id='{0}' added to the store queue, current length = {1}".format(sensorid, store_queue.qsize()))
         self.log.debug(u"New message (from MQ) > storing in the store queue finished")
 
     def _load_client_to_xpl_target(self):
@@ -335,9 +328,12 @@ class XplManager(XplPlugin):
         for the xpl targets
         """
         tmp = {}
+        by_source = {}
         for cli in data:
             tmp[cli] = data[cli]['xpl_source']
+            by_source.setdefault(data[cli]['xpl_source'], cli)
         self.client_xpl_map = tmp
+        self.client_by_xpl_source = by_source
 
     def _load_conversions(self):
         """ Request the client conversion info
@@ -354,17 +350,9 @@ class XplManager(XplPlugin):
                 u"Updating conversion list failed, no response from manager")
 
     def _parse_conversions(self, data):
-        """ Translate the mq data into a dict
+        """ Compile the new or changed conversions
         """
-        tmp = {}
-        for cli in data:
-            tmp[cli] = data[cli]
-        self.client_conversion_map = tmp
-
-    def _get_conversion_map(self):
-        """Return clients conversion maps
-        """
-        return self.client_conversion_map
+        self._conversions.update(data)
 
     def _send_command(self, data):
         """
@@ -386,13 +374,14 @@ class XplManager(XplPlugin):
             if not failed:
                 # get the command
                 #cmd = self._db.get_command(request['cmdid'])
-                with self._cmd_lock:
-                    cmd = self.all_commands[str(request['cmdid'])]
+                # the same devices snapshot is used to find the command, its xpl stat and its device
+                snapshot = self._model.snapshot
+                cmd = snapshot.commands[str(request['cmdid'])]
                 if cmd is not None:
                     if cmd['xpl_command'] is not None:
-                        status, uuid, failed = self._send_xpl_command(cmd, request)
+                        status, uuid, failed = self._send_xpl_command(snapshot, cmd, request)
                     else:
-                        status, uuid, failed = self._send_mq_command(cmd, request)
+                        status, uuid, failed = self._send_mq_command(snapshot, cmd, request)
                         pass
                 else:
                     failed = "Can not find the command"
@@ -414,7 +403,7 @@ class XplManager(XplPlugin):
         self.log.debug(u"   => mq reply to requestor")
         self.reply(reply_msg.get())
 
-    def _send_mq_command(self, cmd, request):
+    def _send_mq_command(self, snapshot, cmd, request):
         """
         Send out the command to the plugin
         data:
@@ -426,8 +415,7 @@ class XplManager(XplPlugin):
         failed = False
         status = True
         #dev = self._db.get_device(int(cmd['device_id']))
-        with self._dev_lock:
-            dev = self.all_devices[str(cmd['device_id'])]
+        dev = snapshot.devices[str(cmd['device_id'])]
         msg = MQMessage()
         msg.set_action('client.cmd')
         msg.add_data('command_id', cmd['id'])
@@ -437,12 +425,11 @@ class XplManager(XplPlugin):
                 value = request['cmdparams'][par['key']]
                 # check if we need a conversion
                 if par['conversion'] is not None and par['conversion'] != '':
-                    if dev['client_id'] in self.client_conversion_map:
-                        if par['conversion'] in self.client_conversion_map[dev['client_id']]:
-                            self.log.debug( \
-                                u"      => Calling conversion {0}".format(par['conversion']))
-                            exec(self.client_conversion_map[dev['client_id']][par['conversion']])
-                            value = locals()[par['conversion']](value)
+                    conversion = self._conversions.get(dev['client_id'], par['conversion'])
+                    if conversion is not None:
+                        self.log.debug( \
+                            u"      => Calling conversion {0}".format(par['conversion']))
+                        value = conversion(value)
                 self.log.debug( \
                     u"      => Command parameter after conversion {0} = {1}".format(par['key'], value))
                 msg.add_data(par['key'], value)
@@ -463,7 +450,7 @@ class XplManager(XplPlugin):
                 failed = data['reason']
         return status, None, failed
 
-    def _send_xpl_command(self, cmd, request):
+    def _send_xpl_command(self, snapshot, cmd, request):
         """ Reply to config.get MQ req
             @param data : MQ req message
                 Needed info in data:
@@ -475,13 +462,11 @@ class XplManager(XplPlugin):
         xplcmd = cmd['xpl_command']
 
         #xplstat = self._db.get_xpl_stat(xplcmd['stat_id'])
-        with self._stats_lock:
-            xplstat = self.all_xpl_stats[str(xplcmd['stat_id'])]
+        xplstat = snapshot.xpl_stats[str(xplcmd['stat_id'])]
 
         if xplstat is not None:
             # get the device from the db
-            with self._dev_lock:
-                dev = self.all_devices[str(cmd['device_id'])]
+            dev = snapshot.devices[str(cmd['device_id'])]
             msg = XplMessage()
             if not dev['client_id'] in self.client_xpl_map.keys():
                 self._load_client_to_xpl_target()
@@ -513,34 +498,30 @@ class XplManager(XplPlugin):
                     value = request['cmdparams'][par['key']]
                     # check if we need a conversion
                     if par['conversion'] is not None and par['conversion'] != '':
-                        if dev['client_id'] in self.client_conversion_map:
-                            if par['conversion'] in self.client_conversion_map[dev['client_id']]:
-                                self.log.debug( \
-                                    u"      => Calling conversion {0}".format(par['conversion']))
-                                exec(self.client_conversion_map[dev['client_id']][par['conversion']])
-                                value = locals()[par['conversion']](value)
+                        conversion = self._conversions.get(dev['client_id'], par['conversion'])
+                        if conversion is not None:
+                            self.log.debug( \
+                                u"      => Calling conversion {0}".format(par['conversion']))
+                            value = conversion(value)
                     self.log.debug( \
                         u"      => Command parameter after conversion {0} = {1}".format(par['key'], value))
                     msg.add_data({par['key'] : value})
                 else:
                     failed = "Parameter ({0}) for device command msg is not provided in the mq message".format(par['key'])
             if not failed:
+                # generate an uuid for the matching answer published messages
+                # it is registered before sending the message, as the answer may come back at once
+                resp_uuid = uuid4()
+                self._cmd_acks.add(str(resp_uuid), xplstat)
                 # send out the msg
                 self.log.debug(u"   => Sending xplmessage: {0}".format(msg))
                 try:
                     self.myxpl.send(msg)
                 except XplMessageError as msg:
                     failed = msg
-                #xplstat = self._db.detach(xplstat)
-                # generate an uuid for the matching answer published messages
-                if xplstat != None:
-                    resp_uuid = uuid4()
-                    self._cmd_lock_d.acquire()
-                    self._cmd_dict[str(resp_uuid)] = xplstat
-                    self._cmd_lock_d.release()
+                    self._cmd_acks.cancel(str(resp_uuid))
                 else:
-                    resp_uuid = None
-                return True, resp_uuid, None
+                    return True, resp_uuid, None
         if failed:
             self.log.error(failed)
             return False, None, failed
@@ -559,88 +540,34 @@ class XplManager(XplPlugin):
         item = {}
         item["msg"] = pkt
         item["received_datetime"] = calendar.timegm(time.gmtime())
-        item["clientId"] = next((cli for cli, xpl in self.client_xpl_map.items() if xpl == pkt.source), None)
+        item["clientId"] = self.client_by_xpl_source.get(pkt.source)
         self.log.debug(u"New message (from xPL) > start storing in the sensor queue...")
         self._sensor_queue.put(item)
         self.log.debug(u"New message (from xPL) > storing in the sensor queue finished, current length = {0}".format(self._sensor_queue.qsize()))
-        self._cmd_lock_p.acquire()
-        # only do this when we have outstanding commands
-        if len(self._cmd_dict) > 0:
-            self._cmd_pkt[time.time()] = pkt
-            self.log.debug(u"Adding new message to the cmdQueue, current length = {0}".format(len(self._cmd_dict)))
-            #self.log.debug(u"Adding new message to the cmdQueue, current length = {0}, message = {1}".format(len(self._cmd_dict), pkt))
-        self._cmd_lock_p.release()
+        # check at once if the message is the answer to some commands
+        for resp_uuid in self._cmd_acks.match(pkt.schema, pkt.data):
+            self.log.info(u"Found response message to command with uuid: {0}".format(resp_uuid))
+            # publish the result
+            self.pub.send_event('command.result', \
+                      {"uuid" : resp_uuid})
 
     class _XplCommandThread(threading.Thread):
         """ XplCommandThread class
-        Thread that waits for the coresponding reply to a xpl command
-        It will send out a pub message when the reply is found
+        Thread that forgets the xpl commands which didn't get their answer in time
+        The answers are found by _xpl_callback when the messages are received
         """
-        def __init__(self, log, stop, db, lock_d, lock_p, dic, pkt, pub):
+        def __init__(self, log, stop, acks):
             threading.Thread.__init__(self, name="XplCommandThread")
-            # TODO : remove the line below
-            #self._db = DbHelper()
             self._log = log
-            self._lock_d = lock_d
-            self._lock_p = lock_p
-            self._dict = dic
-            self._pkt = pkt
-            self._pub = pub
+            self._acks = acks
             self._stop = stop
 
         def run(self):
             while not self._stop.isSet():
-                # remove old pkts
-                self._lock_p.acquire()
-                for pkt in self._pkt.keys():
-                    if pkt < time.time() - CMDTIMEOUT:
-                        self._log.warning(u"Delete packet too old (timeout reached) : {0}".format(pkt))
-                        del(self._pkt[pkt])
-                self._lock_p.release()
-                # now try to match if we have enough data
-                if len(self._dict) > 0 and len(self._pkt) > 0:
-                    todel_pkt = []
-                    todel_dict = []
-                    for uuid, search in self._dict.items():
-                        for tim, pkt in self._pkt.items():
-                            print(search)
-                            print(pkt)
-                            if search['schema'] == pkt.schema:
-                                found = True
-                                for par in search['params']:
-                                    if par['key'] not in pkt.data:
-                                        if par['value'] != pkt.data[par['key']]:
-                                            found = False
-                                        elif par['multiple'] is not None and len(par['multiple']) == 1:
-                                            if pkt.data[par['key']] not in par['value'].split(par['multiple']):
-                                                found = False
-                                if found:
-                                    self._log.info(u"Found response message to command with uuid: {0}".format(uuid))
-                                    # publish the result
-                                    self._pub.send_event('command.result', \
-                                              {"uuid" : uuid})
-                                    todel_pkt.append(tim)
-                                    todel_dict.append(uuid)
-                    # now go and delete the unneeded data
-                    self._lock_p.acquire()
-                    for tim in todel_pkt:
-                        if tim in self._pkt:
-                            del(self._pkt[tim])
-                    #self._log.debug(u"Deleting message from the cmdQueue, current length = {0}".format(len(self._pkt)))
-                    # TODO : remove or comment the 2 following lines
-                    #self._log.debug(u"Data to delete : {0}".format(todel_dict))
-                    #self._log.debug(u"Content before deletion : {0}".format(self._dict))
-                    self._lock_p.release()
-                    self._lock_d.acquire()
-                    for tim in todel_dict:
-                        if tim in self._dict:
-                            del(self._dict[tim])
-                    self._lock_d.release()
-                    todel_pkt = []
-                    todel_dict = []
-                else:
-                    # nothing todo, sleep a second
-                    time.sleep(1)
+                # sleep until the next command timeout (or 1 second to check the stop event)
+                self._acks.wait(1)
+                for resp_uuid in self._acks.expire():
+                    self._log.warning(u"No response to the command with uuid {0} (timeout of {1}s reached)".format(resp_uuid, CMDTIMEOUT))
 
     class _XplSensorThread(threading.Thread):
         """ XplSensorThread class
@@ -648,99 +575,63 @@ class XplManager(XplPlugin):
         It will try to find the matching sensor and then store it into the sensor Store Queue
         This is done in a thread as it can be time consuming to do the DB lookups
         """
-        def __init__(self, log, stop, queue, storeQueue):
+        def __init__(self, log, stop, queue, put_in_store_queue, model):
             threading.Thread.__init__(self, name="XplSensorThread")
-            self._db = DbHelper(owner="xpl sensor queue {0}".format(queue))
             self._log = log
             self._queue = queue
-            self._queue_store = storeQueue
+            self._put_in_store_queue = put_in_store_queue
+            self._model = model
             self._stop = stop
-            # lock list all_xpl_stat when updating to prevent concurrent access.
+            # lock to prevent concurrent rebuilds of the matcher
             self._lockUpdate = threading.Lock()
+            # (devices snapshot version, matcher built from this snapshot), replaced at once
+            self._matcher = (None, None)
             # on startup, load the device parameters
             self.on_device_changed()
 
         def on_device_changed(self):
-            """ Function called when a device have been changed to reload the devices parameters
+            """ Function called when a device have been changed to rebuild the xpl stats index
+                The xpl stats are read from the devices model, which is already up to date
             """
+            self._log.info("Event : one device changed. Reloading data for _XplSensorThread")
+            self._get_matcher()
+            self._log.info("Event : one device changed. Reloading data for _XplSensorThread -- finished")
+
+        def _get_matcher(self):
+            """ Return the matcher of the current devices snapshot
+                It is rebuilt only when the snapshot version changed
+            """
+            snapshot = self._model.snapshot
+            version, matcher = self._matcher
+            if version == snapshot.version:
+                return matcher
             with self._lockUpdate:
-                self._log.info("Event : one device changed. Reloading data for _XplSensorThread")
-                self.all_xpl_stat = []
-                with self._db.session_scope():
-                    for xplstat in self._db.get_all_xpl_stat():
-                        #print(xplstat)
-                        #print(xplstat.params)
-                        # <XplStat: name='Open/Close sensor', json_id='open_close', device_id='95', id='185', schema='ac.basic'>
-                        # <XplStatParam: xplstat_id='188', multiple='None', value='None', ignore_values='', sensor_id='411', static='False', key='current', type='None'>
-                        a_xplstat = {'name' : xplstat.name,
-                                     'json_id' : xplstat.json_id,
-                                     'device_id' : xplstat.device_id,
-                                     'id' : xplstat.id,
-                                     'schema' : xplstat.schema,
-                                     'params' : []
-                                    }
-                        for a_xplstat_param in xplstat.params:
-                            a_xplstat['params'].append({
-                                                         'xplstat_id' : a_xplstat_param.xplstat_id,
-                                                         'multiple' : a_xplstat_param.multiple,
-                                                         'value' : a_xplstat_param.value,
-                                                         'ignore_values' : a_xplstat_param.ignore_values,
-                                                         'sensor_id' : a_xplstat_param.sensor_id,
-                                                         'static' : a_xplstat_param.static,
-                                                         'key' : a_xplstat_param.key,
-                                                         'type' : a_xplstat_param.type
-                                                       })
-
-                        self.all_xpl_stat.append(a_xplstat)
-                    #print(self.all_xpl_stat)
-
-                self._log.info("Event : one device changed. Reloading data for _XplSensorThread -- finished")
+                version, matcher = self._matcher
+                if version != snapshot.version:
+                    all_xpl_stat = [snapshot.xpl_stats[an_id] for an_id in sorted(snapshot.xpl_stats, key=int)]
+                    matcher = XplStatMatcher(all_xpl_stat)
+                    self._matcher = (snapshot.version, matcher)
+                return matcher
 
         def _find_storeparam(self, item):
-            #print("ITEM = {0}".format(item['msg']))
-            found = False
-            tostore = []
-            #for xplstat in self._db.get_all_xpl_stat():
-            with self._lockUpdate:
-                for xplstat in self.all_xpl_stat:
-                    matching = 0
-                    statics = 0
-                    if xplstat['schema'] == item["msg"].schema:
-                        #print("  XPLSTAT = {0}".format(xplstat))
-                        # we found a possible xplstat
-                        # try to match all params and try to find a sensorid and a vlaue to store
-                        for param in xplstat['params']:
-                            #print("    PARAM = {0}".format(param))
-                            ### Caution !
-                            # in case you, who are reading this, have to debug something like that :
-                            # 2015-08-16 22:04:26,190 domogik-xplgw INFO Storing stat for device 'Garage' (6) and sensor 'Humidity' (69): key 'current' with value '53' after conversion.
-                            # 2015-08-16 22:04:26,306 domogik-xplgw INFO Storing stat for device 'Salon' (10) and sensor 'Humidity' (76): key 'current' with value '53' after conversion.
-                            # 2015-08-16 22:04:26,420 domogik-xplgw INFO Storing stat for device 'Chambre d'Ewan' (11) and sensor 'Humidity' (80): key 'current' with value '53' after conversion.
-                            # 2015-08-16 22:04:26,533 domogik-xplgw INFO Storing stat for device 'Chambre des parents' (12) and sensor 'Humidity' (84): key 'current' with value '53' after conversion.
-                            # 2015-08-16 22:04:26,651 domogik-xplgw INFO Storing stat for device 'Chambre de Laly' (13) and sensor 'Humidity' (88): key 'current' with value '53' after conversion.
-                            # 2015-08-16 22:04:26,770 domogik-xplgw INFO Storing stat for device 'Entrée' (17) and sensor 'Humidity' (133): key 'current' with value '53' after conversion.
-                            #
-                            # which means that for a single xPL message, the value is stored in several sensors (WTF!!! ?)
-                            # It can be related to the fact that the device address key is no more corresponding between the plugin (info.json and xpl sent by python) and the way the device was create in the databse
-                            # this should not happen, but in case... well, we may try to find a fix...
-
-                            if param['key'] in item["msg"].data and param['static']:
-                                statics = statics + 1
-                                if param['multiple'] is not None and len(param['multiple']) == 1 and item["msg"].data[param['key']] in param['value'].split(param['multiple']):
-                                    matching = matching + 1
-                                elif item["msg"].data[param['key']] == param['value']:
-                                    matching = matching + 1
-                        # now we have a matching xplstat, go and find all sensors
-                        if matching == statics:
-                            #print("  MATHING !!!!!")
-                            for param in xplstat['params']:
-                                if param['key'] in item["msg"].data and not param['static']:
-                                    #print("    ===> TOSTORE !!!!!!!!! : {0}".format({'param': param, 'value': item["msg"].data[param['key']]}))
-                                    tostore.append( {'param': param, 'value': item["msg"].data[param['key']]} )
-                        if len(tostore) > 0:
-                            found = True
-            if found:
-                return (found, tostore)
+            """ Find the sensors values to store for a received message
+                The matcher is replaced as a whole when the devices snapshot changes, so no lock is needed here
+            """
+            ### Caution !
+            # in case you, who are reading this, have to debug something like that :
+            # 2015-08-16 22:04:26,190 domogik-xplgw INFO Storing stat for device 'Garage' (6) and sensor 'Humidity' (69): key 'current' with value '53' after conversion.
+            # 2015-08-16 22:04:26,306 domogik-xplgw INFO Storing stat for device 'Salon' (10) and sensor 'Humidity' (76): key 'current' with value '53' after conversion.
+            # 2015-08-16 22:04:26,420 domogik-xplgw INFO Storing stat for device 'Chambre d'Ewan' (11) and sensor 'Humidity' (80): key 'current' with value '53' after conversion.
+            # 2015-08-16 22:04:26,533 domogik-xplgw INFO Storing stat for device 'Chambre des parents' (12) and sensor 'Humidity' (84): key 'current' with value '53' after conversion.
+            # 2015-08-16 22:04:26,651 domogik-xplgw INFO Storing stat for device 'Chambre de Laly' (13) and sensor 'Humidity' (88): key 'current' with value '53' after conversion.
+            # 2015-08-16 22:04:26,770 domogik-xplgw INFO Storing stat for device 'Entrée' (17) and sensor 'Humidity' (133): key 'current' with value '53' after conversion.
+            #
+            # which means that for a single xPL message, the value is stored in several sensors (WTF!!! ?)
+            # It can be related to the fact that the device address key is no more corresponding between the plugin (info.json and xpl sent by python) and the way the device was create in the databse
+            # this should not happen, but in case... well, we may try to find a fix...
+            tostore = self._get_matcher().match(item["msg"].schema, item["msg"].data)
+            if len(tostore) > 0:
+                return (True, tostore)
             else:
                 return False
 
@@ -767,17 +658,17 @@ class XplManager(XplPlugin):
                                     #current_date = calendar.timegm(time.gmtime())
                                     current_date = item["received_datetime"]
                                     store = True
-                                    if storeparam['ignore_values']:
-                                        if value in eval(storeparam['ignore_values']):
-                                            self._log.debug(u"Value {0} is in the ignore list {0}, so not storing.".format(value, storeparam['ignore_values']))
+                                    if storeparam['ignore_list'] is not None:
+                                        if value in storeparam['ignore_list']:
+                                            self._log.debug(u"Value {0} is in the ignore list {1}, so not storing.".format(value, storeparam['ignore_values']))
                                             store = False
                                     if store:
                                         data = {}
                                         data['sensor_id'] = storeparam['sensor_id']
                                         data['time'] = current_date
                                         data['value'] = value
-                                        self._log.debug(u"Adding new message to the store queue, current length = {0}".format(self._queue_store.qsize()))
-                                        self._queue_store.put(data)
+                                        store_queue = self._put_in_store_queue(data)
+                                        self._log.debug(u"New message added to the store queue, current length = {0}".format(store_queue.qsize()))
                                     else:
                                         self._log.debug(u"Don't need to store this value")
                 except queue.Empty:
@@ -788,131 +679,198 @@ class XplManager(XplPlugin):
 
     class _SensorStoreThread(threading.Thread):
         """ SensorStoreThread class
-        Thread that will handle the sensorStore queue
+        Thread that will handle a sensorStore queue
         every item in this queue should be stored in the db
         - conversion will happend
         - formula applying
         - rounding
         - and eventually storing it in the db
         Its a thread to make sure it does not block anything else
+        There are several store threads, each one with its own queue, database session and publisher (zmq sockets are not thread safe).
+        All the values of a sensor are in the same queue.
+        The last value, min and max of the sensors are written at most each STORE_STATE_DELAY seconds.
         """
-        def __init__(self, queue, log, get_conversion_map, pub, stop):
-            threading.Thread.__init__(self, name="SensorStoreThread")
+        def __init__(self, idx, queue, log, model, conversions, devices_changed, stop):
+            threading.Thread.__init__(self, name="SensorStoreThread-{0}".format(idx))
+            self._idx = idx
             self._log = log
-            self._db = DbHelper(owner="Sensor Store queue {0}".format(queue))
-            self._conv = get_conversion_map
+            self._db = DbHelper(owner="Sensor Store queue {0}".format(idx))
+            self._model = model
+            self._conversions = conversions
+            # called with the sensors of the devices reloaded by a store thread
+            self._devices_changed = devices_changed
             self._queue = queue
-            self._pub = pub
+            self._pub = MQPub(zmq.Context(), 'xplgw')
             self._stop = stop
             # lock list sensors/devices when updating to prevent concurrent access.
             self._lockUpdate = threading.Lock()
-            # on startup, load the device parameters
-            self.on_device_changed()
-
-        def on_device_changed(self):
-            """ Function called when a device have been changed to reload the devices parameters
+            # sensor id (int) => last 2 stored history rows, read from the database on the first value of the sensor
+            self._windows = {}
+            # sensor id (int) => last value, last received date, min and max of the stored values, read from the database on the first value of the sensor
+            self._sensor_states = {}
+            # statistics
+            self._stats_lock = threading.Lock()
+            self._stats = {'values' : 0, 'batches' : 0, 'errors' : 0}
+            self._stats_period_start = time.time()
+            self._stats_period_values = 0
+
+        def on_device_changed(self, sensor_ids=None):
+            """ Function called when a device have been changed
+                The sensors are read from the devices model, which is already up to date.
+                Only the history windows and the state of the changed sensors have to be read again.
+                @param sensor_ids : ids (str) of the changed sensors, None for all the sensors
             """
             with self._lockUpdate:
-                self._log.info("Event : one device changed. Reloading data for _SensorStoreThread")
-                self.__reload_device()
-                self._log.info("Event : one device changed. Reloading data for _SensorStoreThread -- finished")
-
-        def __reload_device(self):
-            """Self._lockUpdate.acquire must be do by caller"""
-
-            with self._db.session_scope():
-                self.all_sensors = {}
-                self.all_devices = {}
-                for sen in self._db.get_all_sensor():
-                    #print(sen)
-                    #<Sensor: conversion='', value_min='None', history_round='0.0', reference='adco', data_type='DT_String', history_duplicate='False', last_received='1474968431', incremental='False', id='29', history_expire='0', timeout='180', history_store='True', history_max='0', formula='None', device_id='2', last_value='030928084432', value_max='3.09036843008e+11', name='Electric meter address'>
-                    self.all_sensors[str(sen.id)] = { 'id' : sen.id,
-                                                 'conversion' : sen.conversion,
-                                                 'value_min' : sen.value_min,
-                                                 'history_round' : sen.history_round,
-                                                 'reference' : sen.reference,
-                                                 'data_type' : sen.data_type,
-                                                 'history_duplicate' : sen.history_duplicate,
-                                                 'last_received' : sen.last_received,
-                                                 'incremental' : sen.incremental,
-                                                 'history_expire' : sen.history_expire,
-                                                 'timeout' : sen.timeout,
-                                                 'history_store' : sen.history_store,
-                                                 'history_max' : sen.history_max,
-                                                 'formula' : sen.formula,
-                                                 'device_id' : sen.device_id,
-                                                 'last_value' : sen.last_value,
-                                                 'value_max' : sen.value_max,
-                                                 'name' : sen.name}
-                #print(self.all_sensors)
-
-                for dev in self._db.list_devices():
-                    #print(dev)
-                    #{'xpl_stats': {u'get_total_space': {'json_id': u'get_total_space', 'schema': u'sensor.basic', 'id': 3, 'parameters': {'dynamic': [{'ignore_values': u'', 'sensor_name': u'get_total_space', 'key': u'current'}], 'static': [{'type': u'string', 'value': u'/', 'key': u'device'}, {'type': None, 'value': u'total_space', 'key': u'type'}]}, 'name': u'Total space'}, u'get_free_space': {'json_id': u'get_free_space', 'schema': u'sensor.basic', 'id': 4, 'parameters': {'dynamic': [{'ignore_values': u'', 'sensor_name': u'get_free_space', 'key': u'current'}], 'static': [{'type': u'string', 'value': u'/', 'key': u'device'}, {'type': None, 'value': u'free_space', 'key': u'type'}]}, 'name': u'Free space'}, u'get_used_space': {'json_id': u'get_used_space', 'schema': u'sensor.basic', 'id': 5, 'parameters': {'dynamic': [{'ignore_values': u'', 'sensor_name': u'get_used_space', 'key': u'current'}], 'static': [{'type': u'string', 'value': u'/', 'key': u'device'}, {'type': None, 'value': u'used_space', 'key': u'type'}]}, 'name': u'Used space'}, u'get_percent_used': {'json_id': u'get_percent_used', 'schema': u'sensor.basic', 'id': 6, 'parameters': {'dynamic': [{'ignore_values': u'', 'sensor_name': u'get_percent_used', 'key': u'current'}], 'static': [{'type': u'string', 'value': u'/', 'key': u'device'}, {'type': None, 'value': u'percent_used', 'key': u'type'}]}, 'name': u'Percent used'}}, 'commands': {}, 'description': u'', 'reference': u'', 'sensors': {u'get_total_space': {'value_min': None, 'data_type': u'DT_Byte', 'incremental': False, 'id': 57, 'reference': u'get_total_space', 'conversion': u'', 'name': u'Total Space', 'last_received': 1459192737, 'timeout': 0, 'formula': None, 'last_value': u'14763409408', 'value_max': 14763409408.0}, u'get_free_space': {'value_min': None, 'data_type': u'DT_Byte', 'incremental': False, 'id': 59, 'reference': u'get_free_space', 'conversion': u'', 'name':u'Free Space', 'last_received': 1459192737, 'timeout': 0, 'formula': None, 'last_value': u'1319346176', 'value_max': 8220349952.0}, u'get_used_space': {'value_min': None, 'data_type': u'DT_Byte', 'incremental': False, 'id': 60, 'reference': u'get_used_space', 'conversion': u'', 'name': u'Used Space', 'last_received': 1459192737, 'timeout': 0, 'formula': None, 'last_value': u'13444063232', 'value_max': 14763409408.0}, u'get_percent_used': {'value_min': None, 'data_type':u'DT_Scaling', 'incremental': False, 'id': 58, 'reference': u'get_percent_used', 'conversion': u'', 'name': u'Percent used', 'last_received': 1459192737, 'timeout': 0, 'formula': None, 'last_value': u'91', 'value_max': 100.0}}, 'xpl_commands': {}, 'client_id': u'plugin-diskfree.ambre', 'device_type_id': u'diskfree.disk_usage', 'client_version': u'1.0', 'parameters': {u'interval': {'value': u'5', 'type': u'integer', 'id': 5, 'key': u'interval'}}, 'id': 3, 'name': u'Ambre /'}
-                    self.all_devices[str(dev['id'])] = {
-                                                    'client_id': dev['client_id'],
-                                                    'id': dev['id'],
-                                                    'name': dev['name']
-                                                  }
-                #print(self.all_devices)
-                self._log.debug(u"Devices and sensors reloaded for _SensorStoreThread")
+                if sensor_ids is None:
+                    self._windows.clear()
+                    self._sensor_states.clear()
+                else:
+                    for sensor_id in sensor_ids:
+                        self._windows.pop(int(sensor_id), None)
+                        self._sensor_states.pop(int(sensor_id), None)
 
         def run(self):
             while not self._stop.isSet():
                 try:
-                    store = True
-                    item = self._queue.get(timeout=1)
-                    #self._log.debug(u"Getting item from the store queue, current length = {0}".format(self._queue.qsize()))
-                    self._log.debug(u"Getting item from the store queue, current length = {0}, item = '{1}'".format(self._queue.qsize(), item))
-                    # handle ignore
-                    value = item['value']
-                    senid = item['sensor_id']
-                    current_date = item['time']
-                    # get the sensor and dev
-                    with self._lockUpdate:
-                        if str(senid) not in self.all_sensors :
-                            self._log.debug(u"Sensor not find, reload sensors and device_list at once to be sure of devices_list update")
-                            self.__reload_device()
-                        sen = self.all_sensors[str(senid)]
-                        if str(sen['device_id'])not in self.all_devices :
-                            self._log.debug(u"Device not find, reload sensors and devices_list at once to be sure of devices_list update")
-                            self.__reload_device()
-                            sen = self.all_sensors[str(senid)]
-                        dev = self.all_devices[str(sen['device_id'])]
-                    # check if we need a conversion
-                    if sen['conversion'] is not None and sen['conversion'] != '':
-                        if dev['client_id'] in self._conv() and sen['conversion'] in self._conv()[dev['client_id']]:
-                            self._log.debug( \
-                                u"Calling conversion {0}".format(sen['conversion']))
-                            exec(self._conv()[dev['client_id']][sen['conversion']])
-                            value = locals()[sen['conversion']](value)
-                    self._log.info( \
-                            u"Storing stat for device '{0}' ({1}) and sensor '{2}' ({3}) with value '{4}' after conversion." \
-                            .format(dev['name'], dev['id'], sen['name'], sen['id'], value))
+                    batch = self._get_batch()
+                    if len(batch) > 0:
+                        self._store_batch(batch)
+                    else:
+                        # no value : write the sensors state kept in memory once they are too old
+                        self._flush_states(STORE_STATE_DELAY)
+                    self._log_stats()
+                except Exception as exp:
+                    self._log.error(traceback.format_exc())
+            try:
+                self._flush_states()
+            except Exception as exp:
+                self._log.error(traceback.format_exc())
+
+        def _flush_states(self, delay=0):
+            """ Write the last value, min and max of the sensors kept in memory by the store
+                @param delay : only write them if the oldest one is older than delay seconds
+            """
+            with self._lockUpdate:
+                with self._db.session_scope():
+                    self._db.flush_sensor_states(delay)
+
+        def get_stats(self):
+            """ Return the statistics of the worker since xplgw started
+            """
+            with self._stats_lock:
+                stats = dict(self._stats)
+            stats['worker'] = self._idx
+            stats['queue_length'] = self._queue.qsize()
+            return stats
+
+        def _log_stats(self):
+            """ Log the queue length and the throughput each STORE_STATS_INTERVAL seconds
+            """
+            duration = time.time() - self._stats_period_start
+            if duration < STORE_STATS_INTERVAL:
+                return
+            self._log.info(u"Store worker {0} : {1} value(s) stored in {2:.0f}s ({3:.2f} values/s), queue length = {4}".format( \
+                    self._idx, self._stats_period_values, duration, self._stats_period_values / duration, self._queue.qsize()))
+            self._stats_period_start = time.time()
+            self._stats_period_values = 0
+
+        def _get_batch(self):
+            """ Wait for a first item in the store queue and then drain the queue
+                until STORE_BATCH_SIZE items are collected or STORE_BATCH_DELAY is reached
+            """
+            batch = []
+            try:
+                item = self._queue.get(timeout=1)
+            except queue.Empty:
+                # nothing in the queue
+                return batch
+            deadline = time.time() + STORE_BATCH_DELAY
+            while True:
+                self._log.debug(u"Getting item from the store queue, current length = {0}, item = '{1}'".format(self._queue.qsize(), item))
+                data = self._prepare_item(item)
+                if data is not None:
+                    batch.append(data)
+                remaining = deadline - time.time()
+                if len(batch) >= STORE_BATCH_SIZE or remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            return batch
+
+        def _prepare_item(self, item):
+            """ Find the sensor and device of a store queue item and do the conversion
+                @return the item to give to add_sensor_history_batch, None if the item can't be stored
+            """
+            try:
+                value = item['value']
+                senid = item['sensor_id']
+                # get the sensor and dev
+                snapshot = self._model.snapshot
+                sen = snapshot.sensors.get(str(senid))
+                dev = None if sen is None else snapshot.devices.get(str(sen['device_id']))
+                if sen is None or dev is None:
+                    self._log.debug(u"Sensor or device not found, looking for the devices changes")
+                    # all the threads use the reloaded devices
+                    self._devices_changed(self._model.sync(force=False))
+                    snapshot = self._model.snapshot
+                    sen = snapshot.sensors[str(senid)]
+                    dev = snapshot.devices[str(sen['device_id'])]
+                # check if we need a conversion
+                if sen['conversion'] is not None and sen['conversion'] != '':
+                    conversion = self._conversions.get(dev['client_id'], sen['conversion'])
+                    if conversion is not None:
+                        self._log.debug( \
+                            u"Calling conversion {0}".format(sen['conversion']))
+                        value = conversion(value)
+                self._log.info( \
+                        u"Storing stat for device '{0}' ({1}) and sensor '{2}' ({3}) with value '{4}' after conversion." \
+                        .format(dev['name'], dev['id'], sen['name'], sen['id'], value))
+                return {'sensor_id' : senid,
+                        'sensor' : sen,
+                        'value' : value,
+                        'date' : item['time'],
+                        'device' : dev}
+            except Exception as exp:
+                self._log.error(u"Error when preparing sensor history item {0} : {1}".format(item, traceback.format_exc()))
+                return None
+
+        def _store_batch(self, batch):
+            """ Store a batch of values in a single transaction and publish them
+                If the batch fails, the values are stored one by one so that a bad value does not drop the others
+            """
+            try:
+                with self._lockUpdate:
+                    with self._db.session_scope():
+                        values = self._db.add_sensor_history_batch(batch, self._windows, STORE_STATE_DELAY, self._sensor_states)
+                self._log.debug(u"{0} value(s) stored in the history, store queue length = {1}".format(len(batch), self._queue.qsize()))
+            except Exception as exp:
+                self._log.error(u"Error when adding a batch of {0} values to the sensor history, storing them one by one : {1}".format(len(batch), traceback.format_exc()))
+                values = []
+                for data in batch:
                     try:
-                        # do the store
                         with self._lockUpdate:
                             with self._db.session_scope():
-                                value = self._db.add_sensor_history(\
-                                        senid, \
-                                        sen, \
-                                        value, \
-                                        current_date)
-                                # publish the result
-                                self._pub.send_event('device-stats', \
-                                      {"timestamp" : current_date, \
-                                      "device_id" : dev['id'], \
-                                      "sensor_id" : senid, \
-                                      "stored_value" : value})
-                        # Release CPU for other work
-                        time.sleep(0.1)
+                                values.extend(self._db.add_sensor_history_batch([data], self._windows, STORE_STATE_DELAY, self._sensor_states))
                     except Exception as exp:
                         self._log.error(u"Error when adding sensor history : {0}".format(traceback.format_exc()))
-                except queue.Empty:
-                    # nothing in the queue, sleep for 1 second
-                    time.sleep(1)
-                except Exception as exp:
-                    self._log.error(traceback.format_exc())
+                        values.append(None)
+            stored = len([value for value in values if value is not None])
+            with self._stats_lock:
+                self._stats['values'] += stored
+                self._stats['batches'] += 1
+                self._stats['errors'] += len(batch) - stored
+            self._stats_period_values += stored
+            # publish the results
+            for data, value in zip(batch, values):
+                if value is None:
+                    continue
+                self._pub.send_event('device-stats', \
+                      {"timestamp" : data['date'], \
+                      "device_id" : data['device']['id'], \
+                      "sensor_id" : data['sensor_id'], \
+                      "stored_value" : value})
 
 if __name__ == '__main__':
     EVTN = XplManager()
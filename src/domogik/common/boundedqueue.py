@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+""" This file is part of B{Domogik} project (U{http://www.domogik.org}).
+
+License
+=======
+
+B{Domogik} is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+B{Domogik} is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Domogik. If not, see U{http://www.gnu.org/licenses}.
+
+Module purpose
+==============
+
+Bounded queue with an overload policy for each key (sensor id)
+
+When the queue is full, a new item is handled according to the policy of
+its key :
+- block : wait until an item is taken from the queue (all the items are kept)
+- coalesce : replace the last queued item of the same key (only the latest value is kept)
+- drop_oldest : drop the oldest queued item of the same key
+
+With coalesce and drop_oldest, an item whose key has no queued item is
+added anyway, so the queue length may exceed its size by one item per key.
+
+Implements
+==========
+
+- BoundedQueue
+
+@author: Domogik project
+@copyright: (C) 2007-2019 Domogik project
+@license: GPL(v3)
+@organization: Domogik
+"""
+
+import collections
+import threading
+import time
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+POLICY_BLOCK = 'block'
+POLICY_COALESCE = 'coalesce'
+POLICY_DROP_OLDEST = 'drop_oldest'
+POLICIES = [POLICY_BLOCK, POLICY_COALESCE, POLICY_DROP_OLDEST]
+
+
+class BoundedQueue(object):
+    """ Bounded FIFO queue, with the same get/put/qsize methods as queue.Queue
+    """
+
+    def __init__(self, maxsize, default_policy=POLICY_BLOCK, policies=None):
+        """ Create the queue
+            @param maxsize : number of items before the overload policies are applied
+            @param default_policy : policy for the keys which are not in policies
+            @param policies : dict key => policy
+        """
+        if default_policy not in POLICIES:
+            raise ValueError(u"Unknown overload policy : {0}".format(default_policy))
+        self._maxsize = maxsize
+        self._default_policy = default_policy
+        self._policies = {}
+        self.set_policies(policies or {})
+        self._mutex = threading.Lock()
+        self._not_empty = threading.Condition(self._mutex)
+        self._not_full = threading.Condition(self._mutex)
+        # the queued entries are [key, item, alive]
+        self._entries = collections.deque()
+        # key => queued entries of this key, the oldest first
+        self._by_key = {}
+        self._size = 0
+        self._dead = 0
+        self._stats = {'put' : 0, 'blocked' : 0, 'coalesced' : 0, 'dropped' : 0}
+
+    def set_policies(self, policies):
+        """ Set the overload policy of some keys
+            @param policies : dict key => policy
+        """
+        for key, policy in policies.items():
+            if policy not in POLICIES:
+                raise ValueError(u"Unknown overload policy for {0} : {1}".format(key, policy))
+        self._policies = dict(policies)
+
+    def get_policy(self, key):
+        """ Return the overload policy of a key
+        """
+        return self._policies.get(key, self._default_policy)
+
+    def qsize(self):
+        """ Return the number of queued items
+        """
+        with self._mutex:
+            return self._size
+
+    def put(self, item, key=None):
+        """ Add an item to the queue
+            @param item : item
+            @param key : key used to find the overload policy and the items of the same kind
+        """
+        with self._mutex:
+            self._stats['put'] += 1
+            if self._size >= self._maxsize:
+                policy = self.get_policy(key)
+                queued = self._by_key.get(key)
+                if policy == POLICY_BLOCK:
+                    self._stats['blocked'] += 1
+                    while self._size >= self._maxsize:
+                        self._not_full.wait()
+                elif policy == POLICY_COALESCE and queued:
+                    # keep the position of the queued item, but with the latest value
+                    queued[-1][1] = item
+                    self._stats['coalesced'] += 1
+                    return
+                elif policy == POLICY_DROP_OLDEST and queued:
+                    entry = queued.popleft()
+                    if len(queued) == 0:
+                        del self._by_key[key]
+                    entry[2] = False
+                    self._size -= 1
+                    self._dead += 1
+                    self._stats['dropped'] += 1
+                    self._compact()
+            entry = [key, item, True]
+            self._entries.append(entry)
+            self._by_key.setdefault(key, collections.deque()).append(entry)
+            self._size += 1
+            self._not_empty.notify()
+
+    def get(self, block=True, timeout=None):
+        """ Remove and return the oldest item
+            @raise queue.Empty if there is no item after timeout seconds, like queue.Queue
+        """
+        with self._mutex:
+            if not block:
+                if self._size == 0:
+                    raise queue.Empty
+            elif timeout is None:
+                while self._size == 0:
+                    self._not_empty.wait()
+            else:
+                deadline = time.time() + timeout
+                while self._size == 0:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self._not_empty.wait(remaining)
+            while True:
+                entry = self._entries.popleft()
+                if entry[2]:
+                    break
+                self._dead -= 1
+            queued = self._by_key[entry[0]]
+            queued.popleft()
+            if len(queued) == 0:
+                del self._by_key[entry[0]]
+            self._size -= 1
+            self._not_full.notify()
+            return entry[1]
+
+    def get_nowait(self):
+        """ Remove and return the oldest item without waiting
+        """
+        return self.get(block=False)
+
+    def get_stats(self):
+        """ Return the queue statistics
+            @return dict with the keys 'length', 'maxsize', 'put', 'blocked', 'coalesced', 'dropped'
+        """
+        with self._mutex:
+            stats = dict(self._stats)
+            stats['length'] = self._size
+        stats['maxsize'] = self._maxsize
+        return stats
+
+    def _compact(self):
+        """ Remove the dropped entries when they are more than the queued ones
+            The caller must hold the lock
+        """
+        if self._dead > self._size:
+            self._entries = collections.deque([entry for entry in self._entries if entry[2]])
+            self._dead = 0
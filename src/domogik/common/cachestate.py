@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+""" This file is part of B{Domogik} project (U{http://www.domogik.org}).
+
+License
+=======
+
+B{Domogik} is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+B{Domogik} is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Domogik. If not, see U{http://www.gnu.org/licenses}.
+
+Module purpose
+==============
+
+Shared state of the devices cache
+
+The cachedb process (the only writer) publishes the state of its devices
+cache (cache id, devices and sensors versions and up to date clients) in a
+memory mapped file. The DbHelper instances map it : when their copy of the
+devices has the published versions, they don't call the cachedb process at
+all.
+
+The file is a sequence counter, the generation of the writer, a heartbeat
+date, the length of the state and the state in json. The counter is odd
+while the state is written : a reader retries when it is odd or when it
+changed during the read. The state is only parsed again when the counter
+or the generation changed.
+
+Each writer has a new generation, and refreshes the heartbeat each
+STATE_HEARTBEAT_PERIOD seconds. When the heartbeat is older than
+STATE_HEARTBEAT_TIMEOUT seconds (the cachedb process is stopped, or the
+file was created again and the reader maps the removed one), the reader
+maps the file again and, if it is still not refreshed, returns no state :
+the DbHelper instances then call the cachedb process.
+
+Implements
+==========
+
+- CacheStateWriter
+- CacheStateReader
+- get_state_path
+
+@author: Domogik project
+@copyright: (C) 2007-2019 Domogik project
+@license: GPL(v3)
+@organization: Domogik
+"""
+
+import json
+import mmap
+import os
+import struct
+import time
+
+# name of the state file in the pid directory, if the cache_state_path option is not set
+STATE_FILE = 'cachedb_api.state'
+# size (in bytes) of the state file. A bigger state is not published : the readers then call the cachedb process
+STATE_SIZE = 65536
+# number of reads of a state being written before giving up
+STATE_READ_RETRIES = 100
+# seconds between 2 refreshes of the heartbeat by the writer
+STATE_HEARTBEAT_PERIOD = 5
+# seconds after which a state whose heartbeat is not refreshed is not used any more
+STATE_HEARTBEAT_TIMEOUT = 30
+
+_SEQUENCE = struct.Struct('<Q')
+_GENERATION = struct.Struct('<Q')
+_HEARTBEAT = struct.Struct('<d')
+_LENGTH = struct.Struct('<I')
+_GENERATION_OFFSET = _SEQUENCE.size
+_HEARTBEAT_OFFSET = _GENERATION_OFFSET + _GENERATION.size
+_LENGTH_OFFSET = _HEARTBEAT_OFFSET + _HEARTBEAT.size
+_DATA_OFFSET = _LENGTH_OFFSET + _LENGTH.size
+
+
+def get_state_path(config):
+    """ Return the state file, from the cache_state_path option of the database section
+        @param config : result of Loader('database').load()
+        @return the file path, None if the state is not published
+    """
+    db_config = dict(config[1])
+    if 'cache_state_path' in db_config:
+        return db_config['cache_state_path'] or None
+    return os.path.join(config[0]['pid_dir_path'], STATE_FILE)
+
+
+class CacheStateWriter(object):
+    """ Publish the state of the devices cache, from the cachedb process
+    """
+
+    def __init__(self, path, size=STATE_SIZE):
+        """ Init
+            @param path : state file, created if needed
+            @param size : size (in bytes) of the file
+        """
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        # go on after the counter of a previous cachedb process, and make it even
+        sequence = _SEQUENCE.unpack_from(self._map, 0)[0]
+        self._sequence = sequence + 2 - sequence % 2
+        # a new generation : the readers don't use the state of the previous writer
+        generation = struct.unpack('<Q', os.urandom(_GENERATION.size))[0]
+        self._map[0:_SEQUENCE.size] = _SEQUENCE.pack(self._sequence + 1)
+        _GENERATION.pack_into(self._map, _GENERATION_OFFSET, generation)
+        _HEARTBEAT.pack_into(self._map, _HEARTBEAT_OFFSET, time.time())
+        _LENGTH.pack_into(self._map, _LENGTH_OFFSET, 0)
+        self._sequence += 2
+        self._map[0:_SEQUENCE.size] = _SEQUENCE.pack(self._sequence)
+
+    def publish(self, state):
+        """ Publish a state
+            @param state : dict, serializable in json. None to tell the readers that there is no state
+        """
+        data = json.dumps(state).encode('utf-8') if state is not None else b''
+        if _DATA_OFFSET + len(data) > len(self._map):
+            data = b''
+        self._map[0:_SEQUENCE.size] = _SEQUENCE.pack(self._sequence + 1)
+        _HEARTBEAT.pack_into(self._map, _HEARTBEAT_OFFSET, time.time())
+        _LENGTH.pack_into(self._map, _LENGTH_OFFSET, len(data))
+        self._map[_DATA_OFFSET:_DATA_OFFSET + len(data)] = data
+        self._sequence += 2
+        self._map[0:_SEQUENCE.size] = _SEQUENCE.pack(self._sequence)
+
+    def heartbeat(self):
+        """ Tell the readers that the writer is alive, without changing the state
+        """
+        _HEARTBEAT.pack_into(self._map, _HEARTBEAT_OFFSET, time.time())
+
+    def close(self):
+        self._map.close()
+
+
+class CacheStateReader(object):
+    """ Read the state of the devices cache published by the cachedb process
+    """
+
+    def __init__(self, path):
+        """ Init
+            @param path : state file. It is mapped on the first read after it is created
+        """
+        self._path = path
+        self._map = None
+        # (generation, sequence) of the parsed state
+        self._version = None
+        self._state = None
+
+    def _open(self):
+        try:
+            fd = os.open(self._path, os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            if os.fstat(fd).st_size < _DATA_OFFSET:
+                return False
+            self._map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        return True
+
+    def _is_alive(self):
+        """ Check that the heartbeat of the writer was refreshed
+        """
+        heartbeat = _HEARTBEAT.unpack_from(self._map, _HEARTBEAT_OFFSET)[0]
+        return time.time() - heartbeat <= STATE_HEARTBEAT_TIMEOUT
+
+    def read(self):
+        """ Return the last published state, None if there is none or if the writer is not alive
+        """
+        if self._map is None and not self._open():
+            return None
+        if not self._is_alive():
+            # the file may have been created again by a new writer
+            self.close()
+            if not self._open() or not self._is_alive():
+                return None
+        for retry in range(STATE_READ_RETRIES):
+            sequence = _SEQUENCE.unpack_from(self._map, 0)[0]
+            generation = _GENERATION.unpack_from(self._map, _GENERATION_OFFSET)[0]
+            if (generation, sequence) == self._version:
+                return self._state
+            if sequence % 2 == 1:
+                continue
+            length = _LENGTH.unpack_from(self._map, _LENGTH_OFFSET)[0]
+            if _DATA_OFFSET + length > len(self._map):
+                continue
+            data = self._map[_DATA_OFFSET:_DATA_OFFSET + length]
+            if _SEQUENCE.unpack_from(self._map, 0)[0] != sequence:
+                continue
+            self._state = json.loads(data.decode('utf-8')) if length > 0 else None
+            self._version = (generation, sequence)
+            return self._state
+        return None
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+""" This file is part of B{Domogik} project (U{http://www.domogik.org}).
+
+License
+=======
+
+B{Domogik} is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+B{Domogik} is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Domogik. If not, see U{http://www.gnu.org/licenses}.
+
+Module purpose
+==============
+
+Cache of the packages conversion functions
+
+The manager publishes the source of the conversion/*.py files of each
+client. Each source is compiled once and the resulting function is kept
+until the manager publishes a different source for it.
+
+Implements
+==========
+
+- ConversionRegistry
+
+@author: Domogik project
+@copyright: (C) 2007-2019 Domogik project
+@license: GPL(v3)
+@organization: Domogik
+"""
+
+import threading
+import traceback
+
+
+class ConversionRegistry(object):
+    """ Compiled conversions, by client id and conversion name
+    """
+
+    def __init__(self, log):
+        """ Init an empty registry
+            @param log : logger
+        """
+        self.log = log
+        # client id => { conversion name => (source, function) }
+        self._conversions = {}
+        self._lock = threading.Lock()
+
+    def update(self, data):
+        """ Set the conversions published by the manager
+            Only the new or changed sources are compiled
+            @param data : { client id => { conversion name => source } }
+        """
+        with self._lock:
+            conversions = {}
+            for client_id in data:
+                if data[client_id] is None:
+                    continue
+                old = self._conversions.get(client_id, {})
+                conversions[client_id] = {}
+                for name, source in data[client_id].items():
+                    if name in old and old[name][0] == source:
+                        conversions[client_id][name] = old[name]
+                    else:
+                        conversions[client_id][name] = (source, self._compile(client_id, name, source))
+            # the readers don't lock : the whole dict is replaced at once
+            self._conversions = conversions
+
+    def _compile(self, client_id, name, source):
+        """ Compile a conversion source and return its function
+            @return the function or None if the source is invalid
+        """
+        self.log.debug(u"Compiling conversion {0} of {1}".format(name, client_id))
+        try:
+            namespace = {'__name__' : "conversion_{0}".format(name)}
+            code = compile(source, "<conversion {0} of {1}>".format(name, client_id), "exec")
+            exec(code, namespace)
+            return namespace[name]
+        except:
+            self.log.error(u"Unable to compile the conversion {0} of {1} : {2}".format(name, client_id, traceback.format_exc()))
+            return None
+
+    def get(self, client_id, name):
+        """ Return a conversion function
+            @param client_id : client id
+            @param name : conversion name
+            @return the function or None if the conversion is not known
+        """
+        conversion = self._conversions.get(client_id, {}).get(name)
+        if conversion is None:
+            return None
+        return conversion[1]
@@ -48,8 +48,8 @@ import json
 import sqlalchemy
 from sqlalchemy import Table, MetaData, and_, or_, not_, desc
 from sqlalchemy.sql import func
-from sqlalchemy.sql.expression import func, extract
-from sqlalchemy.orm import sessionmaker, defer, scoped_session, joinedload
+from sqlalchemy.sql.expression import func, extract, bindparam, case
+from sqlalchemy.orm import sessionmaker, defer, scoped_session, joinedload, subqueryload
 from sqlalchemy.orm.session import make_transient
 from sqlalchemy.pool import QueuePool
 #from sqlalchemy.cprocessors import str_to_datetime
@@ -57,6 +57,14 @@ from domogik.common.utils import ucode, get_sanitized_hostname
 from domogik.common import logger
 #from domogik.common.packagejson import PackageJson
 from domogik.common.configloader import Loader
+from domogik.common.sensorpipeline import SensorPipelines
+from domogik.common.partition import SensorHistoryPartitions
+from domogik.common.downsampling import lttb
+from domogik.common.cachestate import CacheStateReader, get_state_path
+from domogik.common.rollup import (
+        ROLLUP_LEVELS, STEP_LEVELS, floor_date, next_date, ceil_date, cover_range,
+        group_key, bucket_level, bucket_origin, new_aggregate, merge_aggregate, aggregate_value
+)
 from domogik.common.sql_schema import (
         Device, DeviceParam,
         Plugin, PluginConfig,
@@ -64,15 +72,37 @@ from domogik.common.sql_schema import (
         UserAccount,
         Scenario,
         Command, CommandParam,
-        Sensor, SensorHistory,
+        Sensor, SensorHistory, SensorRetention,
+        SensorHistoryMinute, SensorHistoryHour, SensorHistoryDay, SensorHistoryMonth, SensorRollup,
         XplCommand, XplStat, XplStatParam, XplCommandParam,
         Location, LocationParam, Migrate,
         RepresentableBase
 )
 from contextlib import contextmanager
 from multiprocessing.managers import SyncManager
+from threading import Lock
 
 DEFAULT_RECYCLE_POOL = 3600
+# pause (in seconds) between 2 checks of the devices rebuilt by another client of the devices cache
+DEVICES_REFRESH_WAIT = 0.05
+# max time (in seconds) to refresh the devices from the devices cache (rebuilds and waits), then the devices are read
+DEVICES_REFRESH_TIMEOUT = 5
+
+# rollup level => table of the sensor history aggregates
+_ROLLUP_TABLES = {'minute' : SensorHistoryMinute,
+                  'hour' : SensorHistoryHour,
+                  'day' : SensorHistoryDay,
+                  'month' : SensorHistoryMonth}
+
+# the relations read by DbHelper.get_device, loaded with a fixed number of queries
+# whatever the number of devices (one query per relation, for all the devices)
+_DEVICE_GRAPH = (subqueryload(Device.params),
+                 subqueryload(Device.sensors),
+                 subqueryload(Device.commands).subqueryload(Command.params),
+                 subqueryload(Device.commands).joinedload(Command.xpl_command),
+                 subqueryload(Device.xpl_stats).subqueryload(XplStat.params),
+                 subqueryload(Device.xpl_commands).subqueryload(XplCommand.params),
+                 subqueryload(Device.xpl_commands).joinedload(XplCommand.stat))
 
 #For packages provided by pip sqlalchemy load wrong python modules.
 #So it is not already installed on system, we need to select good one
@@ -104,6 +134,24 @@ def _datetime_string_from_tstamp(ts):
     """Make a date from a timestamp"""
     return str(datetime.datetime.fromtimestamp(ts))
 
+def _history_result(groups, function_used):
+    """Return a history filter result
+    @param groups : list of (key columns list, aggregate)
+    @param function_used : min, max, avg or sum
+    """
+    total = [0, 0, None, None, None]
+    for key, aggregate in groups:
+        merge_aggregate(total, aggregate)
+    return {
+        'values': [key + [aggregate_value(aggregate, function_used)] for key, aggregate in groups],
+        'global_values': {
+            'min': aggregate_value(total, 'min'),
+            'max': aggregate_value(total, 'max'),
+            'avg': aggregate_value(total, 'avg'),
+            'sum': aggregate_value(total, 'sum')
+        }
+    }
+
 def _get_week_nb(dt):
     """Return the week number of a datetime expression"""
     #return (dt - datetime.datetime(dt.year, 1, 1)).days / 7
@@ -168,9 +216,28 @@ class DbHelper(object):
         config = cfg.load()
         self.__db_config = dict(config[1])
         self._owner = owner
+        # compiled storage rules of the sensors (formula, rounding, ...)
+        self._sensor_pipelines = SensorPipelines(self.log)
+        # ids of the sensors whose rollups state exists in the database
+        self._rollup_sensors = set()
+        # sensor id => last value, last received, min and max not yet written (see add_sensor_history_batch)
+        self._sensor_states = {}
+        # time of the oldest not written sensor state
+        self._sensor_states_since = None
+        # local copy of the devices cache : device id => device, synchronized with (cache id, version)
+        self._devices_copy = {}
+        self._devices_copy_version = (None, 0)
+        # sensors version of the local copy (the last value, min and max of the sensors are patched separately)
+        self._devices_copy_sensors_version = 0
+        self._devices_copy_lock = Lock()
         # init cache date multiprocessing for device_list
         self._cacheDB = None
+        # state published by the devices cache
+        self._cache_state = None
         if use_cache :
+            state_path = get_state_path(config)
+            if state_path is not None:
+                self._cache_state = CacheStateReader(state_path)
             CacheDB.register('get_cache')
             port_c = 40409 if not 'portcache' in self.__db_config else int(self.__db_config['portcache'])
             m = CacheDB(address=('localhost', port_c), authkey=b'{0}'.format(self.__db_config['password']))
@@ -286,6 +353,19 @@ class DbHelper(object):
         """Return DB type which is currently used (mysql, postgresql)"""
         return self.__db_config['type'].lower()
 
+    def get_sensor_history_partitions(self):
+        """Return the manager of the sensor history monthly partitions, within the current session
+
+        @return a SensorHistoryPartitions object, None if the partitions are not enabled in the configuration
+
+        """
+        if self.__db_config.get('history_partitioning', 'False').strip() != 'True':
+            return None
+        if self.get_db_type() not in ('mysql', 'postgresql'):
+            self.log.warning(u"The sensor history partitions are not supported with {0}".format(self.get_db_type()))
+            return None
+        return SensorHistoryPartitions(self.__session, self.get_db_type(), self.__db_config['prefix'], self.log)
+
     def _do_commit(self):
         try:
             self.__session.commit()
@@ -614,12 +694,15 @@ class DbHelper(object):
 ###
     def list_devices(self, d_state=u'active'):
         """Return a list of devices
-        @return a list of Device objects (only the devices that are known by this release)
+        @return a list of Device objects (only the devices that are known by this release).
+        The active devices may come from the devices cache : they must not be modified
         """
-        if d_state==u'active' and self._cacheDB and self._cacheDB.upToDateDevices() :
-            return self._cacheDB.getDevices()
+        if d_state==u'active' and self._cacheDB :
+            device_list = self._get_cached_devices()
+            if device_list is not None :
+                return device_list
         device_list = []
-        for device in self.__session.query(Device).filter_by(state=d_state).all():
+        for device in self.__session.query(Device).options(*_DEVICE_GRAPH).filter_by(state=d_state).all():
             device_list.append(self.get_device(device=device))
         if d_state==u'active':
             if self._cacheDB :
@@ -629,22 +712,157 @@ class DbHelper(object):
 
     def list_devices_by_plugin(self, p_id):
         #return self.__session.query(Device).filter_by(client_id=p_id).all()
-        if self._cacheDB and self._cacheDB.upToDateDevices(p_id) :
-            return self._cacheDB.getDevices(client_id=p_id)
+        if self._cacheDB :
+            device_list = self._get_cached_devices(p_id)
+            if device_list is not None :
+                return device_list
         device_list = []
-        for device in self.__session.query(Device).filter_by(state=u'active').filter_by(client_id=p_id).all():
+        for device in self.__session.query(Device).options(*_DEVICE_GRAPH).filter_by(state=u'active').filter_by(client_id=p_id).all():
             device_list.append(self.get_device(device=device))
         if self._cacheDB: self._cacheDB.updateDevices(device_list, client_id=p_id)
         return device_list
 
+    def _get_cached_devices(self, client_id=None):
+        """Return the devices (of a client) from the devices cache
+
+        Only the devices changed since the previous call are transferred from the cache,
+        the others are read from the local copy. The devices marked to update in the cache
+        are rebuilt, or the rebuild of another client of the cache is waited for
+
+        @param client_id : client id, None for all the devices
+        @return a list of devices, None if they are not in the cache
+
+        """
+        deadline = time.time() + DEVICES_REFRESH_TIMEOUT
+        with self._devices_copy_lock:
+            if self._devices_copy_up_to_date(client_id):
+                if not self._devices_copy_sensors_up_to_date():
+                    sensors = self._cacheDB.getSensorsChanges(self._devices_copy_version[0], self._devices_copy_sensors_version)
+                    if sensors is not None:
+                        self._patch_devices_copy(sensors)
+                        return self._copy_devices(client_id)
+                else:
+                    return self._copy_devices(client_id)
+            while True:
+                changes = self._cacheDB.getDevicesChanges(self._devices_copy_version[0], self._devices_copy_version[1], client_id,
+                                                          self._devices_copy_sensors_version)
+                if changes is None:
+                    return None
+                cache_id, version, full, devices, removed, refresh, sensors = changes
+                if full:
+                    self._devices_copy = {}
+                for dev in devices:
+                    self._devices_copy[dev['id']] = dev
+                for device_id in removed:
+                    self._devices_copy.pop(device_id, None)
+                self._devices_copy_version = (cache_id, version)
+                self._patch_devices_copy(sensors)
+                token, client_ids, device_ids, pending = refresh
+                if len(client_ids) == 0 and len(device_ids) == 0 and pending == 0:
+                    return self._copy_devices(client_id)
+                if time.time() > deadline:
+                    # the devices keep changing or other clients are too slow : read them from the database
+                    self.log.warning(u"Devices cache : timeout while refreshing {0} client(s) and {1} device(s), {2} rebuilt by other clients".format( \
+                                     len(client_ids), len(device_ids), pending))
+                    return None
+                if len(client_ids) > 0 or len(device_ids) > 0:
+                    self._cacheDB.refreshDevices(token, client_ids, device_ids,
+                                                 self._rebuild_devices(client_ids, device_ids), self._owner)
+                else:
+                    time.sleep(DEVICES_REFRESH_WAIT)
+
+    def _devices_copy_up_to_date(self, client_id=None):
+        """Check with the state published by the devices cache that the local copy of the devices is up to date
+
+        @param client_id : client id, None for all the devices
+        @return False if it is not up to date or if the state is not available
+
+        """
+        if self._cache_state is None:
+            return False
+        state = self._cache_state.read()
+        if state is None or state['cache_id'] != self._devices_copy_version[0] or state['version'] != self._devices_copy_version[1]:
+            return False
+        if client_id is None:
+            return state['up_to_date']
+        if client_id in state['clients']:
+            return state['clients'][client_id]
+        # the clients which are not in the state have no devices
+        return state['loaded']
+
+    def _devices_copy_sensors_up_to_date(self):
+        """Check with the state published by the devices cache that the sensors state of the local copy is up to date
+        """
+        state = self._cache_state.read()
+        return state is not None and state['sensors_version'] == self._devices_copy_sensors_version
+
+    def _patch_devices_copy(self, sensors):
+        """Apply the sensors state patched in the devices cache to the local copy
+           The patched devices are replaced by new dicts : the returned devices are not modified
+
+        @param sensors : (sensors version, list of (device id, sensor id, state)) from the devices cache
+
+        """
+        sensors_version, changes = sensors
+        patched = {}
+        for device_id, sensor_id, state in changes:
+            dev = patched.get(device_id)
+            if dev is None:
+                if device_id not in self._devices_copy:
+                    continue
+                dev = dict(self._devices_copy[device_id])
+                dev['sensors'] = dict(dev['sensors'])
+                patched[device_id] = dev
+            for key, sensor in dev['sensors'].items():
+                if sensor['id'] == sensor_id:
+                    dev['sensors'][key] = dict(sensor, **state)
+                    break
+        self._devices_copy.update(patched)
+        self._devices_copy_sensors_version = sensors_version
+
+    def _copy_devices(self, client_id=None):
+        """Return the devices (of a client) from the local copy of the devices cache
+        The device dicts are shared between the callers and must not be modified : a changed device
+        is replaced by a new dict in the local copy
+        """
+        return [self._devices_copy[device_id] for device_id in sorted(self._devices_copy)
+                if client_id is None or self._devices_copy[device_id]['client_id'] == client_id]
+
+    def _rebuild_devices(self, client_ids, device_ids):
+        """Return the active devices of some clients and some devices, read from the database
+
+        @param client_ids : client ids
+        @param device_ids : device ids
+        @return a list of devices
+
+        """
+        conditions = []
+        if len(client_ids) > 0:
+            conditions.append(Device.client_id.in_(client_ids))
+        if len(device_ids) > 0:
+            conditions.append(Device.id.in_(device_ids))
+        return [self.get_device(device=device) for device in
+                self.__session.query(Device).options(*_DEVICE_GRAPH).populate_existing() \
+                    .filter_by(state=u'active').filter(or_(*conditions)).all()]
+
     def list_devices_by_timestamp(self, tstamp):
         #return self.__session.query(Device).filter_by(client_id=p_id).all()
         device_list = []
-        for device in self.__session.query(Device).filter_by(state=u'active').filter(Device.info_changed>datetime.datetime.fromtimestamp(float(tstamp))).all():
+        for device in self.__session.query(Device).options(*_DEVICE_GRAPH).filter_by(state=u'active').filter(Device.info_changed>datetime.datetime.fromtimestamp(float(tstamp))).all():
             device_list.append(self.get_device(device=device))
         if self._cacheDB: self._cacheDB.updateDevices(device_list)
         return device_list
 
+    def get_devices_info_changed(self):
+        """Return the last change date of all the active devices
+
+        It is a light query to find the devices which changed since a previous call
+
+        @return a dict : device id => info_changed (datetime)
+
+        """
+        return dict(self.__session.query(Device.id, Device.info_changed).filter_by(state=u'active').all())
+
     def get_device_sql(self, d_id):
         return self.__session.query(Device).filter_by(id=d_id).first()
 
@@ -657,7 +875,7 @@ class DbHelper(object):
 
         """
         if device is None and d_id is not None:
-            device = self.__session.query(Device).filter_by(id=d_id).first()
+            device = self.__session.query(Device).options(*_DEVICE_GRAPH).filter_by(id=d_id).first()
 
         if device == None:
             return None
@@ -689,7 +907,9 @@ class DbHelper(object):
 
         # complete with sensors informations
         json_device['sensors'] = {}
+        sensor_references = {}
         for a_sensor in device.sensors:
+            sensor_references[a_sensor.id] = a_sensor.reference
             try:
                 json_sensor = { 'id' : a_sensor.id,
                                 'name' : a_sensor.name,
@@ -748,12 +968,7 @@ class DbHelper(object):
                 # - for the static parameters
                 for a_xplstat_param in a_xplstat.params:
                     if a_xplstat_param.static == False and a_xplstat_param.sensor_id is not None:
-                        if a_xplstat_param.sensor_id:
-                            for sen in device.sensors:
-                                if sen.id == a_xplstat_param.sensor_id:
-                                    sensor_name = sen.reference
-                        else:
-                            sensor_name = None
+                        sensor_name = sensor_references.get(a_xplstat_param.sensor_id)
                         json_xplstat['parameters']['dynamic'].append({ 'key' :  a_xplstat_param.key,
                                                                        'ignore_values' :  a_xplstat_param.ignore_values,
                                                                        'sensor_name': sensor_name
@@ -1168,171 +1383,804 @@ class DbHelper(object):
 # Sensor history
 ####
     def add_sensor_history(self, sid, sensor, value, date):
-        data = None
-        try:
-            self.__session.expire_all()
-            #sensor = self.__session.query(Sensor).filter_by(id=sid).first()
-            if sensor is not None:
+        """Store one value in the sensor history
 
+        @param sid : sensor id
+        @param sensor : the sensor informations (dict)
+        @param value : the value to store
+        @param date : the value timestamp
+        @return the stored value
 
-                ### get the last 2 value for the below analysis
-                last2 = self.__session.query(SensorHistory) \
-                    .filter(SensorHistory.sensor_id == sid) \
-                    .order_by(SensorHistory.date.desc()) \
-                    .limit(2).all()
-                #print("LAST={0}".format(last))
-                #LAST=[<SensorHistory: original_value_num='22.5', sensor_id='399', value_str='22.5', date='2016-09-27 22:39:04', id='29799954', value_num='22.5'>, <SensorHistory: original_value_num='22.5', sensor_id='399', value_str='22.5', date='2016-09-27 21:39:55', id='29797964', value_num='22.5'>]
-
+        """
+        return self.add_sensor_history_batch([{'sensor_id' : sid,
+                                               'sensor' : sensor,
+                                               'value' : value,
+                                               'date' : date}])[0]
+
+    def add_sensor_history_batch(self, items, windows=None, state_delay=0, sensor_states=None):
+        """Store several values in the sensor history within a single transaction
+
+        Incremental, formula, rounding, duplicate and min/max rules are the same as
+        for a single value. The values of a sensor must be given in chronological order.
+
+        The rules need the last 2 history rows of each sensor. A long running caller
+        can keep them in memory between the calls with the windows parameter : only
+        the sensors which are not in windows are read from the database, and windows
+        is updated once the values are commited.
+
+        The sensor dicts of items are not modified. The min and max are computed from
+        the sensor dict, or from sensor_states when the caller keeps the state of the
+        sensors between the calls : the sensors which are not in sensor_states are read
+        from the database, and sensor_states is updated once the values are commited.
+
+        The last value, last received date, min and max of the sensors are updated in
+        the sensor table. With state_delay, they are kept in memory and written by the
+        first call done state_delay seconds after the oldest kept state (or by
+        flush_sensor_states) : a sensor which sends a value each second is updated once
+        per state_delay seconds. The caller must then call flush_sensor_states before
+        leaving.
+
+        @param items : list of dicts with keys 'sensor_id', 'sensor', 'value', 'date'
+        @param windows : optional dict sensor id => last 2 history rows, the most recent first
+        @param state_delay : max time (in seconds) before the sensors state are written, 0 to write them now
+        @param sensor_states : optional dict sensor id => last value, last received date, min and max
+        @return the list of the stored values, in the same order as items
 
+        """
+        stored = [None] * len(items)
+        if len(items) == 0:
+            return stored
+        sid = value = date = None
+        # sensor id => sensor (to handle the history size once per sensor)
+        sensors = {}
+        try:
+            # Make sure previously modified objects outer of this method won't be commited
+            self.__session.expire_all()
+            # sensor id => last 2 history rows, the most recent first
+            batch_windows = {}
+            # sensor id => columns to update in the sensor table
+            states = {}
+            to_delete = []
+            to_insert = []
+            for idx, item in enumerate(items):
+                sid = item['sensor_id']
+                sensor = item['sensor']
+                value = item['value']
+                date = item['date']
+                if sensor is None:
+                    self.__raise_dbhelper_exception(u"Can not add history to not existing sensor: {0}".format(sid), True)
+                if sid not in batch_windows:
+                    ### get the last 2 value for the below analysis
+                    if windows is not None and sid in windows:
+                        # work on a copy : windows is updated only after the commit
+                        batch_windows[sid] = list(windows[sid])
+                    else:
+                        batch_windows[sid] = self._get_sensor_history_window(sid)
+                    sensors[sid] = sensor
+                window = batch_windows[sid]
 
                 ### Do some checks about incremental, formula, etc to calculate the value to store
-                orig_value = value
-                # check the sensorTypes
-                # sensor.type is absolute => do nothing
-                if sensor['incremental']:
-                    # get the last orig_value and substract value and orig_value and set the enw value
-                    #last = self.__session.query(SensorHistory) \
-                    #    .filter(SensorHistory.sensor_id == sid) \
-                    #    .order_by(SensorHistory.date.desc()) \
-                    #    .first()
-                    if len(last2) > 0 and last2[0] is not None:
-                        if last2[0].original_value_num is not None:
-                            value = float(value) - last2[0].original_value_num
-                    else:
-                        # set the begin value to 0
-                        value = 0
-
-                # handle formula if defined
-                if sensor['formula'] is not None and sensor['formula'] != '':
-                    form = sensor['formula'].replace('VALUE', str(value))
-                    try:
-                        newval = eval(form)
-                    except Exception as exp:
-                        newval = value
-                        self.log.warning("Failed to apply formula ({0}) to sensor ({1}): {2}".format(sensor['formula'], sensor, exp))
-                    value = newval
-
-                if sensor['history_round'] > 0:
-                    #last = self.__session.query(SensorHistory) \
-                    #    .filter(SensorHistory.sensor_id == sid) \
-                    #    .order_by(SensorHistory.date.desc()) \
-                    #    .limit(2) \
-                    #    .all()
-                    last = last2
-                    last.reverse()
-                    if last and len(last) == 2:
-                        delta = abs(float(last[0].value_num) - float(last[1].value_num))
-                        if delta < sensor['history_round']:
-                            delta0 = abs(float(value) - float(last[0].value_num))
-                            delta1 = abs(float(value) - float(last[1].value_num))
-                            if delta0 < sensor['history_round'] \
-                                    and delta1 < sensor['history_round']:
-                                self.__session.query(SensorHistory) \
-                                    .filter(SensorHistory.id == last[1].id) \
-                                    .delete()
+                # the rules of the sensor are compiled once and rebuilt only when the sensor changes
+                pipeline = self._sensor_pipelines.get(sensor)
+                value, orig_value = pipeline.compute(value, window)
 
+                # if the 2 last values and the new one are in the round range, the last one is useless
+                if pipeline.is_rounded(value, window):
+                    self._drop_sensor_history_row(window, to_delete, to_insert)
 
                 ### insert new recored in core_sensor_history
                 # store the history value if requested
-                if sensor['history_store']:
-                    if sensor['history_duplicate'] == 0:
-                        # get last 2 values
-                        #vals = self.__session.query(SensorHistory) \
-                        #        .filter(SensorHistory.sensor_id==sensor.id) \
-                        #        .order_by(SensorHistory.date.desc()) \
-                        #        .limit(2) \
-                        #        .all()
-                        vals = last2
-                        # vals[0] => last stored value
-                        # vals[1] => last-1 stored value
-                        if len(vals) == 2 and vals[0].value_str == vals[1].value_str == str(value):
-                            self.__session.delete(vals[0])
-                            # TODO : commit is done later in the function
-                            #self._do_commit()
+                if pipeline.history_store:
+                    # window[0] => last stored value
+                    # window[1] => last-1 stored value
+                    if pipeline.is_duplicate(value, window):
+                        self._drop_sensor_history_row(window, to_delete, to_insert)
                     # finally store the value
-                    h = SensorHistory(sensor['id'], datetime.datetime.fromtimestamp(date), value, orig_value=orig_value)
-                    self.__session.add(h)
-                    self._do_commit()
-                    # update the info changed
-                    #self.update_device(sensor['device_id'])
-                    #self._do_commit()
+                    row = self._make_sensor_history_row(sid, date, value, orig_value)
+                    to_insert.append(row)
+                    window.insert(0, row)
+                    del window[2:]
 
                 ### update time and value in the sensor table
-                #sensor_db = self.__session.query(Sensor).filter_by(id=sid).first()
-                #sensor_db.last_received = date
-                #sensor_db.last_value = ucode(value)
-                val = value
                 value_min = None
                 value_max = None
                 try:
                     val = float(value)
-                except ValueError:
-                    pass
-                except TypeError:
+                except (ValueError, TypeError):
                     pass
                 else:
-                    value_min = sensor['value_min']
-                    value_max = sensor['value_max']
-
+                    # the previous state : from this batch, the caller, the database or the sensor
+                    if sid in states:
+                        previous = states[sid]
+                    elif sensor_states is not None and sid in sensor_states:
+                        previous = sensor_states[sid]
+                    elif sensor_states is not None:
+                        previous = self._get_sensor_state(sid)
+                    else:
+                        previous = sensor
+                    value_min = previous['value_min']
+                    value_max = previous['value_max']
                     # update min/max
-                    if sensor['value_min'] > val:
+                    if value_min is None or value_min > val:
                         value_min = val
-                    if sensor['value_max'] < val:
+                    if value_max is None or value_max < val:
                         value_max = val
+                states[sid] = {'last_received' : date,
+                               'last_value' : ucode(value),
+                               'value_min' : value_min,
+                               'value_max' : value_max}
+                stored[idx] = ucode(value)
+
+            ### write everything at once
+            if len(to_delete) > 0:
+                self.__session.query(SensorHistory) \
+                    .filter(SensorHistory.id.in_([row['id'] for row in to_delete])) \
+                    .delete(synchronize_session=False)
+            # the rows kept in the windows get their id : a later call may delete them
+            self._insert_sensor_history_rows(to_insert, set(batch_windows) if windows is not None else set())
+            ### the sensors state, with the previous not written ones
+            pending = self._merge_sensor_states(self._sensor_states, states)
+            since = self._sensor_states_since if self._sensor_states_since is not None else time.time()
+            write_states = state_delay <= 0 or time.time() - since >= state_delay
+            if write_states:
+                self._write_sensor_states(pending)
+            # the history_max and history_expire rules are applied by the retention engine (dmg_cron)
+            # update the aggregates of the periods of the inserted and deleted rows
+            self._update_sensor_history_rollups(to_insert, to_delete)
+            self._do_commit()
+            if windows is not None:
+                for sid, window in batch_windows.items():
+                    if sensors[sid]['history_max'] > 0:
+                        del window[sensors[sid]['history_max']:]
+                    windows[sid] = window
+            if sensor_states is not None:
+                for sid, state in states.items():
+                    sensor_states[sid] = dict(state)
+            self.log.debug(u"Query sensor history : {0} value(s) stored for {1} sensor(s)".format(len(items), len(states)))
+            if write_states:
+                self._sensor_states = {}
+                self._sensor_states_since = None
+                self._patch_sensor_states_cache(pending)
+            else:
+                self._sensor_states = pending
+                self._sensor_states_since = since
+                # the cache is up to date before the states are written
+                self._patch_sensor_states_cache(dict([(sid, pending[sid]) for sid in states]))
+        except DbHelperException:
+            self._rollup_sensors.difference_update(sensors.keys())
+            raise
+        except:
+            if windows is not None:
+                # the windows of the batch sensors may not match the database any more : read them again next time
+                for sid in sensors:
+                    windows.pop(sid, None)
+            # the rollups state may have been rolled back
+            self._rollup_sensors.difference_update(sensors.keys())
+            self.__raise_dbhelper_exception(u"Error when adding data to sensor history. Sensor id = {0}  | Value = {1}  | Date = {2}. Error is {3}".format(sid, value, date, traceback.format_exc()))
+        return stored
+
+    def flush_sensor_states(self, delay=0):
+        """Write the sensors state kept in memory by add_sensor_history_batch (state_delay parameter)
+
+        @param delay : only write them if the oldest one is older than delay seconds
+        @return the number of updated sensors
+
+        """
+        if len(self._sensor_states) == 0 or time.time() - self._sensor_states_since < delay:
+            return 0
+        pending = self._sensor_states
+        try:
+            self.__session.expire_all()
+            self._write_sensor_states(pending)
+            self._do_commit()
+        except:
+            self.__raise_dbhelper_exception(u"Error when updating the state of the sensors {0}. Error is {1}".format(list(pending.keys()), traceback.format_exc()))
+        self._sensor_states = {}
+        self._sensor_states_since = None
+        # a device rebuilt from the database since the states were kept may not have them
+        self._patch_sensor_states_cache(pending)
+        return len(pending)
+
+    def _merge_sensor_states(self, pending, states):
+        """Add new sensors states to the not written ones
+
+        The most recent last value wins. The min and max are merged : the sensor
+        read meanwhile from the database (a devices reload) has older ones
+
+        @param pending : sensor id => not written state
+        @param states : sensor id => new state
+        @return the merged states
+
+        """
+        merged = dict(pending)
+        for sid, state in states.items():
+            held = merged.get(sid)
+            if held is not None:
+                state = dict(state)
+                for key, function in (('value_min', min), ('value_max', max)):
+                    values = [value for value in (held[key], state[key]) if value is not None]
+                    state[key] = function(values) if len(values) > 0 else None
+            merged[sid] = state
+        return merged
+
+    def _get_sensor_state(self, sid):
+        """Return the last value, last received date, min and max of a sensor
+        The state kept in memory and not yet written is more recent than the database one
+
+        @param sid : sensor id
+        @return a dict
+
+        """
+        sensor = self.__session.query(Sensor.last_value, Sensor.last_received, Sensor.value_min, Sensor.value_max) \
+                .filter(Sensor.id == sid).first()
+        state = {'last_value' : sensor.last_value if sensor is not None else None,
+                 'last_received' : sensor.last_received if sensor is not None else None,
+                 'value_min' : sensor.value_min if sensor is not None else None,
+                 'value_max' : sensor.value_max if sensor is not None else None}
+        return self._merge_sensor_states({sid : state}, {sid : self._sensor_states[sid]})[sid] \
+            if sid in self._sensor_states else state
+
+    def _write_sensor_states(self, states):
+        """Update the last value, last received date, min and max of some sensors, one query per sensor
+        The commit is done by the caller
+        @param states : sensor id => columns to update
+        """
+        for sid, state in states.items():
+            self.__session.query(Sensor).filter(Sensor.id == sid) \
+                                      .update(state, synchronize_session=False)
+
+    def _patch_sensor_states_cache(self, states):
+        """Update the state of the sensors in the devices cache, their devices stay up to date
+        @param states : sensor id => last value, last received date, min and max
+        """
+        if self._cacheDB and len(states) > 0:
+            self._cacheDB.patchSensors(dict([(int(sid), state) for sid, state in states.items()]))
+
+    def _get_sensor_history_window(self, sid):
+        """Return the last 2 history rows of a sensor, the most recent first
+
+        @param sid : sensor id
+        @return a list of dicts
+
+        """
+        window = []
+        for a_value in self.__session.query(SensorHistory.id, SensorHistory.date, SensorHistory.value_num,
+                                            SensorHistory.value_str, SensorHistory.original_value_num) \
+                .filter(SensorHistory.sensor_id == sid) \
+                .order_by(SensorHistory.date.desc()) \
+                .limit(2).all():
+            window.append({'id' : a_value.id,
+                           'sensor_id' : sid,
+                           'date' : a_value.date,
+                           'value_num' : a_value.value_num,
+                           'value_str' : a_value.value_str,
+                           'original_value_num' : a_value.original_value_num})
+        return window
+
+    def _make_sensor_history_row(self, sid, date, value, orig_value):
+        """Build a core_sensor_history row, the same way SensorHistory() does
+
+        @return a dict with the columns values
+
+        """
+        row = {'sensor_id' : sid,
+               'date' : datetime.datetime.fromtimestamp(date),
+               'value_num' : None,
+               'value_str' : ucode(value),
+               'original_value_num' : None}
+        try:
+            row['value_num'] = float(value)
+            row['original_value_num'] = float(orig_value)
+        except ValueError:
+            pass
+        except TypeError:
+            pass
+        return row
+
+    def _insert_sensor_history_rows(self, rows, sids):
+        """Insert history rows with a single statement and set the id of the rows of some sensors
+
+        With postgresql the ids are returned by the insert. Else the ids are read with one
+        query on the ids range of the insert : the values of a sensor are stored by a single
+        caller, so its rows of this range are the inserted ones, in the insert order.
+        The commit is done by the caller
+
+        @param rows : the rows to insert (dicts)
+        @param sids : ids of the sensors whose rows need their id
+
+        """
+        if len(rows) == 0:
+            return
+        table = SensorHistory.__table__
+        if self.get_db_type() == 'postgresql':
+            result = self.__session.execute(table.insert().values(rows).returning(table.c.id))
+            for row, inserted in zip(rows, result.fetchall()):
+                row['id'] = inserted[0]
+            return
+        sids = set([row['sensor_id'] for row in rows if row['sensor_id'] in sids])
+        last_id = self.__session.query(func.max(SensorHistory.id)).scalar() if len(sids) > 0 else None
+        self.__session.execute(table.insert(), rows)
+        if len(sids) == 0:
+            return
+        ids = {}
+        query = self.__session.query(SensorHistory.id, SensorHistory.sensor_id) \
+                .filter(SensorHistory.sensor_id.in_(sids))
+        if last_id is not None:
+            query = query.filter(SensorHistory.id > last_id)
+        for inserted in query.order_by(SensorHistory.id):
+            ids.setdefault(inserted.sensor_id, []).append(inserted.id)
+        for sid in sids:
+            sensor_rows = [row for row in rows if row['sensor_id'] == sid]
+            # another caller stored values of the sensor meanwhile : its rows stay without id and are never deleted
+            if len(ids.get(sid, [])) == len(sensor_rows):
+                for row, row_id in zip(sensor_rows, ids[sid]):
+                    row['id'] = row_id
+
+    def _drop_sensor_history_row(self, window, to_delete, to_insert):
+        """Forget the most recent row of a sensor history window
+
+        The row is deleted if it is already in the database, else it is not inserted
+
+        """
+        row = window.pop(0)
+        if 'id' in row:
+            to_delete.append(row)
+        else:
+            for idx, a_row in enumerate(to_insert):
+                if a_row is row:
+                    del to_insert[idx]
+                    break
+
+    def list_sensors_retention(self):
+        """Return the sensors with a history_max or history_expire rule and the progress of their cleanup
+
+        @return a list of dicts with the keys 'id', 'history_max', 'history_expire', 'last_run', 'last_id', 'total_deleted'
+
+        """
+        sensors = []
+        for sen, retention in self.__session.query(Sensor, SensorRetention) \
+                .outerjoin(SensorRetention, SensorRetention.sensor_id == Sensor.id) \
+                .filter(or_(Sensor.history_max > 0, Sensor.history_expire > 0)) \
+                .order_by(Sensor.id).all():
+            sensors.append({'id' : sen.id,
+                            'history_max' : sen.history_max or 0,
+                            'history_expire' : sen.history_expire or 0,
+                            'last_run' : retention.last_run if retention else None,
+                            'last_id' : retention.last_id if retention else None,
+                            'total_deleted' : retention.total_deleted if retention else 0})
+        return sensors
+
+    def get_sensor_history_purge_date(self, sensor):
+        """Return the date before which the history of a sensor can be deleted
+
+        The history_max rule keeps at least the history_max most recent values (more if
+        several values have the same date), the history_expire rule keeps the values of
+        the last history_expire days
+
+        @param sensor : dict with the keys 'id', 'history_max' and 'history_expire'
+        @return a datetime (the values with a lower date are deleted) or None if nothing has to be deleted
+
+        """
+        limit = None
+        if sensor['history_max'] > 0:
+            oldest_kept = self.__session.query(SensorHistory.date) \
+                    .filter(SensorHistory.sensor_id == sensor['id']) \
+                    .order_by(SensorHistory.date.desc()) \
+                    .offset(sensor['history_max'] - 1) \
+                    .limit(1).first()
+            if oldest_kept is not None:
+                limit = oldest_kept.date
+        if sensor['history_expire'] > 0:
+            stamp = datetime.datetime.now() - datetime.timedelta(days=sensor['history_expire'])
+            if limit is None or stamp > limit:
+                limit = stamp
+        return limit
+
+    def list_sensor_history_sensors(self, frm, to):
+        """Return the ids of the sensors which have some history values in a date range
+
+        @param frm : range start (datetime, included)
+        @param to : range end (datetime, excluded)
 
-                self.__session.query(Sensor).filter(Sensor.id == sid) \
-                                          .update({'last_received' : date,
-                                                    'last_value' : ucode(value),
-                                                    'value_min' : value_min,
-                                                    'value_max' : value_max})
+        """
+        return [a_value.sensor_id for a_value in self.__session.query(SensorHistory.sensor_id) \
+                .filter(SensorHistory.date >= frm, SensorHistory.date < to) \
+                .distinct().all()]
+
+    def delete_sensor_history_chunk(self, sid, date, chunk_size):
+        """Delete the oldest values of a sensor history, by primary key range
+
+        @param sid : sensor id
+        @param date : the values with a lower date are deleted
+        @param chunk_size : maximum number of values to delete
+        @return (number of deleted values, last deleted id)
+
+        """
+        values = self.__session.query(SensorHistory.id, SensorHistory.date) \
+                .filter(SensorHistory.sensor_id == sid, SensorHistory.date < date) \
+                .order_by(SensorHistory.id) \
+                .limit(chunk_size).all()
+        if len(values) == 0:
+            return 0, None
+        deleted = self.__session.query(SensorHistory) \
+            .filter(SensorHistory.sensor_id == sid, \
+                    SensorHistory.id >= values[0].id, \
+                    SensorHistory.id <= values[-1].id, \
+                    SensorHistory.date < date) \
+            .delete(synchronize_session=False)
+        self._compute_sensor_history_rollups(sid, set([floor_date(a_value.date, 'minute') for a_value in values]))
+        self._do_commit()
+        return deleted, values[-1].id
+
+    def _compute_sensor_history_rollups(self, sid, minutes):
+        """Compute again the rollups of a sensor after some of its history rows were deleted
+           Each level is read with one query, the periods without any value left are deleted at once
+           The commit is done by the caller
+
+        @param sid : sensor id
+        @param minutes : set of the minutes where history rows were deleted
+
+        """
+        if sid not in self._rollup_sensors \
+           and self.__session.query(SensorRollup.sensor_id).filter_by(sensor_id=sid).first() is None:
+            # no rollup for this sensor yet : the backfill will read the remaining history
+            return
+        buckets = minutes
+        for level in ROLLUP_LEVELS:
+            buckets = set([floor_date(bucket, level) for bucket in buckets])
+            start = min(buckets)
+            end = next_date(max(buckets), level)
+            aggregates = {}
+            if level == 'minute':
+                for a_value in self.__session.query(SensorHistory.date, SensorHistory.value_num) \
+                        .filter(SensorHistory.sensor_id == sid, SensorHistory.date >= start, SensorHistory.date < end):
+                    bucket = floor_date(a_value.date, level)
+                    if bucket in buckets:
+                        merge_aggregate(aggregates.setdefault(bucket, [0, 0, None, None, None]), new_aggregate(a_value.value_num))
+            else:
+                finer = _ROLLUP_TABLES[ROLLUP_LEVELS[ROLLUP_LEVELS.index(level) - 1]]
+                for row in self.__session.query(finer.date, finer.row_count, finer.value_count,
+                                                finer.value_sum, finer.value_min, finer.value_max) \
+                        .filter(finer.sensor_id == sid, finer.date >= start, finer.date < end):
+                    bucket = floor_date(row[0], level)
+                    if bucket in buckets:
+                        merge_aggregate(aggregates.setdefault(bucket, [0, 0, None, None, None]), row[1:])
+            table = _ROLLUP_TABLES[level]
+            empty = sorted([bucket for bucket in buckets if bucket not in aggregates])
+            for idx in range(0, len(empty), 500):
+                self.__session.query(table) \
+                    .filter(table.sensor_id == sid, table.date.in_(empty[idx:idx + 500])) \
+                    .delete(synchronize_session=False)
+            for bucket, aggregate in aggregates.items():
+                self._write_rollup_bucket(table, sid, bucket, aggregate)
+
+    def delete_sensor_history_rollups(self, start, end):
+        """Delete the rollups of all the sensors in a date range, after the history of this range was dropped
+
+        @param start : range start (included), the start of a month
+        @param end : range end (excluded), the start of a month
+
+        """
+        for level in ROLLUP_LEVELS:
+            table = _ROLLUP_TABLES[level]
+            self.__session.query(table).filter(table.date >= start, table.date < end) \
+                .delete(synchronize_session=False)
+        self._do_commit()
+
+    def update_sensor_retention(self, sid, last_id, deleted, finished=True):
+        """Record the progress of the cleanup of a sensor history
+
+        @param sid : sensor id
+        @param last_id : last deleted id (None if nothing was deleted)
+        @param deleted : number of values deleted by this run
+        @param finished : False if the cleanup was stopped before the end, the last run date is then cleared
+
+        """
+        retention = self.__session.query(SensorRetention).filter_by(sensor_id=sid).first()
+        if retention is None:
+            retention = SensorRetention(sid)
+            self.__session.add(retention)
+        retention.last_run = datetime.datetime.now() if finished else None
+        if last_id is not None:
+            retention.last_id = last_id
+        retention.last_deleted = deleted
+        retention.total_deleted = (retention.total_deleted or 0) + deleted
+        self._do_commit()
+
+    def _update_sensor_history_rollups(self, to_insert, to_delete):
+        """Update the rollups of the periods where history rows were added or deleted
+           The aggregates of the added rows are added to their periods, with a few statements
+           for all the sensors. The periods where rows were deleted are computed again.
+           The commit is done by the caller
+
+        @param to_insert : the inserted history rows (dicts)
+        @param to_delete : the deleted history rows (dicts)
+
+        """
+        # sensor id => minutes to compute again
+        recompute = {}
+        for row in to_delete:
+            recompute.setdefault(row['sensor_id'], set()).add(floor_date(row['date'], 'minute'))
+        minutes = {}
+        for row in to_insert:
+            minutes.setdefault(row['sensor_id'], set()).add(floor_date(row['date'], 'minute'))
+        for sid in set(minutes) | set(recompute):
+            if self._init_sensor_rollup(sid, min(minutes.get(sid, set()) | recompute.get(sid, set()))):
+                # the periods of the first values may have older values
+                recompute.setdefault(sid, set()).update(minutes.get(sid, set()))
+        for level in ROLLUP_LEVELS:
+            skipped = set([(sid, floor_date(minute, level)) for sid in recompute for minute in recompute[sid]])
+            aggregates = {}
+            for row in to_insert:
+                key = (row['sensor_id'], floor_date(row['date'], level))
+                if key not in skipped:
+                    merge_aggregate(aggregates.setdefault(key, [0, 0, None, None, None]), new_aggregate(row['value_num']))
+            self._add_rollup_aggregates(_ROLLUP_TABLES[level], aggregates)
+        for sid in sorted(recompute):
+            self._compute_sensor_history_rollups(sid, recompute[sid])
+
+    def _add_rollup_aggregates(self, table, aggregates):
+        """Add aggregates to the periods of a rollup table : one query to find the existing periods,
+           one update for all of them and one insert for the new ones
+           The commit is done by the caller
+
+        @param table : rollup table
+        @param aggregates : dict (sensor id, period start) => aggregate to add
+
+        """
+        if len(aggregates) == 0:
+            return
+        existing = set([(row.sensor_id, row.date) for row in
+                        self.__session.query(table.sensor_id, table.date)
+                            .filter(table.sensor_id.in_(set([sid for sid, date in aggregates])),
+                                    table.date.in_(set([date for sid, date in aggregates])))])
+        updates = []
+        inserts = []
+        for (sid, date), aggregate in sorted(aggregates.items()):
+            if (sid, date) in existing:
+                updates.append({'b_sensor_id' : sid,
+                                'b_date' : date,
+                                'b_row_count' : aggregate[0],
+                                'b_value_count' : aggregate[1],
+                                'b_value_sum' : aggregate[2],
+                                'b_value_min' : aggregate[3],
+                                'b_value_max' : aggregate[4]})
+            else:
+                inserts.append({'sensor_id' : sid,
+                                'date' : date,
+                                'row_count' : aggregate[0],
+                                'value_count' : aggregate[1],
+                                'value_sum' : aggregate[2],
+                                'value_min' : aggregate[3],
+                                'value_max' : aggregate[4]})
+        if len(updates) > 0:
+            columns = table.__table__.c
+            value_sum = bindparam('b_value_sum', type_=columns.value_sum.type)
+            value_min = bindparam('b_value_min', type_=columns.value_min.type)
+            value_max = bindparam('b_value_max', type_=columns.value_max.type)
+            # LEAST/GREATEST do not exist with sqlite and return NULL with a NULL argument on mysql
+            update = table.__table__.update() \
+                .where(and_(columns.sensor_id == bindparam('b_sensor_id'), columns.date == bindparam('b_date'))) \
+                .values(row_count=columns.row_count + bindparam('b_row_count'),
+                        value_count=columns.value_count + bindparam('b_value_count'),
+                        value_sum=case([(columns.value_sum == None, value_sum),
+                                        (value_sum != None, columns.value_sum + value_sum)],
+                                       else_=columns.value_sum),
+                        value_min=case([(columns.value_min == None, value_min),
+                                        (value_min < columns.value_min, value_min)],
+                                       else_=columns.value_min),
+                        value_max=case([(columns.value_max == None, value_max),
+                                        (value_max > columns.value_max, value_max)],
+                                       else_=columns.value_max))
+            self.__session.execute(update, updates)
+        if len(inserts) > 0:
+            self.__session.execute(table.__table__.insert(), inserts)
+
+    def _init_sensor_rollup(self, sid, first_minute):
+        """Create the rollups state of a sensor when its first value is stored by this version
+
+        If the sensor has older values, the rollups are complete only from first_minute
+        until the history is backfilled
+
+        @return True if the state was created : the periods of the first values are then computed from the history
 
-                # synchronize_session=False
+        """
+        if sid in self._rollup_sensors:
+            return False
+        created = self.__session.query(SensorRollup).filter_by(sensor_id=sid).first() is None
+        if created:
+            older = self.__session.query(SensorHistory.id) \
+                    .filter(SensorHistory.sensor_id == sid, SensorHistory.date < first_minute) \
+                    .first()
+            self.__session.add(SensorRollup(sid, first_minute if older is not None else None))
+            self.__session.flush()
+        self._rollup_sensors.add(sid)
+        return created
 
-                #self.__session.add(sensor_db)
-                data = ucode(value)
+    def _refresh_rollup_bucket(self, sid, level, start):
+        """Compute again a period of a rollup table, from the finer rollup (or the history for the minutes)
+           The commit is done by the caller
+        """
+        end = next_date(start, level)
+        if level == 'minute':
+            row = self.__session.query(func.count(SensorHistory.id), func.count(SensorHistory.value_num),
+                                       func.sum(SensorHistory.value_num), func.min(SensorHistory.value_num),
+                                       func.max(SensorHistory.value_num)) \
+                    .filter(SensorHistory.sensor_id == sid, SensorHistory.date >= start, SensorHistory.date < end) \
+                    .one()
+        else:
+            finer = _ROLLUP_TABLES[ROLLUP_LEVELS[ROLLUP_LEVELS.index(level) - 1]]
+            row = self.__session.query(func.sum(finer.row_count), func.sum(finer.value_count),
+                                       func.sum(finer.value_sum), func.min(finer.value_min),
+                                       func.max(finer.value_max)) \
+                    .filter(finer.sensor_id == sid, finer.date >= start, finer.date < end) \
+                    .one()
+        # sum() of integers is a decimal with mysql
+        aggregate = [int(row[0] or 0), int(row[1] or 0), row[2], row[3], row[4]]
+        self._write_rollup_bucket(_ROLLUP_TABLES[level], sid, start, aggregate)
+
+    def _write_rollup_bucket(self, table, sid, start, aggregate):
+        """Insert, update or delete (no more history row) a period of a rollup table
+        """
+        if aggregate[0] == 0:
+            self.__session.query(table).filter(table.sensor_id == sid, table.date == start) \
+                .delete(synchronize_session=False)
+            return
+        values = {'row_count' : aggregate[0],
+                  'value_count' : aggregate[1],
+                  'value_sum' : aggregate[2] if aggregate[1] else None,
+                  'value_min' : aggregate[3] if aggregate[1] else None,
+                  'value_max' : aggregate[4] if aggregate[1] else None}
+        updated = self.__session.query(table).filter(table.sensor_id == sid, table.date == start) \
+            .update(values, synchronize_session=False)
+        if updated == 0:
+            values['sensor_id'] = sid
+            values['date'] = start
+            self.__session.execute(table.__table__.insert(), values)
+
+    def list_sensors_rollup_to_backfill(self):
+        """Return the ids of the sensors whose history is not yet in the rollup tables
+        """
+        complete = set([state.sensor_id for state in self.__session.query(SensorRollup.sensor_id) \
+                .filter(SensorRollup.rollup_from == None).all()])
+        return [sen.id for sen in self.__session.query(Sensor.id).order_by(Sensor.id).all() if sen.id not in complete]
+
+    def backfill_sensor_history_rollups(self, sid):
+        """Compute the rollups of the history stored before the rollups were maintained
+
+        The history is read month by month, with a commit after each month.
+        The store path may add values meanwhile : they are after the backfilled range.
+
+        @param sid : sensor id
+        @return the number of history rows read
+
+        """
+        self.__session.expire_all()
+        state = self.__session.query(SensorRollup).filter_by(sensor_id=sid).first()
+        if state is None:
+            # the next stored values will be handled by the store path
+            state = SensorRollup(sid, ceil_date(datetime.datetime.now(), 'minute'))
+            self.__session.add(state)
+            self._do_commit()
+        elif state.rollup_from is None:
+            return 0
+        end = state.rollup_from
+        first = self.__session.query(func.min(SensorHistory.date)) \
+                .filter(SensorHistory.sensor_id == sid, SensorHistory.date < end) \
+                .scalar()
+        count = 0
+        if first is not None:
+            month = floor_date(first, 'month')
+            while month < end:
+                count += self._backfill_rollup_range(sid, month, min(next_date(month, 'month'), end), end)
                 self._do_commit()
-                self.log.debug(u"Query sensor {0} stored last receive {1} : {2}".format(sid, date, ucode(value)))
-                if self._cacheDB: self._cacheDB.markAsUpdatingDevices(sensor_id=sensor['id'])
-#                self.log.debug(u"markAsUpdatingDevices sensor {0} <stored last receive> : {1}".format(sensor['id'], value))
-
-                ### handle the history size in number of items
-                # TODO : move in a dedicated function which would be called each... ??? hours ???
-                if sensor['history_max'] > 0:
-                    count = self.__session.query(SensorHistory).filter_by(sensor_id=sensor['id']).count()
-                    if count > sensor['history_max']:
-                        # delete from sensor_history where id not in (select id from sensor_history order by date desc limit x)
-                        tokeep1 = self.__session.query(SensorHistory.id) \
-                                .filter(SensorHistory.sensor_id==sensor['id']) \
-                                .order_by(SensorHistory.date.desc()) \
-                                .limit(sensor['history_max']) \
-                                .subquery()
-                        # ugly fix because mysql is not supporting limit in a subquery
-                        tokeep2 = self.__session.query(tokeep1).subquery()
-                        self.__session.query(SensorHistory) \
-                            .filter( \
-                                        SensorHistory.sensor_id==sensor['id'], \
-                                        ~SensorHistory.id.in_(tokeep2) \
-                                    ) \
-                            .delete(synchronize_session=False)
-                        self._do_commit()
-
-                ### handle the history size in days
-                # TODO : move in a dedicated function which would be called each day or N hours
-                if sensor['history_expire'] > 0:
-                    stamp = datetime.datetime.now() - datetime.timedelta(days=sensor['history_expire'])
-                    self.__session.query(SensorHistory) \
-                        .filter( \
-                                    SensorHistory.date<=stamp, \
-                                    SensorHistory.sensor_id==sensor['id'] \
-                                ) \
-                        .delete(synchronize_session=False)
-                    self._do_commit()
+                month = next_date(month, 'month')
+        state.rollup_from = None
+        self.__session.add(state)
+        self._do_commit()
+        self.log.info(u"Sensor {0} : rollups computed for {1} history rows".format(sid, count))
+        return count
+
+    def _backfill_rollup_range(self, sid, start, stop, end):
+        """Compute the rollups of the history between start and stop (included in a month)
+           The commit is done by the caller
+
+        @param end : the date from which the rollups are maintained by the store path
+        @return the number of history rows read
+
+        """
+        count = 0
+        aggregates = {}
+        for a_value in self.__session.query(SensorHistory.date, SensorHistory.value_num) \
+                .filter(SensorHistory.sensor_id == sid, SensorHistory.date >= start, SensorHistory.date < stop) \
+                .yield_per(10000):
+            minute = floor_date(a_value.date, 'minute')
+            if minute not in aggregates:
+                aggregates[minute] = [0, 0, None, None, None]
+            merge_aggregate(aggregates[minute], new_aggregate(a_value.value_num))
+            count += 1
+        for level in ROLLUP_LEVELS:
+            if level != 'minute':
+                finer = aggregates
+                aggregates = {}
+                for date, aggregate in finer.items():
+                    bucket = floor_date(date, level)
+                    if bucket not in aggregates:
+                        aggregates[bucket] = [0, 0, None, None, None]
+                    merge_aggregate(aggregates[bucket], aggregate)
+            # the periods which end after the end date also have some values from the store path
+            limit = floor_date(end, level)
+            table = _ROLLUP_TABLES[level]
+            self.__session.query(table) \
+                .filter(table.sensor_id == sid, table.date >= start, table.date < min(stop, limit)) \
+                .delete(synchronize_session=False)
+            rows = [{'sensor_id' : sid,
+                     'date' : date,
+                     'row_count' : aggregate[0],
+                     'value_count' : aggregate[1],
+                     'value_sum' : aggregate[2],
+                     'value_min' : aggregate[3],
+                     'value_max' : aggregate[4]} for date, aggregate in sorted(aggregates.items()) if date < limit]
+            if len(rows) > 0:
+                self.__session.execute(table.__table__.insert(), rows)
+            if start <= limit < stop:
+                self._refresh_rollup_bucket(sid, level, limit)
+        return count
+
+    def _list_sensors_rollup_covering(self, sids, start):
+        """Return the sensors whose rollups include all the values since a date
+        """
+        return [state.sensor_id for state in self.__session.query(SensorRollup).filter(SensorRollup.sensor_id.in_(sids))
+                if state.rollup_from is None or start >= state.rollup_from]
+
+    def _iter_sensors_rollup_aggregates(self, sids, start, end, level):
+        """Read the aggregates of some sensors between 2 dates, using the rollups up to a level
 
+        The periods fully in the range are read from the rollup of the level, the partial periods
+        at the range bounds from the finer rollups and from the history.
+        Each part of the range is read with one query for all the sensors.
+
+        @return generator of (sensor id, period start, aggregate), by part of the range and date
+
+        """
+        for part_level, range_start, range_end in cover_range(start, end, level):
+            if part_level is None:
+                for a_value in self.__session.query(SensorHistory.sensor_id, SensorHistory.date, SensorHistory.value_num) \
+                        .filter(SensorHistory.sensor_id.in_(sids), SensorHistory.date >= range_start, SensorHistory.date < range_end) \
+                        .order_by(SensorHistory.date).all():
+                    yield a_value.sensor_id, a_value.date, new_aggregate(a_value.value_num)
             else:
-                self.__raise_dbhelper_exception(u"Can not add history to not existing sensor: {0}".format(sid), True)
-        except:
-            self.__raise_dbhelper_exception(u"Error when adding data to sensor history. Sensor id = {0}  | Value = {1}  | Date = {2}. Error is {3}".format(sid, value, date, traceback.format_exc()))
-        return data
+                table = _ROLLUP_TABLES[part_level]
+                for a_value in self.__session.query(table.sensor_id, table.date, table.row_count, table.value_count,
+                                                    table.value_sum, table.value_min, table.value_max) \
+                        .filter(table.sensor_id.in_(sids), table.date >= range_start, table.date < range_end) \
+                        .order_by(table.date).all():
+                    yield a_value[0], a_value[1], a_value[2:]
+
+    def _list_sensors_history_rollup(self, sids, frm, to, step_used, function_used):
+        """Compute a history filter of some sensors from the rollup tables
+
+        @return sensor id => same result as list_sensor_history_filter, for the sensors whose rollups cover the range
+
+        """
+        start = datetime.datetime.fromtimestamp(frm)
+        end = datetime.datetime.fromtimestamp(to)
+        sids = self._list_sensors_rollup_covering(sids, start)
+        if len(sids) == 0:
+            return {}
+        keys = dict([(sid, []) for sid in sids])
+        groups = dict([(sid, {}) for sid in sids])
+        for sid, date, aggregate in self._iter_sensors_rollup_aggregates(sids, start, end, STEP_LEVELS[step_used]):
+            key = group_key(date, step_used)
+            if key not in groups[sid]:
+                keys[sid].append(key)
+                groups[sid][key] = [0, 0, None, None, None]
+            merge_aggregate(groups[sid][key], aggregate)
+        self.log.debug(u"Query sensors {0} history filter from the rollups".format(sids))
+        results = {}
+        for sid in sids:
+            results[sid] = _history_result([(list(key), groups[sid][key]) for key in keys[sid]], function_used)
+        return results
 
     def list_sensor_history(self, sid, num=100):
         """ Max values per default : 100
@@ -1344,27 +2192,105 @@ class DbHelper(object):
                            "timestamp" : time.mktime(a_value.date.timetuple()) })
         return values
 
-    def list_sensor_history_between(self, sid, frm, to=None):
+    def _check_sensor_history_range(self, frm, to):
+        """Check a history range, return the end timestamp (now if not set)
+        """
         if to:
             if to < frm:
                 self.__raise_dbhelper_exception(u"'end_date' can't be prior to 'start_date'")
         else:
             to = int(time.time())
-        values = []
+        return to
+
+    def _query_sensor_history_between(self, session, sid, frm, to):
+        """Return the query of the (date, value_num, value_str) of a sensor between 2 timestamps
+        """
         self.log.debug(u"Query sensor {0} history between {1} and {2}".format(sid, _datetime_string_from_tstamp(frm), _datetime_string_from_tstamp(to)))
-        for a_value in self.__session.query(SensorHistory
-#                  ).filter(SensorHistory.date.between(_datetime_string_from_tstamp(frm), _datetime_string_from_tstamp(to))
+        return session.query(SensorHistory.date, SensorHistory.value_num, SensorHistory.value_str
                   ).filter(SensorHistory.date>=_datetime_string_from_tstamp(frm)
                   ).filter(SensorHistory.date<=_datetime_string_from_tstamp(to)
                   ).filter(SensorHistory.sensor_id==sid
-                  ).order_by(sqlalchemy.asc(SensorHistory.date)
-                  ).all():
+                  ).order_by(sqlalchemy.asc(SensorHistory.date))
+
+    def list_sensor_history_between(self, sid, frm, to=None):
+        to = self._check_sensor_history_range(frm, to)
+        values = []
+        for a_value in self._query_sensor_history_between(self.__session, sid, frm, to).all():
             values.append({"value_str" : a_value.value_str,
                            "value_num" : a_value.value_num,
                            "timestamp" : time.mktime(a_value.date.timetuple()) })
         return values
 
+    def list_sensors_history_between(self, sids, frm, to=None):
+        """Return the history of some sensors between 2 timestamps, with one query for all the sensors
+
+        @param sids : list of sensor ids
+        @return sensor id (int) => list of values, like list_sensor_history_between
+
+        """
+        to = self._check_sensor_history_range(frm, to)
+        sids = [int(sid) for sid in sids]
+        values = dict([(sid, []) for sid in sids])
+        if len(sids) == 0:
+            return values
+        self.log.debug(u"Query sensors {0} history between {1} and {2}".format(sids, _datetime_string_from_tstamp(frm), _datetime_string_from_tstamp(to)))
+        for a_value in self.__session.query(SensorHistory.sensor_id, SensorHistory.date, SensorHistory.value_num, SensorHistory.value_str
+                  ).filter(SensorHistory.date>=_datetime_string_from_tstamp(frm)
+                  ).filter(SensorHistory.date<=_datetime_string_from_tstamp(to)
+                  ).filter(SensorHistory.sensor_id.in_(sids)
+                  ).order_by(sqlalchemy.asc(SensorHistory.sensor_id), sqlalchemy.asc(SensorHistory.date)
+                  ).all():
+            values[a_value.sensor_id].append({"value_str" : a_value.value_str,
+                                              "value_num" : a_value.value_num,
+                                              "timestamp" : time.mktime(a_value.date.timetuple()) })
+        return values
+
+    def iter_sensor_history_between(self, sid, frm, to=None, chunk_size=10000, points=None):
+        """Return an iterator on the history of a sensor between 2 timestamps, the oldest value first
+
+        Unlike list_sensor_history_between, the values are fetched by chunks (with a server side
+        cursor if the database driver supports it) as (timestamp, value_num, value_str) tuples,
+        so the memory used doesn't depend on the size of the range.
+        The iterator uses its own session, closed once the iterator is exhausted or closed :
+        it can be consumed after the caller session is closed (in a streamed response).
+
+        @param sid : sensor id
+        @param frm : start timestamp
+        @param to : end timestamp, now if not set
+        @param chunk_size : number of values fetched at once
+        @param points : if set, the values are downsampled to this number of values (see downsampling.lttb)
+
+        """
+        to = self._check_sensor_history_range(frm, to)
+        return self._iter_sensor_history_between(sid, frm, to, chunk_size, points)
+
+    def _iter_sensor_history_between(self, sid, frm, to, chunk_size, points):
+        session = DbHelper.__session_object.session_factory()
+        try:
+            query = self._query_sensor_history_between(session, sid, frm, to)
+            # yield_per also sets the stream_results option : the rows are not all buffered by the driver
+            values = ((time.mktime(a_value.date.timetuple()), a_value.value_num, a_value.value_str) \
+                      for a_value in query.yield_per(chunk_size))
+            if points:
+                count = query.with_entities(func.count(SensorHistory.id)).order_by(None).scalar()
+                self.log.debug(u"Sensor {0} history : {1} values downsampled to {2}".format(sid, count, points))
+                values = lttb(values, count, points)
+            for a_value in values:
+                yield a_value
+        finally:
+            session.close()
+
     def list_sensor_history_filter(self, sid, frm, to, step_used, function_used):
+        return self.list_sensors_history_filter([sid], frm, to, step_used, function_used).get(int(sid))
+
+    def list_sensors_history_filter(self, sids, frm, to, step_used, function_used):
+        """Compute the history filter of some sensors
+        Each query is done once for all the sensors (sensor_id IN (...))
+
+        @param sids : list of sensor ids
+        @return sensor id (int) => {'values' : [...], 'global_values' : {'min', 'max', 'avg', 'sum'}}
+
+        """
         if not frm:
             self.__raise_dbhelper_exception(u"You have to provide a start date")
         if to:
@@ -1376,6 +2302,14 @@ class DbHelper(object):
             self.__raise_dbhelper_exception(u"'function_used' parameter should be one of : min, max, avg, sum")
         if step_used is None or step_used.lower() not in ('minute', 'hour', 'day', 'week', 'month', 'year'):
             self.__raise_dbhelper_exception(u"'period' parameter should be one of : minute, hour, day, week, month, year")
+        step_used = step_used.lower()
+        function_used = function_used.lower()
+        sids = [int(sid) for sid in sids]
+        # read the aggregates from the rollup tables when they cover the range
+        results = self._list_sensors_history_rollup(sids, frm, to, step_used, function_used)
+        sids = [sid for sid in sids if sid not in results]
+        if len(sids) == 0:
+            return results
         function = {
             'min': func.min(SensorHistory.value_num),
             'max': func.max(SensorHistory.value_num),
@@ -1499,20 +2433,23 @@ class DbHelper(object):
                             function['min'], function['max'], function['avg'], function['sum']
                         )
         }
-        self.log.debug(u"Query sensor {0} history filter : {1}".format(sid, sql_query))
+        self.log.debug(u"Query sensors {0} history filter : {1}".format(sids, sql_query))
         if self.get_db_type() in ('mysql', 'postgresql'):
-            cond_min = "date >= '" + _datetime_string_from_tstamp(frm) + "'"
-            cond_max = "date < '" + _datetime_string_from_tstamp(to) + "'"
+            # native date conditions : the (sensor_id, date) index is used
+            cond_min = SensorHistory.date >= datetime.datetime.fromtimestamp(frm)
+            cond_max = SensorHistory.date < datetime.datetime.fromtimestamp(to)
 #            cond_min = "date >= STR_TO_DATE('" + _datetime_string_from_tstamp(frm) + "','%Y-%m-%d %H:%i:%s')"
 #            cond_max = "date < STR_TO_DATE('" + _datetime_string_from_tstamp(to) + "','%Y-%m-%d %H:%i:%s')"
-            query = sql_query[step_used][self.get_db_type()]
-            query = query.filter_by(sensor_id=sid
+            query = sql_query[step_used][self.get_db_type()].add_columns(SensorHistory.sensor_id)
+            query = query.filter(SensorHistory.sensor_id.in_(sids)
                         ).filter(cond_min
-                        ).filter(cond_max)
-            results_global = sql_query['global'].filter_by(sensor_id=sid
+                        ).filter(cond_max
+                        ).group_by(SensorHistory.sensor_id)
+            results_global = sql_query['global'].add_columns(SensorHistory.sensor_id
+                                               ).filter(SensorHistory.sensor_id.in_(sids)
                                                ).filter(cond_min
                                                ).filter(cond_max
-                                               ).first()
+                                               ).group_by(SensorHistory.sensor_id)
 #            query = query.filter(cond_min
 #                        ).filter(cond_max
 #                        ).filter(SensorHistory.sensor_id==sid)
@@ -1537,16 +2474,103 @@ class DbHelper(object):
 #                                            ).filter(cond_max
 #                                            ).filter(SensorHistory.sensor_id==sid
 #                                            ).first()
-            return {
-                'values': query.all(),
-                'global_values': {
-                    'min': results_global[0],
-                    'max': results_global[1],
-                    'avg': results_global[2],
-                    'sum': results_global[3]
+            for sid in sids:
+                results[sid] = {
+                    'values': [],
+                    'global_values': {
+                        'min': None,
+                        'max': None,
+                        'avg': None,
+                        'sum': None
+                    }
+                }
+            # the sensor id is the last column
+            for a_value in query.all():
+                results[a_value[-1]]['values'].append(tuple(a_value[:-1]))
+            for a_value in results_global.all():
+                results[a_value[-1]]['global_values'] = {
+                    'min': a_value[0],
+                    'max': a_value[1],
+                    'avg': a_value[2],
+                    'sum': a_value[3]
                 }
-            }
+        return results
+
 
+    def list_sensor_history_buckets(self, sid, frm, to, width, function_used):
+        return self.list_sensors_history_buckets([sid], frm, to, width, function_used).get(int(sid))
+
+    def list_sensors_history_buckets(self, sids, frm, to, width, function_used):
+        """Compute the min, max, avg or sum of the history of some sensors by buckets of any duration
+
+        The buckets are width seconds long and start at the beginning of the day of frm, so
+        the 15 minutes buckets start at :00, :15, ... When width is a multiple of a minute and
+        the rollups cover the range, the values are read from the rollups. Else they are
+        grouped by the database by bucket number, computed from the seconds since the first
+        bucket. The dates are only filtered with ranges, so the (sensor_id, date) index is used.
+
+        @param sids : list of sensor ids
+        @param width : duration of the buckets, in seconds
+        @return sensor id (int) => {'values' : [[bucket start timestamp, value], ...], 'global_values' : {'min', 'max', 'avg', 'sum'}}
+
+        """
+        if not frm:
+            self.__raise_dbhelper_exception(u"You have to provide a start date")
+        to = self._check_sensor_history_range(frm, to)
+        if function_used is None or function_used.lower() not in ('min', 'max', 'avg', 'sum'):
+            self.__raise_dbhelper_exception(u"'function_used' parameter should be one of : min, max, avg, sum")
+        try:
+            width = int(width)
+        except (TypeError, ValueError):
+            width = 0
+        if width <= 0:
+            self.__raise_dbhelper_exception(u"'width' parameter should be a number of seconds")
+        function_used = function_used.lower()
+        sids = [int(sid) for sid in sids]
+        start = datetime.datetime.fromtimestamp(frm)
+        end = datetime.datetime.fromtimestamp(to)
+        origin = bucket_origin(start)
+        buckets = dict([(sid, {}) for sid in sids])
+        level = bucket_level(width)
+        rollup_sids = self._list_sensors_rollup_covering(sids, start) if level is not None else []
+        if len(rollup_sids) > 0:
+            for sid, date, aggregate in self._iter_sensors_rollup_aggregates(rollup_sids, start, end, level):
+                delta = date - origin
+                idx = (delta.days * 86400 + delta.seconds) // width
+                if idx not in buckets[sid]:
+                    buckets[sid][idx] = [0, 0, None, None, None]
+                merge_aggregate(buckets[sid][idx], aggregate)
+        other_sids = [sid for sid in sids if sid not in rollup_sids]
+        if len(other_sids) > 0:
+            for a_value in self._query_sensors_history_buckets(other_sids, start, end, origin, width):
+                buckets[a_value[0]][int(a_value[1])] = list(a_value[2:])
+        self.log.debug(u"Query sensors {0} history by buckets of {1}s ({2} from the rollups)".format(sids, width, rollup_sids))
+        results = {}
+        for sid in sids:
+            results[sid] = _history_result([([time.mktime((origin + datetime.timedelta(seconds=idx * width)).timetuple())], buckets[sid][idx]) \
+                                            for idx in sorted(buckets[sid])], function_used)
+        return results
+
+    def _query_sensors_history_buckets(self, sids, start, end, origin, width):
+        """Return the query of the aggregates of the history by bucket
+        @return query of (sensor id, bucket number, row_count, value_count, value_sum, value_min, value_max)
+        """
+        db_type = self.get_db_type()
+        if db_type == 'mysql':
+            bucket = func.floor(func.timestampdiff(sqlalchemy.text('SECOND'), origin, SensorHistory.date) / width)
+        elif db_type == 'postgresql':
+            bucket = func.floor(extract('epoch', SensorHistory.date - origin) / width)
+        else:
+            # sqlite : the dates are after the origin, the integer division is the floor
+            bucket = (func.strftime('%s', SensorHistory.date) - func.strftime('%s', origin)) / width
+        # grouped by the label : the expression would be rendered with other parameters
+        return self.__session.query(SensorHistory.sensor_id, bucket.label('bucket'),
+                                    func.count(SensorHistory.id), func.count(SensorHistory.value_num),
+                                    func.sum(SensorHistory.value_num), func.min(SensorHistory.value_num), func.max(SensorHistory.value_num)
+                        ).filter(SensorHistory.sensor_id.in_(sids)
+                        ).filter(SensorHistory.date >= start
+                        ).filter(SensorHistory.date < end
+                        ).group_by(SensorHistory.sensor_id, sqlalchemy.text('bucket'))
 
 ####
 # User accounts
@@ -2433,6 +3457,17 @@ class DbHelper(object):
                                 .update()
                                 .values(sensor_id=mObj.newId)
                                 .where(sensor_id=mObj.oldId))
+        # the rollups of both sensors are wrong now : they are computed again by the store path
+        # for the next values and by the backfill (dmg_rollup) for the older ones
+        for sid in (mObj.oldId, mObj.newId):
+            for table in _ROLLUP_TABLES.values():
+                self.__session.query(table).filter(table.sensor_id == sid).delete(synchronize_session=False)
+        self.__session.query(SensorRollup).filter(SensorRollup.sensor_id == mObj.oldId).delete(synchronize_session=False)
+        state = self.__session.query(SensorRollup).filter_by(sensor_id=mObj.newId).first()
+        if state is None:
+            state = SensorRollup(mObj.newId, None)
+            self.__session.add(state)
+        state.rollup_from = ceil_date(datetime.datetime.now(), 'minute')
         # set the migrate object as Done
         self.__session.delete(mObj)
         # commit
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+
+""" This file is part of B{Domogik} project (U{http://www.domogik.org}).
+
+License
+=======
+
+B{Domogik} is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+B{Domogik} is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Domogik. If not, see U{http://www.gnu.org/licenses}.
+
+Module purpose
+==============
+
+In memory model of the devices, sensors, xpl stats and commands used by xplgw
+
+The model is loaded once from the database. Then, on a device change, only
+the changed devices are read again : the device given in the device.update
+event and the devices whose info_changed date changed.
+
+The data is published as a read-only DeviceSnapshot. A reload builds a new
+snapshot (the unchanged items are shared with the previous one) and replaces
+the current one at once, so the threads read the snapshot without any lock
+and always see a consistent version of the devices.
+
+Implements
+==========
+
+- DeviceSnapshot
+- DeviceModel
+
+@author: Domogik project
+@copyright: (C) 2007-2019 Domogik project
+@license: GPL(v3)
+@organization: Domogik
+"""
+
+import threading
+import time
+
+from domogik.common.database import DbHelper
+from domogik.common.sensorpipeline import compile_ignore_values
+
+# min time (in seconds) between 2 checks of the devices changes for unknown sensors
+SYNC_MIN_INTERVAL = 5
+
+
+class DeviceSnapshot(object):
+    """ A version of the devices, sensors, xpl stats and commands, by id (str)
+        A snapshot is never changed once published : the dicts and their items must not be modified
+    """
+    __slots__ = ['version', 'devices', 'sensors', 'xpl_stats', 'commands', 'info_changed']
+
+    def __init__(self, version, devices, sensors, xpl_stats, commands, info_changed):
+        """ @param version : snapshot number, incremented on each change
+            @param devices : device id => {'client_id', 'id', 'name'} (active devices only)
+            @param sensors : sensor id => sensor informations
+            @param xpl_stats : xpl stat id => xpl stat informations and params
+            @param commands : command id => command informations, params and xpl command
+            @param info_changed : device id (int) => info_changed of the loaded device
+        """
+        self.version = version
+        self.devices = devices
+        self.sensors = sensors
+        self.xpl_stats = xpl_stats
+        self.commands = commands
+        self.info_changed = info_changed
+
+
+class DeviceModel(object):
+    """ Build the devices snapshots
+        The readers get the current snapshot with the snapshot attribute and keep it
+        while they need a consistent view of the devices
+    """
+
+    def __init__(self, log, owner="device model"):
+        """ Load the model from the database
+            @param log : logger
+            @param owner : DbHelper owner name
+        """
+        self.log = log
+        self._db = DbHelper(owner=owner)
+        # the loads may be requested by several threads : they share the same database session
+        # and a snapshot must be built from the last published one
+        self._load_lock = threading.RLock()
+        self.snapshot = DeviceSnapshot(0, {}, {}, {}, {}, {})
+        # ignore_values source => parsed ignore list
+        self._ignore_lists = {}
+        self._last_sync = 0
+        self.reload()
+
+    def _publish(self, devices, sensors, xpl_stats, commands, info_changed):
+        """ Replace the current snapshot. The caller must hold the load lock
+        """
+        # a single assignment : the readers get either the old or the new snapshot
+        self.snapshot = DeviceSnapshot(self.snapshot.version + 1, devices, sensors, xpl_stats, commands, info_changed)
+
+    def reload(self):
+        """ Load all the devices
+        """
+        self.log.info(u"Loading all the devices, sensors, xpl stats and commands")
+        with self._load_lock, self._db.session_scope():
+            info_changed = self._db.get_devices_info_changed()
+            devices = {}
+            for dev in self._db.list_devices():
+                devices[str(dev['id'])] = self._make_device(dev['id'], dev['client_id'], dev['name'])
+            sensors = {}
+            for sen in self._db.get_all_sensor():
+                sensors[str(sen.id)] = self._make_sensor(sen)
+            xpl_stats = {}
+            for xplstat in self._db.get_all_xpl_stat():
+                xpl_stats[str(xplstat.id)] = self._make_xpl_stat(xplstat)
+            commands = {}
+            for cmd in self._db.get_all_command():
+                commands[str(cmd.id)] = self._make_command(cmd)
+            self._publish(devices, sensors, xpl_stats, commands, info_changed)
+            self._last_sync = time.time()
+        self.log.info(u"Loaded {0} devices, {1} sensors, {2} xpl stats and {3} commands".format( \
+                len(devices), len(sensors), len(xpl_stats), len(commands)))
+
+    def reload_device(self, device_id):
+        """ Read again a device and its sensors, xpl stats and commands
+            @param device_id : device id
+            @return the ids (str) of the sensors of the device, before and after the reload
+        """
+        device_id = int(device_id)
+        self.log.info(u"Reloading the device {0}".format(device_id))
+        with self._load_lock, self._db.session_scope():
+            device = self._db.get_device_sql(device_id)
+            if device is not None and device.state == u'active':
+                new_device = self._make_device(device.id, device.client_id, device.name)
+            else:
+                new_device = None
+            sensors = {}
+            for sen in self._db.get_sensor_by_device_id(device_id):
+                sensors[str(sen.id)] = self._make_sensor(sen)
+            xpl_stats = {}
+            for xplstat in self._db.get_xpl_stat_by_device_id(device_id):
+                xpl_stats[str(xplstat.id)] = self._make_xpl_stat(xplstat)
+            commands = {}
+            for cmd in self._db.get_command_by_device_id(device_id):
+                commands[str(cmd.id)] = self._make_command(cmd)
+            # copy on write : the current snapshot may be in use
+            current = self.snapshot
+            changed_sensors = set(sensors.keys())
+            changed_sensors.update([an_id for an_id, item in current.sensors.items() if item['device_id'] == device_id])
+            new_sets = []
+            for data, new_data in [(current.sensors, sensors), (current.xpl_stats, xpl_stats), (current.commands, commands)]:
+                data = dict([(an_id, item) for an_id, item in data.items() if item['device_id'] != device_id])
+                data.update(new_data)
+                new_sets.append(data)
+            devices = dict(current.devices)
+            info_changed = dict(current.info_changed)
+            if new_device is None:
+                devices.pop(str(device_id), None)
+                info_changed.pop(device_id, None)
+            else:
+                devices[str(device_id)] = new_device
+                info_changed[device_id] = device.info_changed
+            self._publish(devices, new_sets[0], new_sets[1], new_sets[2], info_changed)
+        return changed_sensors
+
+    def sync(self, force=True):
+        """ Reload the devices created, changed or deleted since the last load
+            The changes are found with the info_changed date of the devices
+            @param force : if False, nothing is done if the last check is more recent than SYNC_MIN_INTERVAL
+            @return the ids (str) of the sensors of the changed devices
+        """
+        changed_sensors = set()
+        with self._load_lock:
+            if not force and time.time() - self._last_sync < SYNC_MIN_INTERVAL:
+                return changed_sensors
+            self._last_sync = time.time()
+            with self._db.session_scope():
+                info_changed = self._db.get_devices_info_changed()
+            known = self.snapshot.info_changed
+            changed = [device_id for device_id in info_changed if known.get(device_id) != info_changed[device_id]]
+            changed.extend([device_id for device_id in known if device_id not in info_changed])
+            for device_id in changed:
+                changed_sensors.update(self.reload_device(device_id))
+        if len(changed) > 0:
+            self.log.info(u"{0} device(s) reloaded : {1}".format(len(changed), changed))
+        return changed_sensors
+
+    def _make_device(self, device_id, client_id, name):
+        """ Return the device informations used by xplgw
+        """
+        return {'client_id': client_id,
+                'id': device_id,
+                'name': name}
+
+    def _make_sensor(self, sen):
+        """ Return the informations of a Sensor
+        """
+        #<Sensor: conversion='', value_min='None', history_round='0.0', reference='adco', data_type='DT_String', history_duplicate='False', last_received='1474968431', incremental='False', id='29', history_expire='0', timeout='180', history_store='True', history_max='0', formula='None', device_id='2', last_value='030928084432', value_max='3.09036843008e+11', name='Electric meter address'>
+        return {'id' : sen.id,
+                'conversion' : sen.conversion,
+                'value_min' : sen.value_min,
+                'history_round' : sen.history_round,
+                'reference' : sen.reference,
+                'data_type' : sen.data_type,
+                'history_duplicate' : sen.history_duplicate,
+                'last_received' : sen.last_received,
+                'incremental' : sen.incremental,
+                'history_expire' : sen.history_expire,
+                'timeout' : sen.timeout,
+                'history_store' : sen.history_store,
+                'history_max' : sen.history_max,
+                'formula' : sen.formula,
+                'device_id' : sen.device_id,
+                'last_value' : sen.last_value,
+                'value_max' : sen.value_max,
+                'name' : sen.name}
+
+    def _make_xpl_stat(self, xplstat):
+        """ Return the informations of a XplStat and its params
+            The ignore_values of the params are parsed once
+        """
+        # <XplStat: name='Open/Close sensor', json_id='open_close', device_id='95', id='185', schema='ac.basic'>
+        # <XplStatParam: xplstat_id='188', multiple='None', value='None', ignore_values='', sensor_id='411', static='False', key='current', type='None'>
+        a_xplstat = {'name' : xplstat.name,
+                     'json_id' : xplstat.json_id,
+                     'device_id' : xplstat.device_id,
+                     'id' : xplstat.id,
+                     'schema' : xplstat.schema,
+                     'params' : []
+                    }
+        for a_xplstat_param in xplstat.params:
+            ignore_values = a_xplstat_param.ignore_values
+            if ignore_values not in self._ignore_lists:
+                self._ignore_lists[ignore_values] = compile_ignore_values(ignore_values)
+            a_xplstat['params'].append({
+                                         'xplstat_id' : a_xplstat_param.xplstat_id,
+                                         'multiple' : a_xplstat_param.multiple,
+                                         'value' : a_xplstat_param.value,
+                                         'ignore_values' : ignore_values,
+                                         'ignore_list' : self._ignore_lists[ignore_values],
+                                         'sensor_id' : a_xplstat_param.sensor_id,
+                                         'static' : a_xplstat_param.static,
+                                         'key' : a_xplstat_param.key,
+                                         'type' : a_xplstat_param.type
+                                       })
+        return a_xplstat
+
+    def _make_command(self, cmd):
+        """ Return the informations of a Command, its params and its xpl command
+        """
+        #<Command: return_confirmation='True', name='Swith', reference='switch_lighting2', id='6', device_id='21'>
+        #[<CommandParam: data_type='DT_Trigger', conversion='', cmd_id='16', key='state'>]
+        a_command = {'return_confirmation' : cmd.return_confirmation,
+                     'name' : cmd.name,
+                     'reference' : cmd.reference,
+                     'id' : cmd.id,
+                     'device_id' : cmd.device_id,
+                     'xpl_command' : None,
+                     'params' : []
+                    }
+        for param in cmd.params:
+            a_command['params'].append({'data_type' : param.data_type,
+                                        'conversion' : param.conversion,
+                                        'cmd_id' : param.cmd_id,
+                                        'key' : param.key
+                                       })
+        #<XplCommand: name='Switch', stat_id='82', cmd_id='6', json_id='switch_lighting2', device_id='21', id='6', schema='ac.basic'>
+        #<XplCommandParam: value='0x0038abfc', key='address', xplcmd_id='6'>
+        if cmd.xpl_command != None:
+            xpl_command = {'name' : cmd.xpl_command.name,
+                           'stat_id' : cmd.xpl_command.stat_id,
+                           'cmd_id' : cmd.xpl_command.cmd_id,
+                           'json_id' : cmd.xpl_command.json_id,
+                           'device_id' : cmd.xpl_command.device_id,
+                           'id' : cmd.xpl_command.id,
+                           'schema' : cmd.xpl_command.schema,
+                           'params' : []
+                          }
+            for param in cmd.xpl_command.params:
+                xpl_command['params'].append({'value' : param.value,
+                                              'key' : param.key,
+                                              'xplcmd_id' : param.xplcmd_id})
+            a_command['xpl_command'] = xpl_command
+        return a_command
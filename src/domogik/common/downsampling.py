@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+""" This file is part of B{Domogik} project (U{http://www.domogik.org}).
+
+License
+=======
+
+B{Domogik} is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+B{Domogik} is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Domogik. If not, see U{http://www.gnu.org/licenses}.
+
+Module purpose
+==============
+
+Downsampling of the sensor history for the charts
+
+The Largest-Triangle-Three-Buckets algorithm keeps the first and the last
+values and, in each bucket of values between them, the value which makes
+the largest triangle with the value kept in the previous bucket and the
+average of the next bucket : the peaks are kept.
+
+The values are read in a single pass : only 2 buckets are in memory.
+
+Implements
+==========
+
+- lttb
+
+@author: Domogik project
+@copyright: (C) 2007-2019 Domogik project
+@license: GPL(v3)
+@organization: Domogik
+"""
+
+from itertools import islice
+
+
+def _average(bucket):
+    """ Return the average (timestamp, value_num) of a bucket, the value is None if no value is a number
+    """
+    x_sum = 0.0
+    y_sum = 0.0
+    y_count = 0
+    for value in bucket:
+        x_sum += value[0]
+        if value[1] is not None:
+            y_sum += value[1]
+            y_count += 1
+    return x_sum / len(bucket), (y_sum / y_count if y_count > 0 else None)
+
+def lttb(values, count, points):
+    """ Downsample history values with the Largest-Triangle-Three-Buckets algorithm
+
+        @param values : iterator on (timestamp, value_num, ...) tuples, the oldest first
+        @param count : number of values. If the iterator gives more or less values, the
+                       result is still valid but has more or less values in its last buckets
+        @param points : number of values to keep, at least 3
+        @return generator of the kept values
+
+    """
+    points = max(points, 3)
+    values = iter(values)
+    if count <= points:
+        for value in values:
+            yield value
+        return
+    previous = next(values, None)
+    if previous is None:
+        return
+    yield previous
+    # the values between the first and the last ones are split in points - 2 buckets
+    every = float(count - 2) / (points - 2)
+    end = int(every) + 1
+    bucket = list(islice(values, end - 1))
+    for idx in range(points - 2):
+        if idx < points - 3:
+            next_end = int((idx + 2) * every) + 1
+            next_bucket = list(islice(values, next_end - end))
+            end = next_end
+        else:
+            # the last value (and the values added since the count)
+            next_bucket = list(values)
+        if len(bucket) == 0:
+            bucket = next_bucket
+            continue
+        if len(next_bucket) == 0:
+            # less values than expected : the last value of the bucket is the last one
+            next_bucket = [bucket.pop()]
+            if len(bucket) == 0:
+                bucket = next_bucket
+                break
+        avg_x, avg_y = _average(next_bucket)
+        prev_x, prev_y = previous[0], previous[1]
+        if prev_y is None:
+            prev_y = avg_y
+        selected = bucket[0]
+        max_area = -1
+        if prev_y is not None and avg_y is not None:
+            for value in bucket:
+                if value[1] is not None:
+                    # twice the area of the triangle
+                    area = abs((prev_x - avg_x) * (value[1] - prev_y) - (prev_x - value[0]) * (avg_y - prev_y))
+                    if area > max_area:
+                        max_area = area
+                        selected = value
+        yield selected
+        previous = selected
+        bucket = next_bucket
+    if len(bucket) > 0:
+        yield bucket[-1]
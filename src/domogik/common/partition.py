@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+""" This file is part of B{Domogik} project (U{http://www.domogik.org}).
+
+License
+=======
+
+B{Domogik} is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+B{Domogik} is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Domogik. If not, see U{http://www.gnu.org/licenses}.
+
+Module purpose
+==============
+
+Monthly partitions of the sensor history table
+
+This is optional (history_partitioning option of the [database] section).
+With mysql, the table is partitioned by RANGE on TO_DAYS(date), with a last
+'pmax' partition. With postgresql, it becomes a declarative partitioned
+table (postgresql >= 11) with a default partition. In both cases, the
+primary key is (id, date) and the foreign key to the sensors is removed,
+as the partitioned tables don't support them (the history of a deleted
+device is deleted by DbHelper.del_device_real).
+
+The table is converted by the database installer (db_install.py) after the
+alembic upgrade. Then dmg_cron creates the partitions of the next months
+and drops the expired partitions (see retention.py).
+
+Implements
+==========
+
+- SensorHistoryPartitions
+- month_start
+- add_months
+
+@author: Domogik project
+@copyright: (C) 2007-2019 Domogik project
+@license: GPL(v3)
+@organization: Domogik
+"""
+
+import datetime
+import re
+
+from sqlalchemy import text
+
+# number of months for which the partitions are created ahead
+PARTITIONS_AHEAD = 3
+
+_PARTITION_NAME = re.compile(r'p(\d{4})(\d{2})$')
+
+
+def month_start(date):
+    """ Return the first day of the month of a date
+    """
+    return datetime.datetime(date.year, date.month, 1)
+
+def add_months(date, months):
+    """ Return the first day of the month, some months later
+    """
+    month = date.year * 12 + date.month - 1 + months
+    return datetime.datetime(month // 12, month % 12 + 1, 1)
+
+
+class SensorHistoryPartitions(object):
+    """ Manage the monthly partitions of the sensor history table
+    """
+
+    def __init__(self, connection, db_type, prefix, log):
+        """ Init
+            @param connection : sqlalchemy connection or session used to run the queries
+            @param db_type : mysql or postgresql
+            @param prefix : tables prefix
+            @param log : logger
+        """
+        if db_type not in ('mysql', 'postgresql'):
+            raise ValueError(u"The sensor history partitions are not supported with {0}".format(db_type))
+        self._conn = connection
+        self._db_type = db_type
+        self._table = '{0}_sensor_history'.format(prefix)
+        self._sensor_table = '{0}_sensor'.format(prefix)
+        self.log = log
+
+    def _execute(self, sql, **params):
+        return self._conn.execute(text(sql), params)
+
+    def _partition_name(self, month):
+        if self._db_type == 'mysql':
+            return 'p{0:04d}{1:02d}'.format(month.year, month.month)
+        return '{0}_p{1:04d}{2:02d}'.format(self._table, month.year, month.month)
+
+    def is_partitioned(self):
+        """ Check if the sensor history table is partitioned
+        """
+        if self._db_type == 'mysql':
+            return self._execute("SELECT COUNT(*) FROM information_schema.PARTITIONS " \
+                                 "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table " \
+                                 "AND PARTITION_NAME IS NOT NULL", table=self._table).scalar() > 0
+        return self._execute("SELECT COUNT(*) FROM pg_partitioned_table pt " \
+                             "JOIN pg_class c ON c.oid = pt.partrelid WHERE c.relname = :table",
+                             table=self._table).scalar() > 0
+
+    def list_partitions(self):
+        """ Return the monthly partitions, the oldest first
+            @return list of (partition name, month start, next month start)
+        """
+        if self._db_type == 'mysql':
+            names = [row[0] for row in self._execute("SELECT PARTITION_NAME FROM information_schema.PARTITIONS " \
+                                                     "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table " \
+                                                     "AND PARTITION_NAME IS NOT NULL", table=self._table)]
+        else:
+            names = [row[0] for row in self._execute("SELECT c.relname FROM pg_inherits i " \
+                                                     "JOIN pg_class c ON c.oid = i.inhrelid " \
+                                                     "JOIN pg_class p ON p.oid = i.inhparent " \
+                                                     "WHERE p.relname = :table", table=self._table)]
+        partitions = []
+        for name in names:
+            found = _PARTITION_NAME.search(name)
+            if found:
+                month = datetime.datetime(int(found.group(1)), int(found.group(2)), 1)
+                partitions.append((name, month, add_months(month, 1)))
+        partitions.sort(key=lambda partition: partition[1])
+        return partitions
+
+    def enable(self, ahead=PARTITIONS_AHEAD):
+        """ Convert the sensor history table to a partitioned table
+            The existing values are kept. This may take a long time on a large table
+            @param ahead : number of months for which the partitions are created ahead
+        """
+        if self.is_partitioned():
+            return
+        first = self._execute("SELECT MIN(date) FROM {0}".format(self._table)).scalar()
+        now = month_start(datetime.datetime.now())
+        first = month_start(first) if first is not None and first < now else now
+        months = []
+        month = first
+        while month <= add_months(now, ahead):
+            months.append(month)
+            month = add_months(month, 1)
+        self.log.info(u"Partitioning the table {0} by month, from {1} to {2}".format(self._table, months[0], months[-1]))
+        if self._db_type == 'mysql':
+            for fk in [row[0] for row in self._execute("SELECT CONSTRAINT_NAME FROM information_schema.KEY_COLUMN_USAGE " \
+                                                       "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table " \
+                                                       "AND REFERENCED_TABLE_NAME IS NOT NULL", table=self._table)]:
+                self._execute("ALTER TABLE {0} DROP FOREIGN KEY {1}".format(self._table, fk))
+            self._execute("ALTER TABLE {0} DROP PRIMARY KEY, ADD PRIMARY KEY (id, date)".format(self._table))
+            partitions = ["PARTITION {0} VALUES LESS THAN (TO_DAYS('{1}'))".format(self._partition_name(month), add_months(month, 1).date()) \
+                          for month in months]
+            partitions.append("PARTITION pmax VALUES LESS THAN MAXVALUE")
+            self._execute("ALTER TABLE {0} PARTITION BY RANGE (TO_DAYS(date)) ({1})".format(self._table, ", ".join(partitions)))
+        else:
+            old = '{0}_unpartitioned'.format(self._table)
+            self._execute("ALTER TABLE {0} RENAME TO {1}".format(self._table, old))
+            self._execute("CREATE TABLE {0} (LIKE {1} INCLUDING DEFAULTS) PARTITION BY RANGE (date)".format(self._table, old))
+            self._execute("CREATE TABLE {0}_pdefault PARTITION OF {0} DEFAULT".format(self._table))
+            for month in months:
+                self._create_partition(month)
+            self._execute("INSERT INTO {0} SELECT * FROM {1}".format(self._table, old))
+            # the id sequence belongs to the old table
+            self._execute("ALTER SEQUENCE {0}_id_seq OWNED BY NONE".format(self._table))
+            self._execute("DROP TABLE {0}".format(old))
+            self._execute("ALTER SEQUENCE {0}_id_seq OWNED BY {0}.id".format(self._table))
+            self._execute("ALTER TABLE {0} ADD PRIMARY KEY (id, date)".format(self._table))
+            self._execute("CREATE INDEX siddate ON {0} (sensor_id, date)".format(self._table))
+            self._execute("CREATE INDEX ix_{0}_date ON {0} (date)".format(self._table))
+            self._execute("CREATE INDEX ix_{0}_sensor_id ON {0} (sensor_id)".format(self._table))
+
+    def _create_partition(self, month):
+        """ Create the partition of a month
+        """
+        name = self._partition_name(month)
+        if self._db_type == 'mysql':
+            # the new partition is split from pmax, which is empty if the partitions are created ahead
+            self._execute("ALTER TABLE {0} REORGANIZE PARTITION pmax INTO (" \
+                          "PARTITION {1} VALUES LESS THAN (TO_DAYS('{2}')), " \
+                          "PARTITION pmax VALUES LESS THAN MAXVALUE)".format(self._table, name, add_months(month, 1).date()))
+        else:
+            self._execute("CREATE TABLE {0} PARTITION OF {1} FOR VALUES FROM ('{2}') TO ('{3}')".format( \
+                          name, self._table, month, add_months(month, 1)))
+        self.log.info(u"Partition {0} of {1} created".format(name, self._table))
+
+    def create_partitions(self, ahead=PARTITIONS_AHEAD):
+        """ Create the missing partitions, until ahead months after the current one
+            @return the names of the created partitions
+        """
+        partitions = self.list_partitions()
+        month = add_months(partitions[-1][1], 1) if len(partitions) > 0 else month_start(datetime.datetime.now())
+        created = []
+        while month <= add_months(month_start(datetime.datetime.now()), ahead):
+            self._create_partition(month)
+            created.append(self._partition_name(month))
+            month = add_months(month, 1)
+        return created
+
+    def drop_partition(self, name):
+        """ Drop a partition and all its values
+        """
+        if self._db_type == 'mysql':
+            self._execute("ALTER TABLE {0} DROP PARTITION {1}".format(self._table, name))
+        else:
+            self._execute("DROP TABLE {0}".format(name))
+        self.log.info(u"Partition {0} of {1} dropped".format(name, self._table))
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+""" This file is part of B{Domogik} project (U{http://www.domogik.org}).
+
+License
+=======
+
+B{Domogik} is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+B{Domogik} is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Domogik. If not, see U{http://www.gnu.org/licenses}.
+
+Module purpose
+==============
+
+Retention of the sensors history
+
+The history_max and history_expire rules of the sensors are not applied
+when a value is stored any more. They are applied here, for each sensor
+at most once per interval, by deleting the old values in small chunks
+(one transaction per chunk) so the tables are never locked for long.
+The progress of each sensor is recorded in core_sensor_retention.
+
+When the sensor history table is partitioned by month, the partitions of
+the next months are created, and the partitions whose values are all
+expired for all their sensors are dropped instead of deleting the rows.
+
+The rollups (by minute, hour, day and month) of the deleted values are
+computed again, or deleted with the dropped partitions.
+
+Implements
+==========
+
+- SensorHistoryRetention
+
+@author: Domogik project
+@copyright: (C) 2007-2019 Domogik project
+@license: GPL(v3)
+@organization: Domogik
+"""
+
+import datetime
+import time
+import traceback
+
+from domogik.common.partition import month_start
+
+# min time (in seconds) between 2 cleanups of a sensor
+RETENTION_INTERVAL = 3600
+# max number of values deleted in a transaction
+RETENTION_CHUNK_SIZE = 1000
+# pause (in seconds) between 2 chunks, to let the other clients use the database
+RETENTION_CHUNK_PAUSE = 0.1
+# max duration (in seconds) of a run. The remaining sensors are done by the next run
+RETENTION_MAX_DURATION = 1800
+
+
+class SensorHistoryRetention(object):
+    """ Apply the history_max and history_expire rules of the sensors
+    """
+
+    def __init__(self, log, db, interval=RETENTION_INTERVAL, chunk_size=RETENTION_CHUNK_SIZE,
+                 chunk_pause=RETENTION_CHUNK_PAUSE, max_duration=RETENTION_MAX_DURATION):
+        """ Init
+            @param log : logger
+            @param db : DbHelper, the caller opens the session
+            @param interval : min time (in seconds) between 2 cleanups of a sensor
+            @param chunk_size : max number of values deleted in a transaction
+            @param chunk_pause : pause (in seconds) between 2 chunks
+            @param max_duration : max duration (in seconds) of a run
+        """
+        self.log = log
+        self._db = db
+        self._interval = interval
+        self._chunk_size = chunk_size
+        self._chunk_pause = chunk_pause
+        self._max_duration = max_duration
+
+    def run(self):
+        """ Clean the history of the sensors which were not cleaned since interval seconds
+            The sensors which were never cleaned or cleaned long ago are done first
+            @return the number of deleted values
+        """
+        deadline = time.time() + self._max_duration
+        due = datetime.datetime.now() - datetime.timedelta(seconds=self._interval)
+        sensors = self._db.list_sensors_retention()
+        partitions = self._db.get_sensor_history_partitions()
+        if partitions is not None and partitions.is_partitioned():
+            try:
+                partitions.create_partitions()
+                self.drop_expired_partitions(partitions, sensors)
+            except:
+                self.log.error(u"History retention : error while handling the partitions : {0}".format(traceback.format_exc()))
+                # on postgresql, the failed transaction must be rolled back before the next queries
+                self._db.get_session().rollback()
+        sensors = [sensor for sensor in sensors
+                   if sensor['last_run'] is None or sensor['last_run'] <= due]
+        sensors.sort(key=lambda sensor: sensor['last_run'] or datetime.datetime.min)
+        self.log.info(u"History retention : {0} sensor(s) to clean".format(len(sensors)))
+        total = 0
+        for sensor in sensors:
+            if time.time() >= deadline:
+                self.log.info(u"History retention : max duration reached, the remaining sensors will be cleaned on the next run")
+                break
+            try:
+                total += self.clean_sensor(sensor, deadline)
+            except:
+                self.log.error(u"History retention : error while cleaning the sensor {0} : {1}".format(sensor['id'], traceback.format_exc()))
+        self.log.info(u"History retention : {0} value(s) deleted".format(total))
+        return total
+
+    def drop_expired_partitions(self, partitions, sensors):
+        """ Drop the past partitions in which all the values are out of the history rules of their sensor
+            @param partitions : SensorHistoryPartitions object
+            @param sensors : the sensors with a history rule, from list_sensors_retention()
+            @return the names of the dropped partitions
+        """
+        rules = dict([(sensor['id'], sensor) for sensor in sensors])
+        current = month_start(datetime.datetime.now())
+        dropped = []
+        for name, start, end in partitions.list_partitions():
+            if end > current:
+                break
+            expired = True
+            for sid in self._db.list_sensor_history_sensors(start, end):
+                # the sensors without history rule keep all their values
+                date = self._db.get_sensor_history_purge_date(rules[sid]) if sid in rules else None
+                if date is None or date < end:
+                    expired = False
+                    break
+            if expired:
+                partitions.drop_partition(name)
+                # the rollups of the month would outlive its values
+                self._db.delete_sensor_history_rollups(start, end)
+                dropped.append(name)
+        if len(dropped) > 0:
+            self.log.info(u"History retention : partitions dropped : {0}".format(dropped))
+        return dropped
+
+    def clean_sensor(self, sensor, deadline=None):
+        """ Delete the values of a sensor which are out of its history rules
+            @param sensor : dict with the keys 'id', 'history_max' and 'history_expire'
+            @param deadline : time after which the cleanup is stopped (it will go on at the next run)
+            @return the number of deleted values
+        """
+        deleted = 0
+        last_id = None
+        date = self._db.get_sensor_history_purge_date(sensor)
+        if date is not None:
+            while deadline is None or time.time() < deadline:
+                count, chunk_last_id = self._db.delete_sensor_history_chunk(sensor['id'], date, self._chunk_size)
+                deleted += count
+                if chunk_last_id is not None:
+                    last_id = chunk_last_id
+                if count < self._chunk_size:
+                    break
+                time.sleep(self._chunk_pause)
+            else:
+                # stopped before the end : the sensor will be cleaned again first on the next run
+                self._db.update_sensor_retention(sensor['id'], last_id, deleted, finished=False)
+                self.log.info(u"History retention : sensor {0}, {1} value(s) deleted, not finished".format(sensor['id'], deleted))
+                return deleted
+        self._db.update_sensor_retention(sensor['id'], last_id, deleted)
+        if deleted > 0:
+            self.log.debug(u"History retention : sensor {0}, {1} value(s) deleted".format(sensor['id'], deleted))
+        return deleted
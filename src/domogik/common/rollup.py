@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+""" This file is part of B{Domogik} project (U{http://www.domogik.org}).
+
+License
+=======
+
+B{Domogik} is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+B{Domogik} is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Domogik. If not, see U{http://www.gnu.org/licenses}.
+
+Module purpose
+==============
+
+Periods of the sensor history rollup tables
+
+The sensor history is aggregated by minute, hour, day and month. An
+aggregate is [row_count, value_count, value_sum, value_min, value_max] :
+the aggregates of several periods are merged without reading the values
+again. The history filters (interval/selector) are computed from the
+coarsest rollup which fits the requested interval, the partial periods
+at the range bounds being read from the finer rollups.
+
+Implements
+==========
+
+- ROLLUP_LEVELS
+- STEP_LEVELS
+- floor_date
+- next_date
+- ceil_date
+- cover_range
+- group_key
+- bucket_level
+- bucket_origin
+- new_aggregate
+- merge_aggregate
+- aggregate_value
+
+@author: Domogik project
+@copyright: (C) 2007-2019 Domogik project
+@license: GPL(v3)
+@organization: Domogik
+"""
+
+import datetime
+
+# the rollup periods, the finest first
+ROLLUP_LEVELS = ['minute', 'hour', 'day', 'month']
+
+# history filter interval => rollup used to compute it
+STEP_LEVELS = {'minute' : 'minute',
+               'hour' : 'hour',
+               'day' : 'day',
+               'week' : 'day',
+               'month' : 'month',
+               'year' : 'month'}
+
+# duration (in seconds) of the rollup periods with a fixed duration
+LEVEL_SECONDS = {'minute' : 60,
+                 'hour' : 3600,
+                 'day' : 86400}
+
+
+def floor_date(date, level):
+    """ Return the start of the period of a date
+        @param date : datetime
+        @param level : one of ROLLUP_LEVELS
+    """
+    date = date.replace(second=0, microsecond=0)
+    if level == 'minute':
+        return date
+    date = date.replace(minute=0)
+    if level == 'hour':
+        return date
+    date = date.replace(hour=0)
+    if level == 'day':
+        return date
+    return date.replace(day=1)
+
+def next_date(date, level):
+    """ Return the start of the next period
+        @param date : start of a period
+        @param level : one of ROLLUP_LEVELS
+    """
+    if level == 'minute':
+        return date + datetime.timedelta(minutes=1)
+    if level == 'hour':
+        return date + datetime.timedelta(hours=1)
+    if level == 'day':
+        return date + datetime.timedelta(days=1)
+    if date.month == 12:
+        return date.replace(year=date.year + 1, month=1)
+    return date.replace(month=date.month + 1)
+
+def ceil_date(date, level):
+    """ Return the start of the first period which starts at or after a date
+    """
+    start = floor_date(date, level)
+    if start < date:
+        return next_date(start, level)
+    return start
+
+def cover_range(start, end, level):
+    """ Split a date range in complete periods, from the coarsest level to the raw values
+
+        @param start : range start (included)
+        @param end : range end (excluded)
+        @param level : coarsest level to use
+        @return a list of (level, start, end), level is None for the raw values
+
+    """
+    if start >= end:
+        return []
+    if level is None:
+        return [(None, start, end)]
+    finer = ROLLUP_LEVELS.index(level) - 1
+    finer = ROLLUP_LEVELS[finer] if finer >= 0 else None
+    first = ceil_date(start, level)
+    last = floor_date(end, level)
+    if first >= last:
+        return cover_range(start, end, finer)
+    return cover_range(start, first, finer) + [(level, first, last)] + cover_range(last, end, finer)
+
+def _week_mode1(date):
+    """ Week number like the mysql WEEK(date, 1) function used by the history filters
+        (monday first, 0-53, week 1 is the first week with 4 or more days in the year)
+    """
+    iso_year, iso_week, iso_day = date.isocalendar()
+    if iso_year < date.year:
+        return 0
+    if iso_year > date.year:
+        return 53
+    return iso_week
+
+def group_key(date, step):
+    """ Return the columns of the history filter result for a date
+        These are the same columns as the previous GROUP BY queries
+
+        @param date : datetime
+        @param step : history filter interval (minute, hour, day, week, month, year)
+
+    """
+    if step == 'minute':
+        return (date.year, date.month, date.isocalendar()[1], date.day, date.hour, date.minute)
+    if step == 'hour':
+        return (date.year, date.month, date.isocalendar()[1], date.day, date.hour)
+    if step == 'day':
+        return (date.year, date.month, date.isocalendar()[1], date.day)
+    if step == 'week':
+        return (date.year, _week_mode1(date))
+    if step == 'month':
+        return (date.year, date.month)
+    return (date.year,)
+
+def bucket_level(width):
+    """ Return the coarsest rollup level whose periods are all in a single bucket of width seconds
+        The buckets start at bucket_origin(), so the periods are aligned on the buckets
+        @return one of ROLLUP_LEVELS, None if the values must be read
+    """
+    for level in ('day', 'hour', 'minute'):
+        if width % LEVEL_SECONDS[level] == 0:
+            return level
+    return None
+
+def bucket_origin(date):
+    """ Return the start of the first bucket of a range starting at date (the start of its day)
+        The buckets are origin + N * width, so the 15 minutes buckets start at :00, :15, ...
+    """
+    return floor_date(date, 'day')
+
+def new_aggregate(value_num=None):
+    """ Return the aggregate of one history row
+        @param value_num : numeric value of the row, None if the value is not a number
+    """
+    if value_num is None:
+        return [1, 0, None, None, None]
+    return [1, 1, value_num, value_num, value_num]
+
+def merge_aggregate(aggregate, other):
+    """ Add an aggregate to another one
+        @param aggregate : [row_count, value_count, value_sum, value_min, value_max], updated
+        @param other : aggregate (list or tuple) to add
+    """
+    aggregate[0] += other[0]
+    if other[1]:
+        if aggregate[1]:
+            aggregate[2] += other[2]
+            aggregate[3] = min(aggregate[3], other[3])
+            aggregate[4] = max(aggregate[4], other[4])
+        else:
+            aggregate[2], aggregate[3], aggregate[4] = other[2], other[3], other[4]
+        aggregate[1] += other[1]
+    return aggregate
+
+def aggregate_value(aggregate, function):
+    """ Return the min, max, avg or sum of an aggregate, None if there is no numeric value
+    """
+    if not aggregate[1]:
+        return None
+    if function == 'min':
+        return aggregate[3]
+    if function == 'max':
+        return aggregate[4]
+    if function == 'sum':
+        return aggregate[2]
+    return aggregate[2] / float(aggregate[1])
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+
+""" This file is part of B{Domogik} project (U{http://www.domogik.org}).
+
+License
+=======
+
+B{Domogik} is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+B{Domogik} is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Domogik. If not, see U{http://www.gnu.org/licenses}.
+
+Module purpose
+==============
+
+Processing of the values received for a sensor before they are stored
+
+The formula, incremental, rounding and duplicate rules of a sensor are
+compiled once in a SensorPipeline. The formulas are parsed with the ast
+module and only simple arithmetic expressions on VALUE are accepted, so
+a formula can't run arbitrary python code. The ** operator is bounded so
+that a formula can't block the store.
+
+Implements
+==========
+
+- SensorPipeline
+- SensorPipelines
+- compile_formula
+- compile_ignore_values
+- FormulaError
+
+@author: Domogik project
+@copyright: (C) 2007-2019 Domogik project
+@license: GPL(v3)
+@organization: Domogik
+"""
+
+import ast
+import math
+
+from domogik.common.utils import ucode
+
+# the functions which can be called in a formula
+FORMULA_FUNCTIONS = {'abs' : abs,
+                     'round' : round,
+                     'min' : min,
+                     'max' : max,
+                     'int' : int,
+                     'float' : float}
+# the functions of the math module which can be called in a formula (math.xxx)
+FORMULA_MATH = ['ceil', 'floor', 'sqrt', 'exp', 'log', 'log10', 'pow',
+                'sin', 'cos', 'tan', 'asin', 'acos', 'atan', 'atan2',
+                'degrees', 'radians', 'fabs', 'pi', 'e']
+FORMULA_CONSTANTS = ['True', 'False', 'None']
+# bounds of the ** operator in a formula : a big integer power would block the store worker
+FORMULA_MAX_EXPONENT = 100
+FORMULA_MAX_POWER_BITS = 4096
+
+# the python grammar nodes allowed in a formula
+_ALLOWED_NODES = [ast.Expression, ast.Load,
+                  ast.BinOp, ast.UnaryOp, ast.BoolOp, ast.Compare, ast.IfExp, ast.Call,
+                  ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow,
+                  ast.UAdd, ast.USub, ast.Not, ast.And, ast.Or,
+                  ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE]
+# python 2 / python < 3.8 constants, python >= 3.8 constants
+for _node in ['Num', 'Str', 'NameConstant', 'Constant']:
+    if hasattr(ast, _node):
+        _ALLOWED_NODES.append(getattr(ast, _node))
+_ALLOWED_NODES = tuple(_ALLOWED_NODES)
+
+
+class FormulaError(Exception):
+    """ The formula of a sensor is not valid
+    """
+    pass
+
+
+def compile_formula(formula):
+    """ Compile the formula of a sensor
+
+    The formula is a python expression using VALUE, numbers, the arithmetic and
+    comparison operators, the functions of FORMULA_FUNCTIONS and math.xxx for
+    the names of FORMULA_MATH. Anything else (attributes, subscripts, lambdas,
+    other names...) is refused.
+
+    @param formula : the formula, for example "VALUE * 1.8 + 32"
+    @return a function which takes the value and returns the computed value
+    @raise FormulaError if the formula is not valid
+
+    """
+    try:
+        tree = ast.parse(formula.strip(), mode='eval')
+    except SyntaxError as exp:
+        raise FormulaError(u"Invalid formula '{0}' : {1}".format(formula, exp))
+    for node in ast.walk(tree):
+        if isinstance(node, _ALLOWED_NODES):
+            if isinstance(node, ast.Call):
+                if (node.keywords or getattr(node, 'starargs', None) or getattr(node, 'kwargs', None)):
+                    raise FormulaError(u"Invalid formula '{0}' : only positional arguments are allowed".format(formula))
+                if not (isinstance(node.func, ast.Name) and node.func.id in FORMULA_FUNCTIONS) \
+                   and not _is_math_attribute(node.func):
+                    raise FormulaError(u"Invalid formula '{0}' : function not allowed".format(formula))
+        elif isinstance(node, ast.Name):
+            if node.id not in ['VALUE', 'math'] + FORMULA_CONSTANTS and node.id not in FORMULA_FUNCTIONS:
+                raise FormulaError(u"Invalid formula '{0}' : unknown name '{1}'".format(formula, node.id))
+        elif isinstance(node, ast.Attribute):
+            if not _is_math_attribute(node):
+                raise FormulaError(u"Invalid formula '{0}' : attribute not allowed".format(formula))
+        elif type(node).__name__ == 'Starred':
+            raise FormulaError(u"Invalid formula '{0}' : only positional arguments are allowed".format(formula))
+        else:
+            raise FormulaError(u"Invalid formula '{0}' : '{1}' not allowed".format(formula, type(node).__name__))
+    tree = ast.fix_missing_locations(_BoundedPower().visit(tree))
+    code = compile(tree, "<formula>", "eval")
+    namespace = {'__builtins__' : {}, 'math' : math, 'True' : True, 'False' : False, 'None' : None,
+                 '_power' : _power}
+    namespace.update(FORMULA_FUNCTIONS)
+
+    def formula_function(value):
+        return eval(code, namespace, {'VALUE' : value})
+    return formula_function
+
+def _is_math_attribute(node):
+    """ Check if a node is math.<allowed name>
+    """
+    return isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) \
+           and node.value.id == 'math' and node.attr in FORMULA_MATH
+
+class _BoundedPower(ast.NodeTransformer):
+    """ Replace the ** operators of a formula by calls to _power
+    """
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        if not isinstance(node.op, ast.Pow):
+            return node
+        call = ast.Call(func=ast.Name(id='_power', ctx=ast.Load()), args=[node.left, node.right], keywords=[])
+        return ast.copy_location(call, node)
+
+def _power(base, exponent):
+    """ The ** operator of the formulas, with a bounded exponent and integer result size
+    """
+    if abs(exponent) > FORMULA_MAX_EXPONENT:
+        raise FormulaError(u"the exponent {0} is too big".format(exponent))
+    if isinstance(base, (int, type(2 ** 64))) and isinstance(exponent, (int, type(2 ** 64))) \
+       and abs(base).bit_length() * exponent > FORMULA_MAX_POWER_BITS:
+        raise FormulaError(u"the result of the power {0} is too big".format(exponent))
+    return base ** exponent
+
+def compile_ignore_values(ignore_values):
+    """ Parse the ignore_values of a xpl stat parameter
+
+    The ignore_values is a python literal (for example "['0', '255']").
+    If it is not a valid literal, it is read as a comma separated list.
+
+    @param ignore_values : the ignore_values string
+    @return an object which supports 'in', or None if nothing is ignored
+
+    """
+    if ignore_values is None or ignore_values.strip() == '':
+        return None
+    try:
+        ignored = ast.literal_eval(ignore_values.strip())
+    except (ValueError, SyntaxError):
+        ignored = [value.strip() for value in ignore_values.split(',')]
+    if isinstance(ignored, (list, tuple, set, frozenset)):
+        try:
+            return frozenset(ignored)
+        except TypeError:
+            return tuple(ignored)
+    if isinstance(ignored, (str, type(u''))):
+        # same as the previous eval() : 'in' looks for a sub string
+        return ignored
+    return (ignored,)
+
+def _to_number(value):
+    """ Convert a value like the formula text substitution used to do
+        @return an int, a float, or None if the value is not a number
+    """
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return value
+    try:
+        return int(value)
+    except (ValueError, TypeError):
+        pass
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return None
+
+
+class SensorPipeline(object):
+    """ The compiled storage rules of a sensor
+        A pipeline is immutable : a new one is built when the sensor changes
+    """
+
+    # the sensor fields used by the pipeline
+    FIELDS = ['incremental', 'formula', 'history_round', 'history_store', 'history_duplicate']
+
+    def __init__(self, sensor, log=None):
+        """ Compile the rules of a sensor
+            @param sensor : the sensor informations (dict)
+            @param log : logger
+        """
+        self.log = log
+        self.signature = tuple([sensor.get(field) for field in self.FIELDS])
+        self.incremental = sensor['incremental']
+        self.history_round = sensor['history_round'] or 0
+        self.history_store = sensor['history_store']
+        self.history_duplicate = sensor['history_duplicate']
+        self.formula_source = sensor['formula']
+        self.formula = None
+        if self.formula_source is not None and self.formula_source != '':
+            try:
+                self.formula = compile_formula(self.formula_source)
+            except FormulaError as exp:
+                # same as before : a bad formula doesn't change the value
+                if self.log:
+                    self.log.warning(u"Formula of sensor {0} ignored : {1}".format(sensor.get('id'), exp))
+
+    def is_for(self, sensor):
+        """ Check if the pipeline is still valid for a sensor
+        """
+        return self.signature == tuple([sensor.get(field) for field in self.FIELDS])
+
+    def compute(self, value, window):
+        """ Apply the incremental and formula rules
+            @param value : received value
+            @param window : last history rows (dicts), the most recent first
+            @return (value to store, original value)
+        """
+        orig_value = value
+        if self.incremental:
+            # get the last orig_value and substract value and orig_value and set the new value
+            if len(window) > 0:
+                if window[0]['original_value_num'] is not None:
+                    value = float(value) - window[0]['original_value_num']
+            else:
+                # set the begin value to 0
+                value = 0
+        if self.formula is not None:
+            try:
+                number = _to_number(value)
+                if number is None:
+                    raise FormulaError(u"the value '{0}' is not a number".format(value))
+                value = self.formula(number)
+            except Exception as exp:
+                if self.log:
+                    self.log.warning(u"Failed to apply formula ({0}) to value ({1}): {2}".format(self.formula_source, value, exp))
+        return value, orig_value
+
+    def is_rounded(self, value, window):
+        """ Check if the last stored value is useless because the 2 last values
+            and the new one are in the round range
+        """
+        if self.history_round <= 0 or len(window) != 2 \
+                or window[0]['value_num'] is None or window[1]['value_num'] is None:
+            return False
+        try:
+            fvalue = float(value)
+        except (ValueError, TypeError):
+            return False
+        return abs(window[0]['value_num'] - window[1]['value_num']) < self.history_round \
+               and abs(fvalue - window[0]['value_num']) < self.history_round \
+               and abs(fvalue - window[1]['value_num']) < self.history_round
+
+    def is_duplicate(self, value, window):
+        """ Check if the last stored value is useless because the 2 last values
+            and the new one are the same and duplicates are not kept
+        """
+        return self.history_duplicate == 0 and len(window) == 2 \
+               and window[0]['value_str'] == window[1]['value_str'] == ucode(value)
+
+
+class SensorPipelines(object):
+    """ The pipelines of all the sensors, by sensor id
+        The pipeline of a sensor is rebuilt when the sensor changes
+    """
+
+    def __init__(self, log=None):
+        self.log = log
+        self._pipelines = {}
+
+    def get(self, sensor):
+        """ Return the pipeline of a sensor, building it if needed
+            @param sensor : sensor informations (dict)
+        """
+        pipeline = self._pipelines.get(sensor['id'])
+        if pipeline is None or not pipeline.is_for(sensor):
+            pipeline = SensorPipeline(sensor, self.log)
+            self._pipelines[sensor['id']] = pipeline
+        return pipeline
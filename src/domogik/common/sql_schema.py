@@ -43,10 +43,10 @@ import time, sys
 from sqlalchemy import (
         types, create_engine, Table, Column, Index, Integer, Float, String, Enum,
         MetaData, ForeignKey, Boolean, DateTime, Date, Text,
-        Unicode, UnicodeText, UniqueConstraint
+        Unicode, UnicodeText, UniqueConstraint, PrimaryKeyConstraint
 )
 from sqlalchemy.types import TIMESTAMP
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy.orm import relation, backref, relationship
 
 from domogik.common.utils import ucode
@@ -301,6 +301,90 @@ class SensorHistory(DomogikBase):
             pass
         self.value_str = ucode(value)
 
+class SensorHistoryRollupMixin(object):
+    """Aggregates of the sensor history values on a period (columns shared by the rollup tables)
+
+    The value_* columns are computed on the numeric values (value_num), row_count
+    counts all the history rows of the period.
+
+    """
+    date = Column(DateTime, nullable=False)
+    row_count = Column(Integer, nullable=False)
+    value_count = Column(Integer, nullable=False)
+    value_sum = Column(Float(53), nullable=True)
+    value_min = Column(Float(53), nullable=True)
+    value_max = Column(Float(53), nullable=True)
+
+    @declared_attr
+    def sensor_id(cls):
+        return Column(Integer, ForeignKey('{0}.id'.format(Sensor.get_tablename()), ondelete="cascade"), nullable=False)
+
+    @declared_attr
+    def __table_args__(cls):
+        # the values of a sensor are read by date range
+        return (PrimaryKeyConstraint('sensor_id', 'date'), {'mysql_engine':'InnoDB', 'mysql_character_set':'utf8'})
+
+class SensorHistoryMinute(SensorHistoryRollupMixin, DomogikBase):
+    """Sensor history aggregates by minute"""
+    __tablename__ = '{0}_sensor_history_minute'.format(_db_prefix)
+
+class SensorHistoryHour(SensorHistoryRollupMixin, DomogikBase):
+    """Sensor history aggregates by hour"""
+    __tablename__ = '{0}_sensor_history_hour'.format(_db_prefix)
+
+class SensorHistoryDay(SensorHistoryRollupMixin, DomogikBase):
+    """Sensor history aggregates by day"""
+    __tablename__ = '{0}_sensor_history_day'.format(_db_prefix)
+
+class SensorHistoryMonth(SensorHistoryRollupMixin, DomogikBase):
+    """Sensor history aggregates by month"""
+    __tablename__ = '{0}_sensor_history_month'.format(_db_prefix)
+
+class SensorRollup(DomogikBase):
+    """State of the rollup tables of a sensor
+
+    The rollups are complete for the periods starting after rollup_from,
+    or for all the periods if rollup_from is NULL (history backfilled).
+
+    """
+    __tablename__ = '{0}_sensor_rollup'.format(_db_prefix)
+    __table_args__ = {'mysql_engine':'InnoDB', 'mysql_character_set':'utf8'}
+    sensor_id = Column(Integer, ForeignKey('{0}.id'.format(Sensor.get_tablename()), ondelete="cascade"), primary_key=True, autoincrement=False, nullable=False)
+    rollup_from = Column(DateTime, nullable=True)
+
+    def __init__(self, sensor_id, rollup_from):
+        """Class constructor
+
+        @param sensor_id : sensor id
+        @param rollup_from : date from which the rollups are complete, None if they are complete
+
+        """
+        self.sensor_id = sensor_id
+        self.rollup_from = rollup_from
+
+class SensorRetention(DomogikBase):
+    """Progress of the history_max and history_expire rules of a sensor"""
+
+    __tablename__ = '{0}_sensor_retention'.format(_db_prefix)
+    __table_args__ = {'mysql_engine':'InnoDB', 'mysql_character_set':'utf8'}
+    sensor_id = Column(Integer, ForeignKey('{0}.id'.format(Sensor.get_tablename()), ondelete="cascade"), primary_key=True, autoincrement=False, nullable=False)
+    last_run = Column(DateTime, nullable=True)
+    last_id = Column(Integer, nullable=True)
+    last_deleted = Column(Integer, nullable=False, default=0)
+    total_deleted = Column(Integer, nullable=False, default=0)
+
+    def __init__(self, sensor_id):
+        """Class constructor
+
+        @param sensor_id : sensor id
+
+        """
+        self.sensor_id = sensor_id
+        self.last_run = None
+        self.last_id = None
+        self.last_deleted = 0
+        self.total_deleted = 0
+
 class XplStat(DomogikBase):
     __tablename__ = '{0}_xplstat'.format(_db_prefix)
     __table_args__ = {'mysql_engine':'InnoDB', 'mysql_character_set':'utf8'}
@@ -35,7 +35,16 @@
     msg.add_data('from', 1449178465)
     print(cli.request('admin', msg.get(), timeout=10).get())
 
+    # example 4 : get the values of several sensors since a timestamp (the values are returned by sensor id)
+    msg = MQMessage()
+    msg.set_action('sensor_history.get')
+    msg.add_data('sensor_ids', [3, 4, 5])
+    msg.add_data('mode', 'period')
+    msg.add_data('from', 1449178465)
+    print(cli.request('admin', msg.get(), timeout=10).get())
+
 @apiParam {String} sensor_id The sensor id
+@apiParam {List} [sensor_ids] Instead of sensor_id, a list of sensor ids, for the 'period' and 'filter' modes. The values are returned by sensor id
 @apiParam {String} mode The mode : 'last' to get the last values, 'period' to get the values rom a period.
 @apiParam {String} [number] If mode = 'last', set the number of values to get.
 @apiParam {String} [from] If mode = 'period', set the timestamp from which you want to get the values
@@ -120,3 +129,14 @@ msg.add_data('to', 1500847199)      # Optionnal
 msg.add_data('interval', 'day')     # 'minute|hour|day|week|month|year'
 msg.add_data('selector', 'min')     # 'min|max|avg|sum'
 print(cli.request('admin', msg.get(), timeout=10).get())
+
+# example 5 : get the filtered history of several sensors (the values are returned by sensor id)
+msg = MQMessage()
+msg.set_action('sensor_history.get')
+msg.add_data('sensor_ids', [141, 142])
+msg.add_data('mode', 'filter')
+msg.add_data('from', 1483225200)
+msg.add_data('to', 1500847199)
+msg.add_data('interval', 'day')
+msg.add_data('selector', 'avg')
+print(cli.request('admin', msg.get(), timeout=10).get())
@@ -0,0 +1,51 @@
+"""add sensor_history rollup tables
+
+Revision ID: 2d4f6a8c0e13
+Revises: 5b8e3c1f7a20
+Create Date: 2019-03-09 16:47:05.630182
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2d4f6a8c0e13'
+down_revision = '5b8e3c1f7a20'
+
+from alembic import op
+import sqlalchemy as sa
+
+ROLLUP_TABLES = ['core_sensor_history_minute', 'core_sensor_history_hour', 'core_sensor_history_day', 'core_sensor_history_month']
+
+def upgrade():
+    for table in ROLLUP_TABLES:
+        print(u"Create new {0} table".format(table))
+        op.create_table(table,
+            sa.Column('sensor_id', sa.Integer(), nullable=False, autoincrement=False),
+            sa.Column('date', sa.DateTime(), nullable=False),
+            sa.Column('row_count', sa.Integer(), nullable=False),
+            sa.Column('value_count', sa.Integer(), nullable=False),
+            sa.Column('value_sum', sa.Float(precision=53), nullable=True),
+            sa.Column('value_min', sa.Float(precision=53), nullable=True),
+            sa.Column('value_max', sa.Float(precision=53), nullable=True),
+            sa.ForeignKeyConstraint(['sensor_id'], ['core_sensor.id'], ondelete='cascade'),
+            sa.PrimaryKeyConstraint('sensor_id', 'date'),
+            mysql_character_set='utf8',
+            mysql_engine='InnoDB'
+        )
+    print(u"Create new core_sensor_rollup table")
+    op.create_table('core_sensor_rollup',
+        sa.Column('sensor_id', sa.Integer(), nullable=False, autoincrement=False),
+        sa.Column('rollup_from', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['sensor_id'], ['core_sensor.id'], ondelete='cascade'),
+        sa.PrimaryKeyConstraint('sensor_id'),
+        mysql_character_set='utf8',
+        mysql_engine='InnoDB'
+    )
+    print(u"The existing sensors history will be aggregated by the dmg_rollup command")
+
+
+def downgrade():
+    print(u"Remove core_sensor_rollup table")
+    op.drop_table('core_sensor_rollup')
+    for table in reversed(ROLLUP_TABLES):
+        print(u"Remove {0} table".format(table))
+        op.drop_table(table)
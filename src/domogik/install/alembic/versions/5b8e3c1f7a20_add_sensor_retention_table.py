@@ -0,0 +1,33 @@
+"""add sensor_retention table
+
+Revision ID: 5b8e3c1f7a20
+Revises: 4312b4106938
+Create Date: 2019-03-02 10:12:41.218734
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5b8e3c1f7a20'
+down_revision = '4312b4106938'
+
+from alembic import op
+import sqlalchemy as sa
+
+def upgrade():
+    print(u"Create new core_sensor_retention table")
+    op.create_table('core_sensor_retention',
+        sa.Column('sensor_id', sa.Integer(), nullable=False, autoincrement=False),
+        sa.Column('last_run', sa.DateTime(), nullable=True),
+        sa.Column('last_id', sa.Integer(), nullable=True),
+        sa.Column('last_deleted', sa.Integer(), nullable=False),
+        sa.Column('total_deleted', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['sensor_id'], ['core_sensor.id'], ondelete='cascade'),
+        sa.PrimaryKeyConstraint('sensor_id'),
+        mysql_character_set='utf8',
+        mysql_engine='InnoDB'
+    )
+
+
+def downgrade():
+    print(u"Remove core_sensor_retention table")
+    op.drop_table('core_sensor_retention')
@@ -167,6 +167,12 @@ class DbInstall():
             info("Upgrading...")
             command.upgrade(self.alembic_cfg, "head")
             ok("Upgrading : done")
+        with self._db.session_scope():
+            partitions = self._db.get_sensor_history_partitions()
+            if partitions is not None and not partitions.is_partitioned():
+                info("Partitioning the sensor history table by month (this may take a long time)...")
+                partitions.enable()
+                ok("Partitioning the sensor history table : done")
         return
 
     def backup_existing_database(self, ask_confirm=True):
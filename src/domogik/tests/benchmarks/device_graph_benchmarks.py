@@ -0,0 +1,129 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+""" This file is part of B{Domogik} project (U{http://www.domogik.org}).
+
+License
+=======
+B{Domogik} is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+B{Domogik} is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Domogik. If not, see U{http://www.gnu.org/licenses}.
+
+Plugin purpose
+==============
+
+Benchmarks for DbHelper.list_devices and DbHelper.get_device
+
+The devices are read with their params, sensors, commands, xpl stats and
+xpl commands. The number of queries must not depend on the number of
+devices : the benchmark fails if it changes.
+
+It uses the test database (the database of domogik.cfg with the '_test'
+suffix), which must have the domogik tables. The created devices are
+deleted at the end.
+
+Usage : python device_graph_benchmarks.py
+
+@author: Domogik project
+@copyright: (C) 2007-2019 Domogik project
+@license: GPL(v3)
+@organization: Domogik
+"""
+
+import datetime
+import time
+from sqlalchemy import event
+from domogik.common.database import DbHelper
+from domogik.common.sql_schema import Device, DeviceParam, Command, CommandParam, Sensor, \
+                                      XplStat, XplStatParam, XplCommand, XplCommandParam
+
+DEVICES_NUMBERS = [1, 10, 100, 1000]
+CLIENT_ID = u"plugin-benchmark.devicegraph"
+
+def make_devices(db, nb_devices):
+    """Create some devices like the ones of a plugin with a switch
+
+    @param db : DbHelper
+    @param nb_devices : number of devices to create
+
+    """
+    with db.session_scope() as session:
+        for idx in range(nb_devices):
+            device = Device(u"switch", u"bench", u"benchmark.switch", CLIENT_ID, u"0.1", info_changed=datetime.datetime.now())
+            session.add(device)
+            session.flush()
+            session.add(DeviceParam(device.id, u"address", u"{0}".format(idx), u"string"))
+            sensor = Sensor(device.id, u"State", u"state", False, None, u"DT_Switch", u"", True, 0, 0, 0, False, 0)
+            session.add(sensor)
+            command = Command(device.id, u"Switch", u"switch", True)
+            session.add(command)
+            session.flush()
+            session.add(CommandParam(command.id, u"state", u"DT_Switch", u""))
+            xplstat = XplStat(device.id, u"Switch state", u"ac.basic", u"switch_state")
+            session.add(xplstat)
+            session.flush()
+            session.add(XplStatParam(xplstat.id, u"address", u"{0}".format(idx), True, None, u"", None))
+            session.add(XplStatParam(xplstat.id, u"command", None, False, sensor.id, u"", None))
+            xplcommand = XplCommand(u"Switch", device.id, command.id, u"switch", u"ac.basic", xplstat.id)
+            session.add(xplcommand)
+            session.flush()
+            session.add(XplCommandParam(xplcommand.id, u"address", u"{0}".format(idx)))
+
+def delete_devices(db):
+    """Delete the devices created by the benchmark"""
+    with db.session_scope() as session:
+        for device in session.query(Device).filter_by(client_id=CLIENT_ID).all():
+            session.delete(device)
+
+def count_queries(db, function, *args):
+    """Call a DbHelper function in a new session
+
+    @return (number of queries, duration, result)
+
+    """
+    queries = []
+    def on_query(conn, cursor, statement, parameters, context, executemany):
+        queries.append(statement)
+    event.listen(db.get_engine(), "before_cursor_execute", on_query)
+    try:
+        start_t = time.time()
+        with db.session_scope():
+            result = function(*args)
+        return len(queries), time.time() - start_t, result
+    finally:
+        event.remove(db.get_engine(), "before_cursor_execute", on_query)
+
+def run(db):
+    """Run the benchmark for each devices number"""
+    print(u"{0:>10} | {1:>20} | {2:>20} | {3:>20}".format("devices", "list_devices queries", "list_devices (s)", "get_device queries"))
+    counts = set()
+    created = 0
+    try:
+        for nb_devices in DEVICES_NUMBERS:
+            make_devices(db, nb_devices - created)
+            created = nb_devices
+            list_queries, list_t, devices = count_queries(db, db.list_devices)
+            a_device = [dev for dev in devices if dev['client_id'] == CLIENT_ID][0]
+            get_queries, get_t, device = count_queries(db, db.get_device, a_device['id'])
+            # the graph must be complete
+            assert device == a_device
+            assert device['xpl_stats']['switch_state']['parameters']['dynamic'][0]['sensor_name'] == u"state"
+            assert device['xpl_commands']['switch']['xpl_stat_ack'] == u"switch_state"
+            assert device['commands']['switch']['xpl_command'] == u"switch"
+            print(u"{0:>10} | {1:>20} | {2:>20.4f} | {3:>20}".format(len(devices), list_queries, list_t, get_queries))
+            counts.add((list_queries, get_queries))
+    finally:
+        delete_devices(db)
+    assert len(counts) == 1, u"The number of queries depends on the number of devices : {0}".format(sorted(counts))
+
+if __name__ == "__main__":
+    run(DbHelper(use_test_db=True, use_cache=False, owner="device graph benchmark"))
@@ -0,0 +1,125 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+""" This file is part of B{Domogik} project (U{http://www.domogik.org}).
+
+License
+=======
+B{Domogik} is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+B{Domogik} is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Domogik. If not, see U{http://www.gnu.org/licenses}.
+
+Plugin purpose
+==============
+
+Benchmarks for the xpl stats matching done by xplgw
+
+The xpl stats index (XplStatMatcher) is compared to the previous linear
+scan over all the xpl stats. No database is needed.
+
+Usage : python xplstat_matcher_benchmarks.py [number of messages]
+
+@author: Domogik project
+@copyright: (C) 2007-2019 Domogik project
+@license: GPL(v3)
+@organization: Domogik
+"""
+
+import sys
+import time
+from domogik.xpl.common.xplstatmatcher import XplStatMatcher
+
+DEVICES_NUMBERS = [10, 100, 1000, 10000]
+DEFAULT_MESSAGES = 2000
+
+def make_xplstats(nb_devices):
+    """Build xpl stats like the ones of a temperature/humidity sensor plugin
+
+    @param nb_devices : number of devices
+    @return the xpl stats list, as loaded by xplgw
+
+    """
+    xplstats = []
+    sensor_id = 0
+    for dev in range(nb_devices):
+        for a_type in ['temp', 'humidity']:
+            sensor_id += 1
+            xplstats.append({'schema' : 'sensor.basic',
+                             'params' : [{'key' : 'device', 'value' : 'th{0}'.format(dev), 'static' : True, 'multiple' : None, 'ignore_values' : ''},
+                                         {'key' : 'type', 'value' : a_type, 'static' : True, 'multiple' : None, 'ignore_values' : ''},
+                                         {'key' : 'current', 'value' : None, 'static' : False, 'multiple' : None, 'ignore_values' : '', 'sensor_id' : sensor_id}]})
+    return xplstats
+
+def make_messages(nb_devices, nb_messages):
+    """Build the (schema, data) of some messages, spread over all the devices"""
+    messages = []
+    for idx in range(nb_messages):
+        dev = (idx * 7919) % nb_devices
+        messages.append(('sensor.basic', {'device' : 'th{0}'.format(dev), 'type' : 'temp', 'current' : '21.5'}))
+    return messages
+
+def linear_match(xplstats, schema, data):
+    """The linear scan used by xplgw before the index"""
+    tostore = []
+    for xplstat in xplstats:
+        matching = 0
+        statics = 0
+        if xplstat['schema'] == schema:
+            for param in xplstat['params']:
+                if param['key'] in data and param['static']:
+                    statics = statics + 1
+                    if param['multiple'] is not None and len(param['multiple']) == 1 and data[param['key']] in param['value'].split(param['multiple']):
+                        matching = matching + 1
+                    elif data[param['key']] == param['value']:
+                        matching = matching + 1
+            if matching == statics:
+                for param in xplstat['params']:
+                    if param['key'] in data and not param['static']:
+                        tostore.append({'param': param, 'value': data[param['key']]})
+    return tostore
+
+def run(nb_messages):
+    """Run the benchmark for each devices number"""
+    print(u"Matching {0} messages".format(nb_messages))
+    print(u"{0:>10} | {1:>16} | {2:>16} | {3:>16}".format("devices", "index build (s)", "index (us/msg)", "linear (us/msg)"))
+    for nb_devices in DEVICES_NUMBERS:
+        xplstats = make_xplstats(nb_devices)
+        messages = make_messages(nb_devices, nb_messages)
+
+        start_t = time.time()
+        matcher = XplStatMatcher(xplstats)
+        build_t = time.time() - start_t
+
+        start_t = time.time()
+        for schema, data in messages:
+            matcher.match(schema, data)
+        index_t = (time.time() - start_t) / nb_messages * 1000000
+
+        # the linear scan is slow : only check a few messages for the big installs
+        nb_linear = max(1, min(nb_messages, 200000 // nb_devices))
+        start_t = time.time()
+        for schema, data in messages[:nb_linear]:
+            expected = linear_match(xplstats, schema, data)
+        linear_t = (time.time() - start_t) / nb_linear * 1000000
+
+        # both ways must find the same sensors
+        for schema, data in messages[:nb_linear]:
+            assert [a['param']['sensor_id'] for a in matcher.match(schema, data)] == \
+                   [a['param']['sensor_id'] for a in linear_match(xplstats, schema, data)]
+
+        print(u"{0:>10} | {1:>16.4f} | {2:>16.2f} | {3:>16.2f}".format(nb_devices, build_t, index_t, linear_t))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run(int(sys.argv[1]))
+    else:
+        run(DEFAULT_MESSAGES)
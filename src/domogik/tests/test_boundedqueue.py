@@ -0,0 +1,109 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+""" This file is part of B{Domogik} project (U{http://www.domogik.org}).
+
+License
+=======
+
+B{Domogik} is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+B{Domogik} is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Domogik. If not, see U{http://www.gnu.org/licenses}.
+
+Module purpose
+==============
+
+Tests of the overload policies of the bounded queue (BoundedQueue)
+
+@author: Domogik project
+@copyright: (C) 2007-2019 Domogik project
+@license: GPL(v3)
+@organization: Domogik
+"""
+
+import threading
+import time
+import unittest
+
+from domogik.common.boundedqueue import BoundedQueue, POLICY_BLOCK, POLICY_COALESCE, POLICY_DROP_OLDEST
+
+
+def get_all(queue):
+    """ Return all the queued items, the oldest first
+    """
+    items = []
+    while queue.qsize() > 0:
+        items.append(queue.get_nowait())
+    return items
+
+
+class BoundedQueueTestCase(unittest.TestCase):
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, BoundedQueue, 2, 'unknown')
+        self.assertRaises(ValueError, BoundedQueue, 2, POLICY_BLOCK, {1 : 'unknown'})
+
+    def test_block(self):
+        """ A put in a full queue waits until an item is taken, and no item is lost """
+        queue = BoundedQueue(2, POLICY_BLOCK)
+        queue.put('a1', 'a')
+        queue.put('a2', 'a')
+        thread = threading.Thread(target=queue.put, args=('a3', 'a'))
+        thread.start()
+        time.sleep(0.1)
+        self.assertTrue(thread.is_alive())
+        self.assertEqual(queue.qsize(), 2)
+        self.assertEqual(queue.get(), 'a1')
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(get_all(queue), ['a2', 'a3'])
+        self.assertEqual(queue.get_stats()['blocked'], 1)
+
+    def test_coalesce(self):
+        """ In a full queue, the last queued item of the key is replaced at its position """
+        queue = BoundedQueue(3, POLICY_COALESCE)
+        queue.put('a1', 'a')
+        queue.put('b1', 'b')
+        queue.put('a2', 'a')
+        queue.put('a3', 'a')
+        queue.put('b2', 'b')
+        # a key without queued item is added anyway
+        queue.put('c1', 'c')
+        self.assertEqual(get_all(queue), ['a1', 'b2', 'a3', 'c1'])
+        stats = queue.get_stats()
+        self.assertEqual((stats['put'], stats['coalesced'], stats['dropped']), (6, 2, 0))
+
+    def test_drop_oldest(self):
+        """ In a full queue, the oldest queued item of the key is dropped """
+        queue = BoundedQueue(3, POLICY_DROP_OLDEST)
+        queue.put('a1', 'a')
+        queue.put('b1', 'b')
+        queue.put('a2', 'a')
+        queue.put('a3', 'a')
+        queue.put('a4', 'a')
+        queue.put('c1', 'c')
+        self.assertEqual(get_all(queue), ['b1', 'a3', 'a4', 'c1'])
+        self.assertEqual(queue.get_stats()['dropped'], 2)
+
+    def test_policies_by_key(self):
+        """ Each key has its policy, the other keys have the default one """
+        queue = BoundedQueue(2, POLICY_BLOCK, {'a' : POLICY_COALESCE, 'b' : POLICY_DROP_OLDEST})
+        queue.put('a1', 'a')
+        queue.put('b1', 'b')
+        queue.put('a2', 'a')
+        queue.put('b2', 'b')
+        self.assertEqual(queue.get_policy('c'), POLICY_BLOCK)
+        self.assertEqual(get_all(queue), ['a2', 'b2'])
+
+
+if __name__ == "__main__":
+    unittest.main()
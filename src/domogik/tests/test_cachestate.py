@@ -0,0 +1,148 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+""" This file is part of B{Domogik} project (U{http://www.domogik.org}).
+
+License
+=======
+
+B{Domogik} is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+B{Domogik} is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Domogik. If not, see U{http://www.gnu.org/licenses}.
+
+Module purpose
+==============
+
+Tests of the shared state of the devices cache (CacheStateWriter, CacheStateReader)
+
+@author: Domogik project
+@copyright: (C) 2007-2019 Domogik project
+@license: GPL(v3)
+@organization: Domogik
+"""
+
+import os
+import shutil
+import struct
+import tempfile
+import time
+import unittest
+
+from domogik.common import cachestate
+from domogik.common.cachestate import CacheStateWriter, CacheStateReader
+
+
+class ConcurrentWriteMap(bytearray):
+    """ Copy of the state file where a write starts each time the state is read
+        (so, between the 2 reads of the sequence counter)
+    """
+
+    def __init__(self, data, writes):
+        bytearray.__init__(self, data)
+        self.writes = writes
+
+    def __getitem__(self, index):
+        data = bytearray.__getitem__(self, index)
+        if self.writes > 0:
+            self.writes -= 1
+            sequence = struct.unpack_from('<Q', self, 0)[0]
+            self[0:8] = struct.pack('<Q', sequence + 2)
+        return data
+
+
+class CacheStateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cachedb_api.state')
+        self.writer = CacheStateWriter(self.path, 4096)
+        self.reader = CacheStateReader(self.path)
+
+    def tearDown(self):
+        self.reader.close()
+        self.writer.close()
+        shutil.rmtree(self.directory)
+
+    def test_publish(self):
+        """ The reader gets the last published state """
+        self.assertEqual(self.reader.read(), None)
+        self.writer.publish({'version' : 1})
+        self.assertEqual(self.reader.read(), {'version' : 1})
+        self.writer.publish({'version' : 2})
+        self.assertEqual(self.reader.read(), {'version' : 2})
+        self.writer.publish(None)
+        self.assertEqual(self.reader.read(), None)
+
+    def test_no_file(self):
+        """ Without state file, there is no state """
+        reader = CacheStateReader(os.path.join(self.directory, 'missing.state'))
+        self.assertEqual(reader.read(), None)
+
+    def test_too_big(self):
+        """ A state bigger than the file is not published """
+        self.writer.publish({'data' : 'x' * 5000})
+        self.assertEqual(self.reader.read(), None)
+
+    def test_writer_mid_update(self):
+        """ While the writer is writing (odd counter), the reader gives up, then gets the new state """
+        self.writer.publish({'version' : 1})
+        self.assertEqual(self.reader.read(), {'version' : 1})
+        self.writer._map[0:8] = struct.pack('<Q', self.writer._sequence + 1)
+        self.assertEqual(self.reader.read(), None)
+        self.writer.publish({'version' : 2})
+        self.assertEqual(self.reader.read(), {'version' : 2})
+
+    def test_read_retry(self):
+        """ A state written during the read is read again """
+        self.writer.publish({'version' : 1})
+        self.reader.read()
+        self.writer.publish({'version' : 2})
+        mapped = self.reader._map
+        self.reader._map = ConcurrentWriteMap(mapped[:], 2)
+        self.assertEqual(self.reader.read(), {'version' : 2})
+        self.assertEqual(self.reader._map.writes, 0)
+        self.reader._map = mapped
+
+    def test_restart(self):
+        """ A new writer goes on after the counter of the previous one """
+        self.writer.publish({'version' : 1})
+        self.assertEqual(self.reader.read(), {'version' : 1})
+        writer = CacheStateWriter(self.path, 4096)
+        writer.publish({'version' : 1, 'cache_id' : 'new'})
+        self.assertEqual(self.reader.read(), {'version' : 1, 'cache_id' : 'new'})
+        writer.close()
+
+    def test_stale_heartbeat(self):
+        """ The state of a writer whose heartbeat is not refreshed is not used """
+        self.writer.publish({'version' : 1})
+        self.assertEqual(self.reader.read(), {'version' : 1})
+        stale = time.time() - cachestate.STATE_HEARTBEAT_TIMEOUT - 1
+        cachestate._HEARTBEAT.pack_into(self.writer._map, cachestate._HEARTBEAT_OFFSET, stale)
+        self.assertEqual(self.reader.read(), None)
+        self.writer.heartbeat()
+        self.assertEqual(self.reader.read(), {'version' : 1})
+
+    def test_recreated_file(self):
+        """ The reader maps the new file when the heartbeat of the removed one is not refreshed """
+        self.writer.publish({'version' : 1})
+        self.assertEqual(self.reader.read(), {'version' : 1})
+        os.remove(self.path)
+        writer = CacheStateWriter(self.path, 4096)
+        writer.publish({'version' : 1, 'cache_id' : 'new'})
+        stale = time.time() - cachestate.STATE_HEARTBEAT_TIMEOUT - 1
+        cachestate._HEARTBEAT.pack_into(self.writer._map, cachestate._HEARTBEAT_OFFSET, stale)
+        self.assertEqual(self.reader.read(), {'version' : 1, 'cache_id' : 'new'})
+        writer.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+""" This file is part of B{Domogik} project (U{http://www.domogik.org}).
+
+License
+=======
+
+B{Domogik} is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+B{Domogik} is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Domogik. If not, see U{http://www.gnu.org/licenses}.
+
+Module purpose
+==============
+
+Tests of the downsampling of the sensor history (lttb)
+
+@author: Domogik project
+@copyright: (C) 2007-2019 Domogik project
+@license: GPL(v3)
+@organization: Domogik
+"""
+
+import math
+import unittest
+
+from domogik.common.downsampling import lttb
+
+
+def make_values(count):
+    """ Return count (timestamp, value_num) tuples of a sine curve
+    """
+    return [(idx, math.sin(idx / 10.0)) for idx in range(count)]
+
+
+class LttbTestCase(unittest.TestCase):
+
+    def test_first_and_last(self):
+        """ The first and the last values are kept, and at most points values are returned """
+        values = make_values(1000)
+        for points in [3, 4, 10, 100, 999]:
+            result = list(lttb(values, len(values), points))
+            self.assertTrue(len(result) <= points)
+            self.assertEqual(result[0], values[0])
+            self.assertEqual(result[-1], values[-1])
+            # the kept values are values of the history, in the same order
+            timestamps = [value[0] for value in result]
+            self.assertEqual(timestamps, sorted(set(timestamps)))
+
+    def test_few_values(self):
+        """ Less values than points : all the values are returned """
+        values = make_values(10)
+        self.assertEqual(list(lttb(values, len(values), 10)), values)
+        self.assertEqual(list(lttb([], 0, 10)), [])
+        # at least 3 points are kept
+        self.assertEqual(len(list(lttb(make_values(10), 10, 1))), 3)
+
+    def test_peak(self):
+        """ A peak is kept """
+        values = [(idx, 0.0) for idx in range(100)]
+        values[42] = (42, 50.0)
+        self.assertTrue((42, 50.0) in list(lttb(values, len(values), 10)))
+
+    def test_wrong_count(self):
+        """ The iterator may give more or less values than the count """
+        values = make_values(100)
+        result = list(lttb(iter(values), 90, 10))
+        self.assertEqual((result[0], result[-1]), (values[0], values[-1]))
+        result = list(lttb(iter(values), 120, 10))
+        self.assertTrue(len(result) <= 10)
+        self.assertEqual((result[0], result[-1]), (values[0], values[-1]))
+
+    def test_none_values(self):
+        """ The values which are not numbers don't break the selection """
+        values = [(idx, None if idx % 3 else float(idx)) for idx in range(100)]
+        result = list(lttb(values, len(values), 10))
+        self.assertTrue(len(result) <= 10)
+        self.assertEqual((result[0], result[-1]), (values[0], values[-1]))
+
+
+if __name__ == "__main__":
+    unittest.main()
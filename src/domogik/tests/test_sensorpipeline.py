@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+""" This file is part of B{Domogik} project (U{http://www.domogik.org}).
+
+License
+=======
+
+B{Domogik} is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+B{Domogik} is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Domogik. If not, see U{http://www.gnu.org/licenses}.
+
+Module purpose
+==============
+
+Tests of the formulas of the sensors (compile_formula, SensorPipeline)
+
+@author: Domogik project
+@copyright: (C) 2007-2019 Domogik project
+@license: GPL(v3)
+@organization: Domogik
+"""
+
+import unittest
+
+from domogik.common.sensorpipeline import compile_formula, FormulaError, SensorPipeline, FORMULA_MAX_EXPONENT
+
+
+def make_sensor(formula=None, incremental=False):
+    """ Build the sensor informations used by a pipeline
+    """
+    return {'id' : 1, 'incremental' : incremental, 'formula' : formula,
+            'history_round' : 0, 'history_store' : True, 'history_duplicate' : 1}
+
+
+class CompileFormulaTestCase(unittest.TestCase):
+
+    def test_allowed_formulas(self):
+        """ Arithmetic, comparisons, the whitelisted functions and math.xxx are allowed """
+        self.assertEqual(compile_formula("VALUE * 1.8 + 32")(100), 212.0)
+        self.assertEqual(compile_formula("round(VALUE / 3.0, 2)")(10), 3.33)
+        self.assertEqual(compile_formula("max(0, min(VALUE, 100))")(150), 100)
+        self.assertEqual(compile_formula("math.floor(math.sqrt(VALUE))")(17), 4)
+        self.assertEqual(compile_formula("1 if VALUE > 0 and not VALUE > 10 else 0")(5), 1)
+
+    def test_refused_formulas(self):
+        """ Names, attributes, calls and nodes which are not whitelisted are refused """
+        for formula in ["__import__('os').system('ls')",
+                        "open('/etc/passwd')",
+                        "VALUE.__class__",
+                        "math.__dict__",
+                        "[VALUE]",
+                        "VALUE[0]",
+                        "(lambda: 1)()",
+                        "OTHER + 1",
+                        "round(VALUE, ndigits=1)",
+                        "VALUE +"]:
+            self.assertRaises(FormulaError, compile_formula, formula)
+
+    def test_bounded_power(self):
+        """ The ** operator works with small exponents and raises with big ones """
+        self.assertEqual(compile_formula("VALUE ** 2")(3), 9)
+        self.assertEqual(compile_formula("2 ** VALUE")(FORMULA_MAX_EXPONENT), 2 ** FORMULA_MAX_EXPONENT)
+        self.assertEqual(compile_formula("(VALUE ** 2) ** 0.5")(4), 4.0)
+        self.assertRaises(FormulaError, compile_formula("2 ** VALUE"), FORMULA_MAX_EXPONENT + 1)
+        self.assertRaises(FormulaError, compile_formula("VALUE ** 100"), 10 ** 20)
+        self.assertRaises(FormulaError, compile_formula("9 ** 99 ** 99"), 0)
+
+
+class SensorPipelineTestCase(unittest.TestCase):
+
+    def test_formula(self):
+        """ The formula is applied to the numeric value, the original value is kept """
+        pipeline = SensorPipeline(make_sensor("VALUE * 2"))
+        self.assertEqual(pipeline.compute("21", []), (42, "21"))
+        # not a number : the value is not changed
+        self.assertEqual(pipeline.compute("on", []), ("on", "on"))
+
+    def test_invalid_formula(self):
+        """ An invalid formula is ignored """
+        pipeline = SensorPipeline(make_sensor("__import__('os')"))
+        self.assertTrue(pipeline.formula is None)
+        self.assertEqual(pipeline.compute("21", []), ("21", "21"))
+
+    def test_incremental(self):
+        """ An incremental sensor stores the difference with the last original value """
+        pipeline = SensorPipeline(make_sensor(incremental=True))
+        self.assertEqual(pipeline.compute("100", []), (0, "100"))
+        self.assertEqual(pipeline.compute("130", [{'original_value_num' : 100}]), (30.0, "130"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+""" This file is part of B{Domogik} project (U{http://www.domogik.org}).
+
+License
+=======
+
+B{Domogik} is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+B{Domogik} is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Domogik. If not, see U{http://www.gnu.org/licenses}.
+
+Module purpose
+==============
+
+Tests of the xPL commands answers matching (XplCommandAckMatcher)
+
+@author: Domogik project
+@copyright: (C) 2007-2019 Domogik project
+@license: GPL(v3)
+@organization: Domogik
+"""
+
+import time
+import unittest
+
+from domogik.xpl.common.xplcommandack import XplCommandAckMatcher
+
+
+def make_xplstat(schema, statics, dynamics=('current',)):
+    """ Build the xpl stat which confirms a command
+        @param statics : dict key => value of the static params
+    """
+    params = [{'key' : key, 'value' : value, 'static' : True, 'multiple' : None} for key, value in statics.items()]
+    params.extend([{'key' : key, 'value' : None, 'static' : False, 'multiple' : None} for key in dynamics])
+    return {'schema' : schema, 'params' : params}
+
+
+class XplCommandAckMatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.acks = XplCommandAckMatcher(10)
+
+    def test_match_static_values(self):
+        """ An answer matches when the schema and all the static values are the same """
+        self.acks.add('uuid-1', make_xplstat('ac.basic', {'address' : '0x1', 'unit' : '1'}))
+        self.assertEqual(self.acks.match('ac.basic', {'address' : '0x1', 'unit' : '1', 'current' : 'on'}), ['uuid-1'])
+        # an answered command is no more pending
+        self.assertEqual(len(self.acks), 0)
+        self.assertEqual(self.acks.match('ac.basic', {'address' : '0x1', 'unit' : '1', 'current' : 'on'}), [])
+
+    def test_mismatch_static_values(self):
+        """ An answer with a different static value does not match (the static values were not compared before) """
+        self.acks.add('uuid-1', make_xplstat('ac.basic', {'address' : '0x1', 'unit' : '1'}))
+        self.assertEqual(self.acks.match('ac.basic', {'address' : '0x1', 'unit' : '2', 'current' : 'on'}), [])
+        self.assertEqual(self.acks.match('ac.basic', {'address' : '0x2', 'unit' : '1', 'current' : 'on'}), [])
+        self.assertEqual(self.acks.match('lighting.basic', {'address' : '0x1', 'unit' : '1'}), [])
+        self.assertEqual(len(self.acks), 1)
+
+    def test_match_missing_static_key(self):
+        """ A static key which is not in the answer is not checked, and a missing key does not raise KeyError """
+        self.acks.add('uuid-1', make_xplstat('ac.basic', {'address' : '0x1', 'unit' : '1'}))
+        self.assertEqual(self.acks.match('ac.basic', {'address' : '0x2'}), [])
+        self.assertEqual(self.acks.match('ac.basic', {'address' : '0x1'}), ['uuid-1'])
+
+    def test_match_multiple_static_values(self):
+        """ A static param with a 'multiple' separator accepts each of its values """
+        xplstat = make_xplstat('sensor.basic', {}, ())
+        xplstat['params'].append({'key' : 'type', 'value' : 'temp,temperature', 'static' : True, 'multiple' : ','})
+        self.acks.add('uuid-1', xplstat)
+        self.assertEqual(self.acks.match('sensor.basic', {'type' : 'humidity'}), [])
+        self.assertEqual(self.acks.match('sensor.basic', {'type' : 'temperature'}), ['uuid-1'])
+
+    def test_match_several_commands(self):
+        """ All the commands waiting for the same answer are answered, once each """
+        xplstat = make_xplstat('ac.basic', {'address' : '0x1'})
+        self.acks.add('uuid-1', xplstat)
+        self.acks.add('uuid-2', xplstat)
+        self.acks.add('uuid-3', make_xplstat('ac.basic', {'address' : '0x3'}))
+        self.assertEqual(sorted(self.acks.match('ac.basic', {'address' : '0x1'})), ['uuid-1', 'uuid-2'])
+        self.assertEqual(len(self.acks), 1)
+
+    def test_cancel_and_expire(self):
+        """ A cancelled command is not matched, a command without answer expires """
+        self.acks.cancel('unknown')
+        self.acks.add('uuid-1', make_xplstat('ac.basic', {'address' : '0x1'}))
+        self.acks.cancel('uuid-1')
+        self.assertEqual(self.acks.match('ac.basic', {'address' : '0x1'}), [])
+        acks = XplCommandAckMatcher(0)
+        acks.add('uuid-2', make_xplstat('ac.basic', {'address' : '0x2'}))
+        time.sleep(0.01)
+        self.assertEqual(acks.expire(), ['uuid-2'])
+        self.assertEqual(len(acks), 0)
+        self.assertEqual(acks.expire(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
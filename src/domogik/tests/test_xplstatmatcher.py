@@ -0,0 +1,97 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+""" This file is part of B{Domogik} project (U{http://www.domogik.org}).
+
+License
+=======
+
+B{Domogik} is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+B{Domogik} is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Domogik. If not, see U{http://www.gnu.org/licenses}.
+
+Module purpose
+==============
+
+Tests of the xpl stats index (XplStatMatcher)
+
+@author: Domogik project
+@copyright: (C) 2007-2019 Domogik project
+@license: GPL(v3)
+@organization: Domogik
+"""
+
+import unittest
+
+from domogik.xpl.common.xplstatmatcher import XplStatMatcher
+
+
+def make_xplstat(schema, statics, dynamics=('current',)):
+    """ Build an xpl stat
+        @param statics : dict key => value of the static params
+    """
+    params = [{'key' : key, 'value' : value, 'static' : True, 'multiple' : None} for key, value in statics.items()]
+    params.extend([{'key' : key, 'value' : None, 'static' : False, 'multiple' : None} for key in dynamics])
+    return {'schema' : schema, 'params' : params}
+
+def values(found):
+    """ Return the (key, value) of the values found by the matcher
+    """
+    return [(item['param']['key'], item['value']) for item in found]
+
+
+class XplStatMatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.xplstats = [make_xplstat('sensor.basic', {'device' : 'th1', 'type' : 'temp'}),
+                         make_xplstat('sensor.basic', {'device' : 'th1', 'type' : 'humidity'}),
+                         make_xplstat('sensor.basic', {'device' : 'th2', 'type' : 'temp'}),
+                         make_xplstat('sensor.basic', {'device' : 'th1'}, ('battery',)),
+                         make_xplstat('ac.basic', {'address' : '0x1'}, ('command',))]
+        self.matcher = XplStatMatcher(self.xplstats)
+
+    def test_match(self):
+        """ Only the xpl stats with the message schema and static values match """
+        self.assertEqual(len(self.matcher), 5)
+        found = self.matcher.match('sensor.basic', {'device' : 'th1', 'type' : 'temp', 'current' : '21', 'battery' : '90'})
+        self.assertEqual(values(found), [('current', '21'), ('battery', '90')])
+        self.assertTrue(found[0]['param'] is self.xplstats[0]['params'][2])
+        self.assertEqual(values(self.matcher.match('sensor.basic', {'device' : 'th2', 'type' : 'temp', 'current' : '18'})),
+                         [('current', '18')])
+        self.assertEqual(self.matcher.match('sensor.basic', {'device' : 'th3', 'type' : 'temp', 'current' : '18'}), [])
+        self.assertEqual(self.matcher.match('lighting.basic', {'device' : 'th1', 'current' : '18'}), [])
+        self.assertEqual(XplStatMatcher().match('sensor.basic', {'device' : 'th1'}), [])
+
+    def test_missing_static_key(self):
+        """ A static key which is not in the message is not checked """
+        found = self.matcher.match('sensor.basic', {'device' : 'th1', 'current' : '21'})
+        self.assertEqual(values(found), [('current', '21'), ('current', '21')])
+        found = self.matcher.match('sensor.basic', {'type' : 'temp', 'current' : '21'})
+        self.assertEqual(values(found), [('current', '21'), ('current', '21')])
+
+    def test_multiple(self):
+        """ A static param with a 'multiple' separator accepts each of its values, and matches once """
+        xplstat = make_xplstat('sensor.basic', {}, ('current',))
+        xplstat['params'].append({'key' : 'type', 'value' : 'temp,temperature', 'static' : True, 'multiple' : ','})
+        matcher = XplStatMatcher([xplstat])
+        self.assertEqual(values(matcher.match('sensor.basic', {'type' : 'temperature', 'current' : '1'})), [('current', '1')])
+        self.assertEqual(values(matcher.match('sensor.basic', {'type' : 'temp', 'current' : '1'})), [('current', '1')])
+        self.assertEqual(values(matcher.match('sensor.basic', {'current' : '1'})), [('current', '1')])
+        self.assertEqual(matcher.match('sensor.basic', {'type' : 'humidity', 'current' : '1'}), [])
+
+    def test_list_value(self):
+        """ A key which is several times in the message can't match a static value """
+        self.assertEqual(self.matcher.match('ac.basic', {'address' : ['0x1', '0x2'], 'command' : 'on'}), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
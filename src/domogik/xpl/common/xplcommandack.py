@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+""" This file is part of B{Domogik} project (U{http://www.domogik.org}).
+
+License
+=======
+
+B{Domogik} is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+B{Domogik} is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Domogik. If not, see U{http://www.gnu.org/licenses}.
+
+Plugin purpose
+==============
+
+Find the answers to the xPL commands sent by xplgw
+
+When xplgw sends an xPL command, it waits for the xpl stat of the device
+which confirms the command. The pending commands are indexed by the schema
+and by the static values of this xpl stat, so each received message is
+checked as soon as it arrives. The pending commands expire after a timeout,
+handled with a heap of deadlines.
+
+Implements
+==========
+
+- XplCommandAckMatcher
+
+@author: Domogik project
+@copyright: (C) 2007-2019 Domogik project
+@license: GPL(v3)
+@organization: Domogik
+"""
+
+import heapq
+import itertools
+import threading
+import time
+
+from domogik.xpl.common.xplstatmatcher import get_static_alternatives
+
+
+class XplCommandAckMatcher(object):
+    """ Pending xPL commands, waiting for their answer
+        All the methods are thread safe
+    """
+
+    def __init__(self, timeout):
+        """ Init an empty matcher
+            @param timeout : time (in seconds) to wait for the answer of a command
+        """
+        self._timeout = timeout
+        self._cond = threading.Condition()
+        # uuid => (schema, static keys, list of accepted static values, deadline)
+        self._pending = {}
+        # schema => {static keys : {static values : [uuids]}}
+        self._index = {}
+        # heap of (deadline, uuid)
+        self._timers = []
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, uuid, xplstat):
+        """ Wait for the answer to a command
+            @param uuid : command uuid
+            @param xplstat : the xpl stat which confirms the command (dict with the keys 'schema' and 'params')
+        """
+        statics = sorted([param for param in xplstat['params'] if param['static']], key=lambda param: param['key'])
+        keys = tuple([param['key'] for param in statics])
+        combinations = list(itertools.product(*[get_static_alternatives(param) for param in statics]))
+        deadline = time.time() + self._timeout
+        with self._cond:
+            if uuid in self._pending:
+                self._remove(uuid)
+            values_index = self._index.setdefault(xplstat['schema'], {}).setdefault(keys, {})
+            for values in combinations:
+                values_index.setdefault(values, []).append(uuid)
+            self._pending[uuid] = (xplstat['schema'], keys, combinations, deadline)
+            heapq.heappush(self._timers, (deadline, uuid))
+            if self._timers[0][1] == uuid:
+                # the timer thread may wait for a later deadline
+                self._cond.notify_all()
+
+    def cancel(self, uuid):
+        """ Stop waiting for the answer to a command
+        """
+        with self._cond:
+            if uuid in self._pending:
+                self._remove(uuid)
+
+    def match(self, schema, data):
+        """ Find the commands answered by a received message
+            The found commands are no more pending
+            @param schema : message schema
+            @param data : message body (dict)
+            @return the list of the answered commands uuids
+        """
+        with self._cond:
+            if schema not in self._index:
+                return []
+            found = []
+            for keys, values_index in self._index[schema].items():
+                try:
+                    if all([key in data for key in keys]):
+                        found.extend(values_index.get(tuple([data[key] for key in keys]), []))
+                    else:
+                        # some static keys are not in the message : only check the present ones
+                        positions = [pos for pos, key in enumerate(keys) if key in data]
+                        values = [data[keys[pos]] for pos in positions]
+                        for candidate, uuids in values_index.items():
+                            if [candidate[pos] for pos in positions] == values:
+                                found.extend(uuids)
+                except TypeError:
+                    # a key is several times in the message (list value) : it can't match a static value
+                    continue
+            answered = []
+            for uuid in found:
+                if uuid not in answered:
+                    answered.append(uuid)
+                    self._remove(uuid)
+            return answered
+
+    def expire(self):
+        """ Remove the commands which are waiting for longer than the timeout
+            @return the list of the expired commands uuids
+        """
+        now = time.time()
+        expired = []
+        with self._cond:
+            while len(self._timers) > 0 and self._timers[0][0] <= now:
+                deadline, uuid = heapq.heappop(self._timers)
+                # the command may have been answered or added again since
+                if uuid in self._pending and self._pending[uuid][3] == deadline:
+                    self._remove(uuid)
+                    expired.append(uuid)
+        return expired
+
+    def wait(self, max_delay):
+        """ Wait until the next deadline, a new command or max_delay seconds
+        """
+        with self._cond:
+            delay = max_delay
+            if len(self._timers) > 0:
+                delay = min(max_delay, max(0, self._timers[0][0] - time.time()))
+            if delay > 0:
+                self._cond.wait(delay)
+
+    def _remove(self, uuid):
+        """ Remove a pending command from the index. The caller must hold the lock
+            The heap entry is ignored when its deadline is reached
+        """
+        schema, keys, combinations, deadline = self._pending.pop(uuid)
+        values_index = self._index[schema][keys]
+        for values in combinations:
+            uuids = values_index.get(values)
+            if uuids is not None and uuid in uuids:
+                uuids.remove(uuid)
+                if len(uuids) == 0:
+                    del values_index[values]
+        if len(values_index) == 0:
+            del self._index[schema][keys]
+            if len(self._index[schema]) == 0:
+                del self._index[schema]
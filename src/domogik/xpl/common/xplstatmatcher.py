@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+""" This file is part of B{Domogik} project (U{http://www.domogik.org}).
+
+License
+=======
+
+B{Domogik} is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+B{Domogik} is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with Domogik. If not, see U{http://www.gnu.org/licenses}.
+
+Plugin purpose
+==============
+
+Find the xpl stats (and so the sensors) matching a received xPL message.
+
+An xpl stat matches a message when its schema is the message schema and
+when all its static parameters found in the message have the expected
+value. The xpl stats are indexed by schema, by the keys of their static
+parameters and by the values of these parameters, so the cost of a lookup
+does not depend on the number of devices.
+
+Implements
+==========
+
+- XplStatMatcher
+- get_static_alternatives
+
+@author: Domogik project
+@copyright: (C) 2007-2019 Domogik project
+@license: GPL(v3)
+@organization: Domogik
+"""
+
+import itertools
+
+
+def get_static_alternatives(param):
+    """ Return all the message values accepted for a static parameter
+        @param param : xpl stat param (dict with the keys 'value' and 'multiple')
+    """
+    alternatives = [param['value']]
+    if param['multiple'] is not None and len(param['multiple']) == 1 and param['value'] is not None:
+        for value in param['value'].split(param['multiple']):
+            if value not in alternatives:
+                alternatives.append(value)
+    return alternatives
+
+class XplStatMatcher(object):
+    """ Read only index of the xpl stats
+        A new matcher is built each time the devices change
+    """
+
+    def __init__(self, xplstats=None):
+        """ Build the index
+            @param xplstats : list of xpl stats, each one is a dict with the keys 'schema' and 'params'.
+                              'params' is a list of dicts with the keys 'key', 'value', 'static', 'multiple'
+        """
+        # schema => list of [static keys, {static values : [entries]}]
+        self._index = {}
+        # (schema, static keys, present keys) => {present values : [entries]}
+        self._partial = {}
+        self._size = 0
+        if xplstats is not None:
+            for xplstat in xplstats:
+                self._add(xplstat)
+
+    def __len__(self):
+        return self._size
+
+    def _add(self, xplstat):
+        """ Add an xpl stat to the index
+        """
+        statics = sorted([param for param in xplstat['params'] if param['static']], key=lambda param: param['key'])
+        dynamics = [param for param in xplstat['params'] if not param['static']]
+        keys = tuple([param['key'] for param in statics])
+        # an entry is (position, static params, dynamic params)
+        # the position is used to return the results in the xpl stats order
+        entry = (self._size, statics, dynamics)
+        self._size += 1
+
+        signatures = self._index.setdefault(xplstat['schema'], [])
+        for signature in signatures:
+            if signature[0] == keys:
+                values_index = signature[1]
+                break
+        else:
+            values_index = {}
+            signatures.append([keys, values_index])
+
+        for values in itertools.product(*[get_static_alternatives(param) for param in statics]):
+            values_index.setdefault(values, []).append(entry)
+
+    def _get_partial_index(self, schema, keys, present, values_index):
+        """ Return an index on a subset of the static keys
+            It is used for the messages which don't contain all the static keys of some xpl stats
+            The index is built on the first use
+        """
+        partial_key = (schema, keys, present)
+        if partial_key not in self._partial:
+            positions = [keys.index(key) for key in present]
+            partial = {}
+            seen = set()
+            for values, entries in values_index.items():
+                sub_values = tuple([values[pos] for pos in positions])
+                for entry in entries:
+                    # an xpl stat with a 'multiple' param is several times in values_index
+                    if (sub_values, entry[0]) not in seen:
+                        seen.add((sub_values, entry[0]))
+                        partial.setdefault(sub_values, []).append(entry)
+            self._partial[partial_key] = partial
+        return self._partial[partial_key]
+
+    def match(self, schema, data):
+        """ Find the sensors values to store for a message
+            @param schema : message schema
+            @param data : message body (dict)
+            @return a list of {'param' : dynamic xpl stat param, 'value' : value found in the message}
+        """
+        found = []
+        for keys, values_index in self._index.get(schema, []):
+            present = tuple([key for key in keys if key in data])
+            try:
+                values = tuple([data[key] for key in present])
+                if len(present) == len(keys):
+                    entries = values_index.get(values)
+                else:
+                    entries = self._get_partial_index(schema, keys, present, values_index).get(values)
+            except TypeError:
+                # a key is several times in the message (list value) : it can't match a static value
+                entries = None
+            if entries:
+                found.extend(entries)
+        found.sort(key=lambda entry: entry[0])
+
+        tostore = []
+        for position, statics, dynamics in found:
+            for param in dynamics:
+                if param['key'] in data:
+                    tostore.append({'param': param, 'value': data[param['key']]})
+        return tostore